@@ -4,11 +4,14 @@
 #    - compute_bathymetric_roughness_h2(**opts)
 
 import os, hashlib, logging
+import concurrent.futures, multiprocessing
 import numpy as np
 import xarray as xr
 import pdb
 
 from . import meshrefinement
+from . import kernels
+from . import utils
 
 # Functions
 
@@ -44,8 +47,9 @@ def applyExistingLandmask(grd, dsData, dsVariable, maskFile, maskVariable, **kwa
           Maximum depth of the ocean.  Defaults to maximum depth from data source if
           not specified.
         * *TOPO_EDITS_FILE* (``string``) --
-          Changed mask points in the MOM6 zEdits format will be
-          recorded to the specified filename. (Unimplemented)
+          Changed depth points will be recorded to the specified
+          filename in the MOM6 zEdits format.  See
+          :py:func:`write_topo_edits`.  Default: None
 
     .. note::
         For ocean points, if a depth is shallower than the MINIMUM_DEPTH
@@ -108,58 +112,12 @@ def applyExistingLandmask(grd, dsData, dsVariable, maskFile, maskVariable, **kwa
     if masking_depth < -99990.0:
         masking_depth = minimum_depth
 
-    # To use xr.where the data and mask have to be in the same Dataset()
-    workData = xr.Dataset()
-    workData['depth'] = depthGrid
-    workData['land_mask'] = originalLandMask
-    workData['land_mask'].attrs['masking_depth'] = masking_depth
-    workData['land_mask'].attrs['minimum_depth'] = minimum_depth
-    workData['land_mask'].attrs['maximum_depth'] = maximum_depth
-
     msg = ("Beginning application of new land mask (changes noted, if any).")
     grd.printMsg(msg, level=logging.INFO)
 
-    # 1. Test points that should be makred as land.  If they are deeper
-    #    than the masking depth, set them to the masking depth.  If
-    #    the masking depth is not defined, use the minimum depth.
-
-    # MOM6 RULE: A depth equal or shallower than MASKING_DEPTH is masked as land.
-    condExp = (workData['land_mask'] == 1) & (workData['depth'] > masking_depth)
-    # This returns the number of matching points
-    nPts = condExp.data.ravel().sum()
-    if nPts > 0:
-        msg = (" * Number of land mask points with new depth of %f: %d" % (masking_depth, nPts))
-        grd.printMsg(msg, level=logging.INFO)
-    workData['newDepth'] = xr.where(condExp, masking_depth, workData['depth'])
-
-    # 2. Test points that should be marked as ocean.  If they are shallower than
-    #    the masking depth, then set them to the minimum depth.  If
-    #    masking depth is undefined, set them to the minimum depth + epsilon.
-
-    condExp = (workData['land_mask'] == 0) & (workData['newDepth'] < masking_depth)
-    nPts = condExp.data.ravel().sum()
-    if nPts > 0:
-        if masking_depth == minimum_depth:
-            msg = (" * Number of ocean points with new depth of %f: %d" % (minimum_depth + epsilon_depth, nPts))
-            workData['newDepth'] = xr.where(condExp, minumum_depth + epsilon_depth, workData['newDepth'])
-        else:
-            msg = (" * Number of ocean points with new depth of %f: %d" % (minimum_depth, nPts))
-            workData['newDepth'] = xr.where(condExp, minimum_depth, workData['newDepth'])
-        grd.printMsg(msg, level=logging.INFO)
-
-    # 3. If masking depth is defined, check ocean points that might violate minimum depth.
-    if masking_depth < minimum_depth:
-        condExp = (workData['land_mask'] == 0) & (workData['newDepth'] < minimum_depth)
-        nPts = condExp.data.ravel().sum()
-        if nPts > 0:
-            msg = (" * Number of ocean points set to minimum depth: %d" % (nPts))
-            workData['newDepth'] = xr.where(condExp, minimum_depth, workData['newDepth'])
-            grd.printMsg(msg, level=logging.INFO)
-
-    # Update hash for the new grid
-    workData['newDepth'].attrs['sha256'] = hashlib.sha256( np.array( workData['newDepth'] ) ).hexdigest()
-
-    return workData['newDepth']
+    # A land mask marks land with 1 and ocean with 0
+    return _apply_existing_mask(grd, depthGrid, originalLandMask, 1,
+            masking_depth, minimum_depth, epsilon_depth, **kwargs)
 
 def applyExistingOceanmask(grd, dsData, dsVariable, maskFile, maskVariable, **kwargs):
     '''Modify a given bathymetry using a specified ocean mask.
@@ -193,8 +151,9 @@ def applyExistingOceanmask(grd, dsData, dsVariable, maskFile, maskVariable, **kw
           Maximum depth of the ocean.  Defaults to maximum depth from data source if
           not specified.
         * *TOPO_EDITS_FILE* (``string``) --
-          Changed mask points in the MOM6 zEdits format will be
-          recorded to the specified filename. (Unimplemented)
+          Changed depth points will be recorded to the specified
+          filename in the MOM6 zEdits format.  See
+          :py:func:`write_topo_edits`.  Default: None
 
     .. note::
         For ocean points, if a depth is shallower than the MINIMUM_DEPTH
@@ -257,63 +216,189 @@ def applyExistingOceanmask(grd, dsData, dsVariable, maskFile, maskVariable, **kw
     if masking_depth < -99990.0:
         masking_depth = minimum_depth
 
-    # To use xr.where the data and mask have to be in the same Dataset()
-    workData = xr.Dataset()
-    workData['depth'] = depthGrid
-    workData['ocean_mask'] = originalOceanMask
-    workData['ocean_mask'].attrs['masking_depth'] = masking_depth
-    workData['ocean_mask'].attrs['minimum_depth'] = minimum_depth
-    workData['ocean_mask'].attrs['maximum_depth'] = maximum_depth
-
     msg = ("Beginning application of new ocean mask (changes noted, if any).")
     grd.printMsg(msg, level=logging.INFO)
 
-    # With the given ocean mask, we now test points that need to change
-    # based on given depths and given parameters.
+    # An ocean mask marks land with 0 and ocean with 1
+    return _apply_existing_mask(grd, depthGrid, originalOceanMask, 0,
+            masking_depth, minimum_depth, epsilon_depth, **kwargs)
+
+def apply_mask_rules(depth, mask, masking_depth, minimum_depth, epsilon=1.0e-14, land_value=1):
+    '''Apply the MOM6 masking rules to a depth array in a single pass.
+
+    :param depth: depth (positive down)
+    :type depth: numpy.ndarray
+    :param mask: mask with the same shape as depth; points not equal
+                 to 0 or 1 are left alone
+    :type mask: numpy.ndarray
+    :param masking_depth: masking depth (at most the minimum depth)
+    :type masking_depth: float
+    :param minimum_depth: minimum ocean depth
+    :type minimum_depth: float
+    :param epsilon: offset added to the minimum depth for ocean points
+                    when the masking depth equals the minimum depth
+    :type epsilon: float
+    :param land_value: mask value of land points (1 for a land mask,
+                       0 for an ocean mask)
+    :type land_value: int
+    :return: new depth, edits as a tuple of ``(i, j, old, new)`` arrays
+             and the number of points changed by each rule
+    :rtype: tuple
 
-    # 1. Test points that should be marked as land.  If they are deeper
-    #    than the masking depth, set them to the masking depth.  If
-    #    masking depth is undefined, use minimum depth.
+    .. note::
+        The rules are applied to the original depth.  Rule 1 only
+        changes land points and rules 2 and 3 select disjoint sets of
+        ocean points, so this gives the same result as applying them
+        one after another.  Only the new depth is allocated at full
+        size in floating point.
+    '''
 
-    # MOM6 RULES: A depth equal or shallower than MASKING_DEPTH is masked as land.
-    #             If MASKING_DEPTH is undefined, use MINIMUM_DEPTH for MASKING_DEPTH.
-    condExp = (workData['ocean_mask'] == 0) & (workData['depth'] > masking_depth)
-    # This returns the number of matching points
-    nPts = condExp.data.ravel().sum()
-    if nPts > 0:
-        msg = (" * Number of land mask points with new depth of %f: %d" % (masking_depth, nPts))
-        grd.printMsg(msg, level=logging.INFO)
+    depth = np.asarray(depth)
+    mask = np.asarray(mask)
+    if depth.shape != mask.shape:
+        raise Exception("Mask shape %s does not match depth shape %s." % (mask.shape, depth.shape))
+
+    land = mask == land_value
+    ocean = mask == (1 - land_value)
+
+    # 1. Land points deeper than the masking depth are set to the masking depth
+    # 2. Ocean points shallower than the masking depth are set to the minimum
+    #    depth (plus epsilon if that equals the masking depth)
+    # 3. Remaining ocean points shallower than the minimum depth are set to
+    #    the minimum depth
+    toOcean = minimum_depth
+    if masking_depth == minimum_depth:
+        toOcean = minimum_depth + epsilon
+    rules = [(land & (depth > masking_depth), masking_depth),
+             (ocean & (depth < masking_depth), toOcean)]
+    if masking_depth < minimum_depth:
+        rules.append((ocean & (depth >= masking_depth) & (depth < minimum_depth), minimum_depth))
+    del land, ocean
+
+    newDepth = depth.copy()
+    counts = np.zeros(3, dtype=np.int64)
+    idx = []
+    for (n, (cond, value)) in enumerate(rules):
+        k = np.flatnonzero(cond)
+        newDepth.flat[k] = value
+        counts[n] = k.size
+        idx.append(k)
+    idx = np.sort(np.concatenate(idx))
+
+    j, i = np.unravel_index(idx, depth.shape)
+    edits = (i, j, depth.flat[idx], newDepth.flat[idx])
+
+    return newDepth, edits, counts
+
+def write_topo_edits(grd, edits, shape, filename):
+    '''Write depth edits to a file in the MOM6 zEdits format.
+
+    :param grd: class object
+    :type grd: GridUtils
+    :param edits: tuple of ``(i, j, old, new)`` arrays
+    :type edits: tuple
+    :param shape: shape of the depth grid ``(nj, ni)``
+    :type shape: tuple
+    :param filename: output filename
+    :type filename: string
+
+    .. note::
+        The indices are zero based as expected by MOM6 (TOPO_EDITS_FILE).
+        The previous depths are kept in ``zOld`` so that the edits can
+        be reverted.
+    '''
 
-    workData['newDepth'] = xr.where(condExp, masking_depth, workData['depth'])
+    (i, j, old, new) = edits
+    edFile = xr.Dataset()
+    edFile['ni'] = xr.DataArray(np.int32(shape[1]))
+    edFile['nj'] = xr.DataArray(np.int32(shape[0]))
+    edFile['iEdit'] = xr.DataArray(np.asarray(i, dtype=np.int32), dims=('nEdits'))
+    edFile['jEdit'] = xr.DataArray(np.asarray(j, dtype=np.int32), dims=('nEdits'))
+    edFile['zEdit'] = xr.DataArray(np.asarray(new, dtype=np.float64), dims=('nEdits'))
+    edFile['zOld'] = xr.DataArray(np.asarray(old, dtype=np.float64), dims=('nEdits'))
+    edFile['iEdit'].attrs['long_name'] = 'i-index of edited data'
+    edFile['jEdit'].attrs['long_name'] = 'j-index of edited data'
+    edFile['zEdit'].attrs['long_name'] = 'New value of data'
+    edFile['zEdit'].attrs['units'] = 'meters'
+    edFile['zOld'].attrs['long_name'] = 'Original value of data'
+    edFile['zOld'].attrs['units'] = 'meters'
+
+    edFile.to_netcdf(filename, encoding=grd.removeFillValueAttributes(data=edFile))
+
+    msg = ("Wrote %d topography edits to %s." % (len(i), filename))
+    grd.printMsg(msg, level=logging.INFO)
 
-    # 2. Test points that should be marked as ocean.  If they are shallower than
-    #    the masking depth, then set them to the minimum depth.  If
-    #    masking depth is undefined, set them to the minimum depth + epsilon.
+def _apply_existing_mask(grd, depthGrid, maskGrid, land_value, masking_depth, minimum_depth, epsilon_depth, **kwargs):
+    '''Apply the MOM6 masking rules for applyExistingLandmask() and
+    applyExistingOceanmask().'''
 
-    condExp = (workData['ocean_mask'] == 1) & (workData['newDepth'] < masking_depth)
-    nPts = condExp.data.ravel().sum()
-    if nPts > 0:
+    newDepth, edits, counts = apply_mask_rules(depthGrid.values, maskGrid.values,
+            masking_depth, minimum_depth, epsilon=epsilon_depth, land_value=land_value)
+
+    # MOM6 RULE: A depth equal or shallower than MASKING_DEPTH is masked as land.
+    if counts[0] > 0:
+        msg = (" * Number of land mask points with new depth of %f: %d" % (masking_depth, counts[0]))
+        grd.printMsg(msg, level=logging.INFO)
+    if counts[1] > 0:
         if masking_depth == minimum_depth:
-            msg = (" * Number of ocean points with new depth of %f: %d" % (minimum_depth + epsilon_depth, nPts))
-            workData['newDepth'] = xr.where(condExp, minimum_depth + epsilon_depth, workData['newDepth'])
+            msg = (" * Number of ocean points with new depth of %f: %d" % (minimum_depth + epsilon_depth, counts[1]))
         else:
-            msg = (" * Number of ocean points with new depth of %f: %d" % (minimum_depth, nPts))
-            workData['newDepth'] = xr.where(condExp, minimum_depth, workData['newDepth'])
+            msg = (" * Number of ocean points with new depth of %f: %d" % (minimum_depth, counts[1]))
+        grd.printMsg(msg, level=logging.INFO)
+    if counts[2] > 0:
+        msg = (" * Number of ocean points set to minimum depth: %d" % (counts[2]))
         grd.printMsg(msg, level=logging.INFO)
 
-    # 3. If masking depth is defined, check ocean points that might violate minimum depth.
-    if masking_depth < minimum_depth:
-        condExp = (workData['ocean_mask'] == 1) & (workData['newDepth'] < minimum_depth)
-        nPts = condExp.data.ravel().sum()
-        if nPts > 0:
-            msg = (" * Number of ocean points set to minimum depth: %d" % (nPts))
-            workData['newDepth'] = xr.where(condExp, minimum_depth, workData['newDepth'])
-            grd.printMsg(msg, level=logging.INFO)
+    if kwargs.get('TOPO_EDITS_FILE', None):
+        write_topo_edits(grd, edits, newDepth.shape, kwargs['TOPO_EDITS_FILE'])
 
-    # Update hash for the new grid
-    workData['newDepth'].attrs['sha256'] = hashlib.sha256( np.array( workData['newDepth'] ) ).hexdigest()
+    newDepth = xr.DataArray(newDepth, dims=depthGrid.dims, coords=depthGrid.coords)
 
-    return workData['newDepth']
+    # Update hash for the new grid
+    newDepth.attrs['sha256'] = utils.sha256sum( newDepth )
+
+    return newDepth
+
+def label_wet_components(wet, periodic=False, tripolar=False):
+    """Returns the labels of the connected components of the wet points and the
+    number of components.  Points are connected to their four neighbors.  Land
+    points have the label 0, wet points have labels 1 to the number of components.
+
+    :param wet: True at wet points
+    :type wet: numpy.ndarray
+    :param periodic: if True, the first and last columns are neighbors
+    :type periodic: boolean
+    :param tripolar: if True, the last row is folded onto itself so the point at
+                     column i is a neighbor of the point at column ni-1-i
+    :type tripolar: boolean
+    :return: labels with the shape of wet, number of components
+    :rtype: tuple
+    """
+    from scipy import ndimage, sparse
+    from scipy.sparse import csgraph
+
+    labels, nlabels = ndimage.label(wet)
+    if nlabels == 0 or not(periodic or tripolar):
+        return labels, nlabels
+
+    # Pairs of labels joined across the periodic boundary and the fold
+    first, second = [], []
+    if periodic:
+        first.append(labels[:,0])
+        second.append(labels[:,-1])
+    if tripolar:
+        first.append(labels[-1,:])
+        second.append(labels[-1,::-1])
+    first, second = np.concatenate(first), np.concatenate(second)
+    joined = (first > 0) & (second > 0)
+    graph = sparse.coo_matrix((np.ones(joined.sum(), dtype=np.int8), (first[joined], second[joined])),
+            shape=(nlabels+1, nlabels+1))
+    ncomponents, component = csgraph.connected_components(graph, directed=False)
+
+    # Renumber the merged components from 1, land (label 0) is a component of its own
+    _, merged = np.unique(component[1:], return_inverse=True)
+    merged = np.concatenate(([0], merged+1))
+    return merged[labels], ncomponents-1
 
 def ice9(grd, **kwargs):
     '''
@@ -334,7 +419,6 @@ def ice9(grd, **kwargs):
           as areas that should be treated as areas of continuous ocean points.  
           If more than one seed is given, all the discovered wet points will be
           merged together to form the final grid minus any detached ocean points (lakes).
-          NOTE: Only the first seed is used! Future releases will allow multiple seeds.
         * *depth* (``grid``) --
           The depth grid to use for ice-9 algorithm.  This should be the same size as
           the provided latitude and logitude points defining the grid.  Values are
@@ -342,7 +426,9 @@ def ice9(grd, **kwargs):
         * *periodic* (``boolean``) --
           Tells the algorithm that the grid is periodic and should
           check wrap points.  Default: False
-          NOTE: Not implemented!
+        * *tripolar* (``boolean``) --
+          Tells the algorithm that the last row of the grid is folded onto
+          itself as in a tripolar grid.  Default: False
         * *returnFields* (``list``) --
           List of fields to be returned in the grd object.  Default: ['wetMask']
         * *MINIMUM_DEPTH* (``float``) -- minimum depth of ocean in meters. Default: 0.0
@@ -358,99 +444,318 @@ def ice9(grd, **kwargs):
 
     Another reference to the ice-9 algorithm is metioned in the
     repository `regrid_runoff` by  Alistair Adcroft.  :cite:p:`Adcroft_2020_regrid_runoff`.
+
+    .. note::
+
+        Points deeper than MASKING_DEPTH are wet.  The wet points are labeled
+        as connected components in one pass, see :py:func:`label_wet_components`,
+        and the wet mask keeps every component that contains a seed.  Seeds on
+        land are ignored.  The returned wet mask has the attributes
+        `components` (number of wet components), `seeded_components`,
+        `wet_points` (wet points before ice-9) and `ocean_points`
+        (wet points kept by ice-9).
     '''
 
+    if not('periodic' in kwargs.keys()):
+        kwargs['periodic'] = False
+
+    if not('tripolar' in kwargs.keys()):
+        kwargs['tripolar'] = False
+
+    if not('MASKING_DEPTH' in kwargs.keys()):
+        kwargs['MASKING_DEPTH'] = 0.0
+
+    depth = np.asarray(kwargs['depth'])
+    (nj, ni) = depth.shape
+    wet = depth > kwargs['MASKING_DEPTH']
+    labels, ncomponents = label_wet_components(wet, periodic=kwargs['periodic'], tripolar=kwargs['tripolar'])
+
     # Run through each ocean_seed provided
-    # TODO: This only runs through the first seed
+    seeded = np.zeros(ncomponents+1, dtype=bool)
     for oceanSeed in kwargs['ocean_seeds']:
-        depth = kwargs['depth']
-        (nj, ni) = depth.shape
-        wetMask = xr.DataArray(data = np.zeros((nj, ni)), dims = ("ny", "nx"))
-        stack = set()
-        stack.add( oceanSeed )
-        while stack:
-            (j,i) = stack.pop()
-            # If we are already marked wet or see a land point
-            # skip to the next point.
-            if wetMask[j,i] or depth[j,i] <= kwargs['MASKING_DEPTH']: continue
-            wetMask[j,i] = 1
-
-            # Check surrounding points
-            # For periodic boundaries, check wrap points
-            if i>0: stack.add( (j,i-1) )
-            #else: stack.add( (j,ni-1) )
-            if i<ni-1: stack.add( (j,i+1) )
-            #else: stack.add( (j,0) )
-            if j>0: stack.add( (j-1,i) )
-            if j<nj-1: stack.add( (j+1,i) )
-            #else: stack.add( (j,ni-1-i) )
-
-        # Only run the first seed for now
-        break
+        (j,i) = oceanSeed
+        if labels[j,i] == 0:
+            msg = ("WARNING: ice9: ocean seed (%d,%d) is on land and is ignored." % (j,i))
+            grd.printMsg(msg, level=logging.WARNING)
+            continue
+        seeded[labels[j,i]] = True
+
+    wetMask = xr.DataArray(data = seeded[labels].astype(np.float64), dims = ("ny", "nx"))
+    wetMask.attrs['components'] = ncomponents
+    wetMask.attrs['seeded_components'] = int(seeded.sum())
+    wetMask.attrs['wet_points'] = int(wet.sum())
+    wetMask.attrs['ocean_points'] = int(wetMask.sum())
 
     return wetMask
 
+def neighbor_pairs(shape, periodic=False, tripolar=False):
+    """Returns the flat indexes (a,b) of each pair of neighboring points of a grid
+    with the given shape.  See :py:func:`label_wet_components` for the neighbors."""
+    (nj, ni) = shape
+    idx = np.arange(nj*ni).reshape(shape)
+    a = [idx[:,:-1].ravel(), idx[:-1,:].ravel()]
+    b = [idx[:,1:].ravel(), idx[1:,:].ravel()]
+    if periodic and ni > 2:
+        a.append(idx[:,-1])
+        b.append(idx[:,0])
+    if tripolar:
+        fold = np.arange(ni//2)
+        a.append(idx[-1,fold])
+        b.append(idx[-1,ni-1-fold])
+    return np.concatenate(a), np.concatenate(b)
+
+def _bottleneck_depth(forest, depth, root, backend=None):
+    """Returns, for each point, the largest depth the water can be lowered to
+    (exclusive) with the point still connected to the root.  This is the smallest
+    depth on the path to the root in the maximum spanning forest.  Points without
+    a path have -inf."""
+    from scipy import sparse
+    from scipy.sparse import csgraph
+
+    n = depth.size
+    tree = sparse.csr_matrix((np.ones(forest[0].size, dtype=np.int8), forest), shape=(n, n))
+    order, parent = csgraph.breadth_first_order(tree, root, directed=False, return_predecessors=True)
+
+    # Smallest depth of each point and its parent on the edge between them
+    reached = parent >= 0
+    parent = np.where(reached, parent, np.arange(n))
+    edge = np.where(reached, np.minimum(depth, depth[parent]), -np.inf)
+    edge[root] = depth[root]
+    return kernels.path_minimum(order, parent, edge, backend=backend)
+
+def ice9Sweep(grd, **kwargs):
+    '''
+    Applies the ice-9 algorithm for several masking depths at once and returns the
+    number of wet points, the number of wet components (basins), the number of
+    components connected to the ocean seeds and the ocean points and area
+    connected to the seeds for each masking depth.  This helps to choose a
+    MASKING_DEPTH or MINIMUM_DEPTH without running :py:func:`ice9` for each one.
+
+    :param grd: class object
+    :type grd: GridUtils
+    :param \**kwargs:
+        See below
+    :return: dataset with the dimension `maskingDepth`
+    :rtype: xarray.Dataset
+
+    **Keyword arguments**:
+
+        * *ocean_seeds* (``[(int, int)]``) --
+          One or more (j,i) ocean points.  See :py:func:`ice9`.
+        * *depth* (``grid``) --
+          The depth grid to use for ice-9 algorithm.  See :py:func:`ice9`.
+        * *maskingDepths* (``list``) --
+          Masking depths of the ocean in meters.  Points deeper than the masking
+          depth are wet.
+        * *periodic* (``boolean``) --
+          Tells the algorithm that the grid is periodic and should
+          check wrap points.  Default: False
+        * *tripolar* (``boolean``) --
+          Tells the algorithm that the last row of the grid is folded onto
+          itself as in a tripolar grid.  Default: False
+        * *area* (``grid``) --
+          Area of the grid cells.  Default: the area of the grid, if it matches
+          the depth grid, otherwise the ocean area is not returned.
+
+    .. note::
+
+        The variables of the returned dataset are `wet_points`, `components`,
+        `seeded_components`, `lakes` (components not connected to a seed),
+        `ocean_points` and `ocean_area`.  For each masking depth, these are the
+        same as the attributes of the wet mask returned by :py:func:`ice9`.
+
+        Neighboring points are joined at the shallower of their depths.  A
+        maximum spanning forest of the grid, computed once, joins the wet points
+        of every masking depth into the same components.  The number of components
+        is the number of wet points less the number of forest edges deeper than the
+        masking depth.  The points connected to the seeds are found in a single pass
+        over the forest with the seeds joined to a common root.  The time grows with
+        neither the number of seeds nor the number of masking depths.
+    '''
+    from scipy import sparse
+    from scipy.sparse import csgraph
+
+    if not('periodic' in kwargs.keys()):
+        kwargs['periodic'] = False
+
+    if not('tripolar' in kwargs.keys()):
+        kwargs['tripolar'] = False
+
+    if not('area' in kwargs.keys()):
+        kwargs['area'] = None
+
+    depth = np.asarray(kwargs['depth'], dtype=np.float64)
+    (nj, ni) = depth.shape
+    maskingDepths = np.atleast_1d(np.asarray(kwargs['maskingDepths'], dtype=np.float64))
+    area = kwargs['area']
+    if area is None and hasattr(grd, 'grid') and 'area' in grd.grid and grd.grid['area'].shape == (2*nj, 2*ni):
+        # Cells of the model grid are 2x2 cells of the supergrid
+        area = np.asarray(grd.grid['area']).reshape((nj, 2, ni, 2)).sum(axis=(1,3))
+    d = np.where(np.isnan(depth), -np.inf, depth).ravel()
+
+    # Maximum spanning forest of the edges that are wet for some masking depth
+    a, b = neighbor_pairs((nj, ni), periodic=kwargs['periodic'], tripolar=kwargs['tripolar'])
+    w = np.minimum(d[a], d[b])
+    keep = w > maskingDepths.min()
+    a, b, w = a[keep], b[keep], w[keep]
+    if w.size > 0:
+        # Edge weights must be positive; the deepest edges are the lightest
+        graph = sparse.csr_matrix(((w.max()-w)+1., (a, b)), shape=(nj*ni, nj*ni))
+        forest = csgraph.minimum_spanning_tree(graph).tocoo()
+        forest = (forest.row, forest.col)
+    else:
+        forest = (np.zeros(0, dtype=int), np.zeros(0, dtype=int))
+    levels = np.unique(maskingDepths)
+    where = np.searchsorted(levels, maskingDepths)
+
+    def deeper(values, weights=None):
+        # Number (or sum of weights) of values deeper than each masking depth
+        count = np.bincount(np.searchsorted(levels, values), weights=weights, minlength=levels.size+1)
+        return np.cumsum(count[::-1])[::-1][1:][where]
+
+    wetPoints = deeper(d)
+    forestDepth = np.minimum(d[forest[0]], d[forest[1]])
+    components = wetPoints - deeper(forestDepth)
+
+    # Points connected to any seed.  A root point, joined to every seed by an edge
+    # deeper than any other, is added to the forest and the maximum spanning tree
+    # of the result gives the deepest path of every point to any seed in one pass.
+    # The forest edges left out of this tree are those that join two components
+    # each holding a seed, which are no longer separate above the edge depth.
+    seeds = np.unique([j*ni+i for (j,i) in kwargs['ocean_seeds']])
+    root = d.size
+    dRoot = np.append(d, np.inf)
+    if forestDepth.size > 0:
+        forestWeight = (forestDepth.max()-forestDepth)+1.
+    else:
+        forestWeight = forestDepth
+    graph = sparse.csr_matrix((np.concatenate((forestWeight, np.full(seeds.size, 0.5))),
+        (np.concatenate((forest[0], np.full(seeds.size, root))), np.concatenate((forest[1], seeds)))),
+        shape=(root+1, root+1))
+    tree = csgraph.minimum_spanning_tree(graph).tocoo()
+    bottleneck = _bottleneck_depth((tree.row, tree.col), dRoot, root)[:-1]
+    inForest = (tree.row != root) & (tree.col != root)
+    treeDepth = np.minimum(d[tree.row[inForest]], d[tree.col[inForest]])
+    oceanPoints = deeper(bottleneck)
+    if area is not None:
+        oceanArea = deeper(bottleneck, weights=np.asarray(area, dtype=np.float64).ravel())
+    seededComponents = deeper(d[seeds]) - (deeper(forestDepth) - deeper(treeDepth))
+
+    sweep = xr.Dataset(coords={'maskingDepth': maskingDepths})
+    sweep['wet_points'] = ('maskingDepth', wetPoints)
+    sweep['components'] = ('maskingDepth', components)
+    sweep['seeded_components'] = ('maskingDepth', seededComponents)
+    sweep['lakes'] = ('maskingDepth', components - seededComponents)
+    sweep['ocean_points'] = ('maskingDepth', oceanPoints)
+    if area is not None:
+        sweep['ocean_area'] = ('maskingDepth', oceanArea)
+    sweep['maskingDepth'].attrs['units'] = 'm'
+
+    return sweep
+
 # Original functions from create_topog_refinedSampling.py
 
-def break_array_to_blocks(a, xb=4, yb=1, useOverlap=False, useSupergrid=False):
-    a_win = []
-    # TODO: xb==8 or other values are not completely supported
-    if ((xb == 4 or xb == 8) and yb == 1):
-        i1 = a.shape[1]//xb
-        i2 = 2*i1
-        i3 = 3*i1
-        i4 = a.shape[1]
-
-        j1 = a.shape[0]//yb
-
-        # If we are using the overlap, add points in the
-        # j-direction which we dispose of to get rid of the
-        # zero bands.
-        if useOverlap:
-            a_win.append(a[0:j1,0:i1+1])
-            a_win.append(a[0:j1,i1:i2+1])
-            a_win.append(a[0:j1,i2:i3+1])
-            a_win.append(a[0:j1,i3:i4])
+def estimate_refinement_factor(lon, lat, src_lon, src_lat):
+    """Returns the power of two refinement factor needed for the cells of the
+    target mesh (lon,lat) to be no larger than the spacing of the source grid
+    (src_lon,src_lat), see meshrefinement.refine_levels()."""
+    return 2**meshrefinement.refine_levels(lon, lat, src_lon, src_lat)
+
+def block_bounds(n, nb, halo=0):
+    """Returns a list of (start, stop) index pairs that split n points into nb
+    blocks.  The last block receives any remaining points.  Every block, except
+    the last one, is extended by halo points into the next block."""
+    size = n//nb
+    bounds = []
+    for b in range(nb):
+        start = b*size
+        if b == nb-1:
+            stop = n
+        else:
+            stop = min((b+1)*size + halo, n)
+        bounds.append((start, stop))
+    return bounds
+
+def plan_blocks(shape, max_mb=8000, refine_factor=1, halo=1):
+    """Returns the number of blocks (yb, xb) in the j and i directions needed to
+    keep the finest refinement of each block of a target mesh with the given
+    shape within max_mb.  The memory estimate matches the one used by
+    MeshRefinement.refine_loop(): two double precision coordinates per refined
+    mesh node.  The direction with the most points per block is split first."""
+    nj, ni = shape
+
+    def largest(n, nb):
+        # The last block holds the remainder; other blocks hold the halo.
+        if nb == 1:
+            return n
+        return max(n//nb + halo, n//nb + n%nb)
+
+    def block_mb(yb, xb):
+        bj, bi = largest(nj, yb), largest(ni, xb)
+        nodes = (refine_factor*(bj-1)+1) * (refine_factor*(bi-1)+1)
+        return 2*8*nodes/1024/1024
+
+    yb, xb = 1, 1
+    while block_mb(yb, xb) >= max_mb:
+        # Each block needs at least two points in each direction
+        canSplitI = ni//(xb+1) >= 2
+        canSplitJ = nj//(yb+1) >= 2
+        if canSplitI and (ni//xb >= nj//yb or not(canSplitJ)):
+            xb = xb + 1
+        elif canSplitJ:
+            yb = yb + 1
         else:
-            a_win.append(a[0:j1,0:i1])
-            a_win.append(a[0:j1,i1:i2])
-            a_win.append(a[0:j1,i2:i3])
-            a_win.append(a[0:j1,i3:i4])
+            break
 
-        return a_win
-    else:
-        raise Exception('This routine can only make 2x2 blocks!')
-        ##Niki: Implement a better algo and lift this restriction
+    return yb, xb
+
+def break_array_to_blocks(a, xb=4, yb=1, useOverlap=False, useSupergrid=False, halo=None):
+    """Breaks the 2D array a into yb x xb blocks.  Blocks are returned in row
+    major order (i varies fastest).  If the halo is not specified, a halo of one
+    point is used with useOverlap, otherwise no halo is used.  The halo points
+    are disposed of by undo_break_array_to_blocks() to get rid of the zero
+    bands at the block boundaries."""
+    if halo is None:
+        halo = 1 if useOverlap else 0
+
+    a_win = []
+    for (j0, j1) in block_bounds(a.shape[0], yb, halo=halo):
+        for (i0, i1) in block_bounds(a.shape[1], xb, halo=halo):
+            a_win.append(a[j0:j1,i0:i1])
+
+    return a_win
 
 def undo_break_array_to_blocks(a, xb=4, yb=1, useOverlap=False, extendedGrid=False,
-        useSupergrid=False, useQHGridShift=False):
-    if (xb == 4 and yb == 1):
-        if useOverlap:
-            ao = np.append(a[0][:,:-1], a[1], axis=1)
-            ao = np.append(ao[:,:-1]  , a[2], axis=1)
-            ao = np.append(ao[:,:-1]  , a[3], axis=1)
-            # If we are using the QHGridShift,
-            # trim y+1,x and y,x+1, otherwise send
-            # the grid back untrimmed.
-            if useQHGridShift:
-                ao = ao[:-1,:-1]
-        else:
-            ao = np.append(a[0], a[1], axis=1)
-            ao = np.append(ao  , a[2], axis=1)
-            ao = np.append(ao  , a[3], axis=1)
-        return ao
-    elif (xb == 8 and yb == 1):
-        ao = np.append(a[0], a[1], axis=1)
-        ao = np.append(ao  , a[2], axis=1)
-        ao = np.append(ao  , a[3], axis=1)
-        ao = np.append(ao  , a[4], axis=1)
-        ao = np.append(ao  , a[5], axis=1)
-        ao = np.append(ao  , a[6], axis=1)
-        ao = np.append(ao  , a[7], axis=1)
-        return ao
-    else:
-        raise Exception('This routine can only make 2x2 blocks!')
-        ##TODO: Implement a better algorithm and lift this restriction
+        useSupergrid=False, useQHGridShift=False, halo=None):
+    """Reassembles a list of blocks produced by break_array_to_blocks() into a
+    single 2D array.  The halo points of each block, except for the blocks in
+    the last row and column, are removed."""
+    if halo is None:
+        halo = 1 if useOverlap else 0
+
+    if len(a) != xb*yb:
+        raise Exception('Expected %d blocks, received %d blocks!' % (xb*yb, len(a)))
+
+    rows = []
+    for jb in range(yb):
+        row = []
+        for ib in range(xb):
+            blk = a[jb*xb+ib]
+            if jb < yb-1:
+                blk = blk[:blk.shape[0]-halo,:]
+            if ib < xb-1:
+                blk = blk[:,:blk.shape[1]-halo]
+            row.append(blk)
+        rows.append(row)
+    ao = np.block(rows)
+
+    # If we are using the QHGridShift,
+    # trim y+1,x and y,x+1, otherwise send
+    # the grid back untrimmed.
+    if useOverlap and useQHGridShift:
+        ao = ao[:-1,:-1]
+
+    return ao
 
 def get_indices1D_old(lon_grid, lat_grid, x, y):
     """This function returns the j,i indices for the grid point closest to the input lon,lat coordinates."""
@@ -473,13 +778,21 @@ def mdist(x1, x2):
 def get_indices1D(lon_grid,lat_grid,x,y):
     """This function returns the j,i indices for the grid point closest to the input lon,lat coordinates."""
     """It returns the j,i indices."""
-#    lons=np.fabs(lon_grid-x)
-    lons=np.fabs(mdist(lon_grid,x))
-    lonm=np.where(lons==lons.min())
-    lats=np.fabs(lat_grid-y)
-    latm=np.where(lats==lats.min())
-    j0=latm[0][0]
-    i0=lonm[0][0]
+    xaxis = meshrefinement.uniform_axis(lon_grid, period=360.)
+    yaxis = meshrefinement.uniform_axis(lat_grid)
+    if xaxis is not None:
+        i0 = int(xaxis.index(x))
+    else:
+#        lons=np.fabs(lon_grid-x)
+        lons=np.fabs(mdist(lon_grid,x))
+        lonm=np.where(lons==lons.min())
+        i0=lonm[0][0]
+    if yaxis is not None:
+        j0 = int(yaxis.index(y))
+    else:
+        lats=np.fabs(lat_grid-y)
+        latm=np.where(lats==lats.min())
+        j0=latm[0][0]
     print(" wanted: %f %f" % (x,y))
     print(" got:    %f %f" % (lon_grid[i0] , lat_grid[j0]))
     good = False
@@ -517,6 +830,14 @@ def get_indices2D(lon_grid, lat_grid, x, y):
 #got:     43.9958333333 36.0041666667
 #15120 26879
 
+def plane_residual_std(xs, ys, zs, xm, ym, zm, alphd, betad, denom, rf, max_elements=2**22, backend=None):
+    """Returns the standard deviation of denom*D in each coarse cell where D is the
+    vertical distance of the points (xs,ys,zs) of the finest mesh from the
+    least-square plane of the cell.  See kernels.plane_residual_std().
+    """
+    return kernels.plane_residual_std(xs, ys, zs, xm, ym, zm, alphd, betad, denom, rf,
+            max_elements=max_elements, backend=backend)
+
 def refine_by_repeat(x, rf):
     xrf=np.repeat(np.repeat(x[:,:],rf,axis=0),rf,axis=1) #refine by repeating values
     return xrf
@@ -527,122 +848,116 @@ def extend_by_zeros(x, shape):
     return ext
 
 # Copied with slight modifications
-def do_block(grd, part, lon, lat, topo_lons, topo_lats, topo_elvs, max_mb=500):
-    msg = ("Doing block number %d" % (part))
-    grd.printMsg(msg, level=logging.INFO)
-    msg = ("Target sub mesh shape: %s" % (str(lon.shape)))
-    grd.printMsg(msg, level=logging.INFO)
-
-    #target_mesh = GMesh.GMesh( lon=lon, lat=lat )
-    #target_mesh = GMesh.GMesh(lon=lon, lat=lat)
+def shift_source_longitudes(topo_lons, shift):
+    """Returns the 1D source longitudes topo_lons rotated to start at index shift.
+    Longitudes that move to the front are reduced by 360 so the result
+    is monotonic.  This is the same as np.roll(topo_lons, -shift) but
+    the data is not moved.  The source data is read through
+    read_source_window() with the same shift."""
+    lonDim = topo_lons.dims[0]
+    lons = np.asarray(topo_lons)
+    lons = np.concatenate((lons[shift:]-360., lons[:shift]))
+    return xr.DataArray(lons, dims=(lonDim,), coords={lonDim: lons}, attrs=topo_lons.attrs)
+
+def read_source_window(topo_elvs, tjs, tis, lon_shift=0):
+    """Returns the window topo_elvs[tjs,tis] where the i indices refer to the
+    longitudes returned by shift_source_longitudes() with shift lon_shift.  A
+    window that crosses the end of the source grid is read in two pieces."""
+    ni = topo_elvs.shape[-1]
+    i0, i1 = tis.start + lon_shift, tis.stop + lon_shift
+    if i0 >= ni:
+        i0, i1 = i0 - ni, i1 - ni
+    if i1 <= ni:
+        return topo_elvs[tjs,i0:i1]
+    return xr.concat([topo_elvs[tjs,i0:ni], topo_elvs[tjs,0:i1-ni]], dim=topo_elvs.dims[-1])
+
+def block_source_window(lon, lat, topo_lons, topo_lats):
+    """Returns the (j,i) slices of the source grid (topo_lons,topo_lats), with
+    1D coordinates, that cover the target block (lon,lat)."""
     target_mesh = meshrefinement.MeshRefinement(lon=lon, lat=lat)
-    #target_mesh.shape = lon.shape
-    #target_mesh.ni = target_mesh.shape[0]
-    #target_mesh.nj = target_mesh.shape[1]
-    #print("  D:target_mesh.shape", target_mesh.shape)
-    #pdb.set_trace()
-
-    #plot()
 
     # Indices in topographic data
-    ti,tj = target_mesh.find_nn_uniform_source(topo_lons, topo_lats)
+    ti,tj = target_mesh.find_nn_source(topo_lons, topo_lats)
 
     #Sample every other source points
     ##Niki: This is only for efficeincy and we want to remove the constraint for the final product.
     ##Niki: But in some cases it may not work!
     #tis,tjs = slice(ti.min(), ti.max()+1,2), slice(tj.min(), tj.max()+1,2)
     #tis,tjs = slice(ti.min(), ti.max()+1,1), slice(tj.min(), tj.max()+1,1)
-    tis,tjs = slice(ti.min().data.tolist(), ti.max().data.tolist()+1,1),\
-        slice(tj.min().data.tolist(), tj.max().data.tolist()+1,1)
-    #print('  Slices j,i:', tjs, tis )
-    msg = ('Topographic grid slice: %s %s' % (str(tjs), str(tis)))
-    grd.printMsg(msg, level=logging.INFO)
+    tis,tjs = slice(int(ti.min()), int(ti.max())+1,1),\
+        slice(int(tj.min()), int(tj.max())+1,1)
 
-    # Read elevation data
-    topo_elv = topo_elvs[tjs,tis]
-    # Extract appropriate coordinates
-    topo_lon = topo_lons[tis]
-    topo_lat = topo_lats[tjs]
+    return tjs, tis
 
-    msg = ('Topo shape: %s' % (str(topo_elv.shape)))
-    grd.printMsg(msg, level=logging.INFO)
-    #print('  topography longitude range:', topo_lon.min(), topo_lon.max())
-    #print('  topography latitude  range:', topo_lat.min(), topo_lat.max())
-    msg = ('Topography longitude range: %f %f' % (topo_lon.min(), topo_lon.max()))
-    grd.printMsg(msg, level=logging.INFO)
-    msg = ('Topography latitude  range: %f %f' % (topo_lat.min(), topo_lat.max()))
-    grd.printMsg(msg, level=logging.INFO)
+def refine_block(part, lon, lat, topo_lon, topo_lat, topo_elv, max_mb=500, predict_levels=False, min_max=True,
+        dtype=np.float64, backend=None):
+    """Computes the height, roughness, minimum and maximum of the source data
+    (topo_lon,topo_lat,topo_elv) for the target block (lon,lat).  The source data
+    should already be reduced to the window of the block.
 
-    #print("  Target     longitude range:", lon.min(), lon.max())
-    #print("  Target     latitude  range:", lat.min(), lat.max())
-    msg = ("Target     longitude range: %f %f" % (lon.min(), lon.max()))
-    grd.printMsg(msg, level=logging.INFO)
-    msg = ("Target     latitude  range: %f %f" % (lat.min(), lat.max()))
-    grd.printMsg(msg, level=logging.INFO)
+    This routine does not require a GridUtils object so it can be run in a
+    separate process.  Messages are returned in a list instead of being printed.
+    The minimum and maximum are None unless min_max is True.  The height,
+    minimum, maximum and plane fit moments are stored with the given dtype
+    during the refinements, see kernels.coarsen_2x2().  The numerical kernels
+    use the given backend, see kernels.check_backend().
+
+    :return: height, D_std, h_min, h_max, hits, messages
+    :rtype: tuple
+    """
+    msgs = []
+
+    target_mesh = meshrefinement.MeshRefinement(lon=lon, lat=lat)
+
+    msgs.append('Topo shape: %s' % (str(topo_elv.shape)))
+    msgs.append('Topography longitude range: %f %f' % (topo_lon.min(), topo_lon.max()))
+    msgs.append('Topography latitude  range: %f %f' % (topo_lat.min(), topo_lat.max()))
+    msgs.append("Target     longitude range: %f %f" % (lon.min(), lon.max()))
+    msgs.append("Target     latitude  range: %f %f" % (lat.min(), lat.max()))
 
     # Refine grid by 2 till all source points are hit
     msg = ("Refining the target to hit all source points ...")
-    grd.printMsg(msg, level=logging.INFO)
+    msgs.append(msg)
     #pdb.set_trace()
-    Glist = target_mesh.refine_loop(topo_lon, topo_lat, max_mb=max_mb);
-    hits = Glist[-1].source_hits(topo_lon, topo_lat)
-    msg = ("Non-hit ratio: %d%s%d" % (hits.size-hits.sum().astype(int)," / ",hits.size))
-    grd.printMsg(msg, level=logging.INFO)
+    Glist = target_mesh.refine_loop(topo_lon, topo_lat, max_mb=max_mb, predict_levels=predict_levels,
+            backend=backend);
+    hits = Glist[-1].source_hits(topo_lon, topo_lat, backend=backend)
+    msg = ("Non-hit ratio: %d%s%d" % (hits.size-np.count_nonzero(hits)," / ",hits.size))
+    msgs.append(msg)
 
     # Sample the topography on the refined grid
     msg = ("Sampling the source points on target mesh ...")
-    grd.printMsg(msg, level=logging.INFO)
-    Glist[-1].sample_source_data_on_target_mesh(topo_lon, topo_lat, topo_elv)
+    msgs.append(msg)
+    Glist.sample(topo_lon, topo_lat, topo_elv, dtype=dtype, backend=backend)
     msg = ("Sampling finished ...")
-    grd.printMsg(msg, level=logging.INFO)
+    msgs.append(msg)
 
     # Coarsen back to the original taget grid
     msg = ("Coarsening back to the original target grid ...")
-    grd.printMsg(msg, level=logging.INFO)
-    for i in reversed(range(1,len(Glist))):   # 1, makes it stop at element 1 rather than 0
-        Glist[i].coarsenby2(Glist[i-1])
+    msgs.append(msg)
+    Glist.coarsen(min_max=min_max, dtype=dtype, backend=backend)
 
     #pdb.set_trace()
 
     msg = ("Roughness calculation via plane fit")
-    grd.printMsg(msg, level=logging.INFO)
+    msgs.append(msg)
     #Roughness calculation by plane fitting
     #Calculate the slopes of the planes on the coarsest (model) grid cells
     G = Glist[0]
-    denom = (G.xxm-G.xm*G.xm)*(G.yym-G.ym*G.ym)-(G.xym-G.xm*G.ym)*(G.xym-G.xm*G.ym)
-    alphd = (G.xzm-G.xm*G.zm)*(G.yym-G.ym*G.ym)-(G.yzm-G.ym*G.zm)*(G.xym-G.xm*G.ym)
-    betad = (G.yzm-G.ym*G.zm)*(G.xxm-G.xm*G.xm)-(G.xzm-G.xm*G.zm)*(G.xym-G.xm*G.ym)
+    cxx, cyy, cxy, cxz, cyz = G.covariances()
+    denom = cxx*cyy-cxy*cxy
+    alphd = cxz*cyy-cyz*cxy
+    betad = cyz*cxx-cxz*cxy
     #alph = alphd/denom
     #beta = betad/denom
 
     rf = 2**(len(Glist)-1) #refinement factor
-    #Generate the refined arrays from coarse arrays by repeating the coarse elements rf times
-    #These arrays have the same values on finest mesh points inside each coarse cell by construction.
-    #They are being used to calculate the (least-square) distance of data points
-    #inside that cell from the fitted plane in that cell.
-    xmrf = refine_by_repeat(G.xm, rf)
-    ymrf = refine_by_repeat(G.ym, rf)
-    zmrf = refine_by_repeat(G.zm, rf)
-    alphdrf = refine_by_repeat(alphd, rf)
-    betadrf = refine_by_repeat(betad, rf)
-    denomrf = refine_by_repeat(denom, rf)
-    #The refined mesh has a shape of (2*nj-1,2*ni-1) rather than (2*nj,2*ni) and hence
-    #is missing the last row/column by construction!
-    #So, the finest mesh does not have (rf*nj,rf*ni) points but is smaller by ...
-    #Bring it to the same shape as (rf*nj,rf*ni) by padding with zeros.
-    #This is for algorithm convenience and we remove the contribution of them later.
-    xs = extend_by_zeros(Glist[-1].xm, zmrf.shape)
-    ys = extend_by_zeros(Glist[-1].ym, zmrf.shape)
-    zs = extend_by_zeros(Glist[-1].zm, zmrf.shape)
-    #Calculate the vertical distance D of each source point from the least-square plane
-    #Note that the least-square plane passes through the mean data point.
-    #The last rf rows and columns are for padding and denom is not zero on them.
-    #To avoid division by zero calculate denom*D instead
-    D_times_denom = denomrf*(zs-zmrf) - alphdrf*(xs-xmrf) - betadrf*(ys-ymrf)
-    #Calculate topography roughness as the standard deviation of D on each coarse (model) grid cell
-    #This is why we wanted to have a (nj*rf,ni*rf) shape arrays and padded with zeros above.
-    D_times_denom_coarse = np.reshape(D_times_denom,(G.xm.shape[0],rf,G.xm.shape[1],rf))
-    D_times_denom_coarse_std = D_times_denom_coarse.std(axis=(1,3))
+    #Calculate the vertical distance D of each source point on the finest mesh from the
+    #least-square plane in its coarse (model) grid cell.  The standard deviation of D is
+    #accumulated over strips of coarse rows so only a strip of the finest mesh is expanded
+    #at a time.  See plane_residual_std().
+    D_times_denom_coarse_std = plane_residual_std(Glist[-1].xm, Glist[-1].ym, Glist[-1].zm,
+            G.xm, G.ym, G.zm, alphd, betad, denom, rf, backend=backend)
     D_std = np.zeros(G.zm.shape)
     epsilon = 1.0e-20 #To avoid negative underflow
     D_std[:,:] = D_times_denom_coarse_std[:,:]/(denom[:,:]+epsilon)
@@ -655,7 +970,77 @@ def do_block(grd, part, lon, lat, topo_lons, topo_lats, topo_elvs, max_mb=500):
     #filename = 'topog_refsamp_BP.nc'+str(b)
     #write_topog(Glist[0].height,fnam=filename,no_changing_meta=True)
     #print("heights shape:", lons[b].shape,Hlist[b].shape)
-    return Glist[0].height, D_std, Glist[0].h_min, Glist[0].h_max, hits
+    return Glist[0].height, D_std, Glist[0].h_min, Glist[0].h_max, hits, msgs
+
+# Names of the block results in a checkpoint file, in the order returned by do_block()
+BLOCK_CHECKPOINT_VARIABLES = ['height', 'hstd', 'hmin', 'hmax', 'hits']
+
+def block_checkpoint_key(lon, lat, *options):
+    """Returns a sha256 hash of the target block coordinates (lon,lat) and
+    any options that change the result of the block."""
+    h = hashlib.sha256()
+    h.update(np.ascontiguousarray(lon, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(lat, dtype=np.float64).tobytes())
+    h.update(repr(options).encode('utf-8'))
+    return h.hexdigest()
+
+def source_checkpoint_key(topo_lons, topo_lats, topo_elvs):
+    """Returns a sha256 hash identifying the data source of a block checkpoint:
+    its coordinates (topo_lons,topo_lats) and, if topo_elvs was read from a file
+    or url, the source name and, for a file, its size and modification time."""
+    h = hashlib.sha256()
+    h.update(np.ascontiguousarray(topo_lons, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(topo_lats, dtype=np.float64).tobytes())
+    source = getattr(topo_elvs, 'encoding', {}).get('source', None)
+    if source:
+        h.update(source.encode('utf-8'))
+        if os.path.isfile(source):
+            st = os.stat(source)
+            h.update(repr((st.st_size, st.st_mtime_ns)).encode('utf-8'))
+    return h.hexdigest()
+
+def save_block_checkpoint(fileName, height, hstd, hmin, hmax, hits):
+    """Writes the results of a block to fileName.  Results that are None are
+    not written.  The file is written under a temporary name and then renamed
+    so an interrupted write never leaves a partial checkpoint behind."""
+    results = dict(height=height, hstd=hstd, hmin=hmin, hmax=hmax, hits=np.asarray(hits).astype(bool))
+    results = {k: v for k, v in results.items() if v is not None}
+    tmpName = "%s.tmp%d" % (fileName, os.getpid())
+    with open(tmpName, 'wb') as f:
+        np.savez(f, **results)
+    os.replace(tmpName, fileName)
+
+def load_block_checkpoint(fileName, varName):
+    """Returns the variable varName of a block checkpoint written by save_block_checkpoint()
+    or None if it was not written."""
+    with np.load(fileName) as data:
+        if not(varName in data.files):
+            return None
+        return data[varName]
+
+def do_block(grd, part, lon, lat, topo_lons, topo_lats, topo_elvs, max_mb=500, lon_shift=0,
+        predict_levels=False, min_max=True, dtype=np.float64, backend=None):
+    msg = ("Doing block number %d" % (part))
+    grd.printMsg(msg, level=logging.INFO)
+    msg = ("Target sub mesh shape: %s" % (str(lon.shape)))
+    grd.printMsg(msg, level=logging.INFO)
+
+    tjs, tis = block_source_window(lon, lat, topo_lons, topo_lats)
+    msg = ('Topographic grid slice: %s %s' % (str(tjs), str(tis)))
+    grd.printMsg(msg, level=logging.INFO)
+
+    # Read elevation data
+    topo_elv = read_source_window(topo_elvs, tjs, tis, lon_shift=lon_shift)
+    # Extract appropriate coordinates
+    topo_lon = topo_lons[tis]
+    topo_lat = topo_lats[tjs]
+
+    h, hstd, hmin, hmax, hits, msgs = refine_block(part, lon, lat, topo_lon, topo_lat, topo_elv, max_mb=max_mb,
+            predict_levels=predict_levels, min_max=min_max, dtype=dtype, backend=backend)
+    for msg in msgs:
+        grd.printMsg(msg, level=logging.INFO)
+
+    return h, hstd, hmin, hmax, hits
 
 # Rebuilt from main() function
 def computeBathymetricRoughness(grd, dsName, **kwargs):
@@ -693,11 +1078,36 @@ def computeBathymetricRoughness(grd, dsName, **kwargs):
           For a regular grid, use the Q point values as the H values to fill missing points.
         * *useOverlap* (``boolean``) --
           Use overlapping grid technique to fill in partition boundaries.  The outer column and
-          row will still be missing.
+          row will still be missing.  Partition boundaries are now always filled;
+          this flag is required for **useQHGridShift**.
         * *extendedGrid* (``boolean``) --
           If True, the grid provided by this routine has been extended and should use the overlap
           technique on h-points only and not q-points which are then shifted back to h-points.
           See IMPLEMENTATION NOTES below. Default: False
+        * *xBlocks* (``int``) --
+          Number of blocks to partition the target grid into along the i-direction.
+          Default: determined from maxMb
+        * *yBlocks* (``int``) --
+          Number of blocks to partition the target grid into along the j-direction.
+          Default: determined from maxMb
+        * *nWorkers* (``int``) --
+          Number of processes used to compute the blocks.  Default: 1
+        * *executor* (``concurrent.futures.Executor``) --
+          Executor used to compute the blocks instead of creating a process pool.
+          Default: None
+        * *checkpointDir* (``string``) --
+          Directory to write the results of each block to.  See below.
+          Default: None
+        * *predictRefinement* (``boolean``) --
+          Predict the number of grid refinements needed from the grid cell size and
+          the spacing of the data source.  See below.  Default: False
+        * *singlePrecision* (``boolean``) --
+          Store the sampled and coarsened heights, minimum, maximum and plane fit moments in
+          single precision during refinements.  The moments are then central moments and the
+          mean positions are kept in double precision.  Default: False
+        * *kernelBackend* (``string``) --
+          Backend of the numerical kernels, 'numpy' or 'numba'.  See below.
+          Default: None
 
     This routine is based on a paper by Adcroft :cite:p:`Adcroft_2013` and python code from
     `OMtopogen/create_topog_refinedSampling.py` :cite:p:`Zadeh_2020_ocean_model_topog_generator`.
@@ -736,10 +1146,53 @@ def computeBathymetricRoughness(grd, dsName, **kwargs):
           tells this routine to use the supergrid when calculating
           the bathymetric roughness.  This will require more RAM. Default: False
 
+      :xBlocks, yBlocks:
+          The target grid is partitioned into blocks that are refined
+          independently.  By default, the number of blocks is chosen
+          so the finest refinement of each block fits within maxMb.  The
+          required refinement is estimated from the ratio of the largest
+          target cell to the spacing of the data source.
+
+      :nWorkers, executor:
+          Blocks are independent of each other and may be computed in parallel.
+          If nWorkers is larger than one, a process pool with nWorkers processes
+          is used.  The processes are spawned rather than forked.  Alternatively, an
+          existing executor may be provided.  Only the window of the data source
+          needed by a block is sent to a worker.  Each worker may use up to maxMb
+          of memory for refinements.
+
+      :checkpointDir:
+          If specified, the results of each block are written to this
+          directory as soon as the block is finished.  If the routine
+          is run again, blocks with an existing result are not computed
+          again.  Results are identified by a hash of the block coordinates,
+          data source and options that change the result.  The data source is
+          identified by its name, coordinates and, if it was read from a file,
+          the path, size and modification time of the file.  The directory
+          may be removed once the routine returns.
+
+      :predictRefinement:
+          By default, the grid is refined by two until a refinement does not hit
+          any more cells of the data source and hits are counted after every
+          refinement.  With predictRefinement, the grid is refined directly to the
+          level where the cell edges are no larger than the spacing of the data
+          source and hits are only counted once.  If not all cells are hit, the
+          refinement continues as usual.  All predicted refinement levels are
+          used to coarsen the data back to the grid.
+
+      :kernelBackend:
+          The refinement, nearest neighbor search, sampling, coarsening and plane fit
+          residual use compiled, parallel loops with 'numba' if numba is installed.
+          The results are the same as with 'numpy' to round off.  If None, the default
+          backend of :py:mod:`gridtools.kernels` is used, which can be set with the
+          environment variable GRIDTOOLS_KERNEL_BACKEND.  When blocks are computed by
+          several processes, limit the threads of each process with NUMBA_NUM_THREADS.
+
     IMPLEMENTATION NOTES:
-      * For the supergrid, four zero bands along longitude are returned
-        representing the four grid partitions.  This needs to be fixed
-        in the future.
+      * Neighboring blocks overlap by one point.  The last row and column
+        of each block is replaced by the first row and column of the
+        next block when the blocks are merged.  The last row and column
+        of the grid are still missing.
       * **useFixByOverlapQHGridShift** by default is True.  Roughness (h2) is
         diagnosed on the q-points and shifted by 1/2 a grid cell back to the
         h-points.  Accuracy of the roughness and other resultant variables are
@@ -785,6 +1238,35 @@ def computeBathymetricRoughness(grd, dsName, **kwargs):
         kwargs['extendedGrid'] = False
     extendedGrid = kwargs['extendedGrid']
 
+    if not('xBlocks' in kwargs.keys()):
+        kwargs['xBlocks'] = None
+
+    if not('yBlocks' in kwargs.keys()):
+        kwargs['yBlocks'] = None
+
+    if not('predictRefinement' in kwargs.keys()):
+        kwargs['predictRefinement'] = False
+
+    if not('singlePrecision' in kwargs.keys()):
+        kwargs['singlePrecision'] = False
+
+    if not('kernelBackend' in kwargs.keys()):
+        kwargs['kernelBackend'] = None
+
+    if not('checkpointDir' in kwargs.keys()):
+        kwargs['checkpointDir'] = None
+
+    if not('nWorkers' in kwargs.keys()):
+        kwargs['nWorkers'] = 1
+
+    if not('executor' in kwargs.keys()):
+        kwargs['executor'] = None
+
+    # Blocks always overlap by one point so the last row and column of
+    # each block, which can not be computed, is replaced by the first
+    # row and column of the next block.
+    blockHalo = 1
+
     # useFixByOverlapQHGridShift = True implies superGrid = False
     # this method uses q-points and shifts back to h-points.
     #useOverlap = False
@@ -901,14 +1383,16 @@ def computeBathymetricRoughness(grd, dsName, **kwargs):
     #   meridian) or 180 latitude (dateline)
     # Translate topo data to start at target_mesh.lon_m[0]
     # Why/When? TODO: Investigate get_indices1D() function
+    # The data is not moved.  The longitudes are renamed, (0,60) as (-300,-180), and
+    # the windows of data read for each block are remapped by lonShift.
     jllc, illc, status1 = get_indices1D(topo_lons, topo_lats ,target_lon[0,0] ,target_lat[0,0])
     jurc, iurc, status2 = get_indices1D(topo_lons, topo_lats ,target_lon[0,-1],target_lat[-1,0])
+    lonShift = 0
     if(not status1 or not status2):
         msg = ('Shifting topo data to start at target lon.')
         grd.printMsg(msg, level=logging.INFO)
-        topo_lons = np.roll(topo_lons,-illc,axis=0) #Roll data longitude to right
-        topo_lons = np.where(topo_lons>=topo_lons[0] , topo_lons-360, topo_lons) #Rename (0,60) as (-300,-180)
-        topo_elvs = np.roll(topo_elvs,-illc,axis=1) #Roll data depth to the right by the same amount.
+        lonShift = int(illc)
+        topo_lons = shift_source_longitudes(topo_lons, lonShift)
 
     # TODO: This section needs to be reworked
     msg = ('Topography grid array shapes: lon:%s lat:%s' % (str(topo_lons.shape),str(topo_lats.shape)))
@@ -937,40 +1421,121 @@ def computeBathymetricRoughness(grd, dsName, **kwargs):
     msg = ("Flag extendedGrid   : %s" % (extendedGrid))
     grd.printMsg(msg, level=logging.INFO)
 
-    # Rework partitioning (dask opportunity)
-    # Niki: Why 4,1 partition?
-    xb = 4
-    yb = 1
-    lons = break_array_to_blocks(target_lon, xb, yb, useOverlap=useOverlap, useSupergrid=useSupergrid)
-    lats = break_array_to_blocks(target_lat, xb, yb, useOverlap=useOverlap, useSupergrid=useSupergrid)
+    # Partition the target grid so the refinement of each block stays within
+    # the memory limit.  The number of blocks in either direction may be
+    # specified with xBlocks and yBlocks.
+    rf = estimate_refinement_factor(target_lon, target_lat, topo_lons, topo_lats)
+    yb, xb = plan_blocks(target_lon.shape, max_mb=max_mb, refine_factor=rf, halo=blockHalo)
+    if kwargs['xBlocks']:
+        xb = kwargs['xBlocks']
+    if kwargs['yBlocks']:
+        yb = kwargs['yBlocks']
+    msg = ("Estimated refinement factor: %d" % (rf))
+    grd.printMsg(msg, level=logging.INFO)
+    msg = ("Partitioning target mesh into %d x %d (j x i) blocks." % (yb, xb))
+    grd.printMsg(msg, level=logging.INFO)
+
+    lons = break_array_to_blocks(target_lon, xb, yb, useOverlap=useOverlap, useSupergrid=useSupergrid, halo=blockHalo)
+    lats = break_array_to_blocks(target_lat, xb, yb, useOverlap=useOverlap, useSupergrid=useSupergrid, halo=blockHalo)
 
-    # We must loop over the 4 partitions
+    # We must loop over all the partitions
     # TODO: The number of points being collected and the number of hits algorithm does not
     # compute things correctly due to issues with different bounding boxes.  This issue
     # should be addressed with previous section.
-    Hlist=[]
-    Hstdlist=[]
-    Hminlist=[]
-    Hmaxlist=[]
-    for part in range(0,xb):
-        lon = lons[part]
-        lat = lats[part]
-        h, hstd, hmin, hmax, hits = do_block(grd, part, lon, lat, topo_lons, topo_lats, topo_elvs, max_mb=max_mb)
-        Hlist.append(h)
-        Hstdlist.append(hstd)
-        Hminlist.append(hmin)
-        Hmaxlist.append(hmax)
+    # Results of each block are kept in memory or, with a checkpointDir,
+    # written to a file as soon as the block is finished.  Blocks with an
+    # existing checkpoint file are not computed again.
+    checkpointDir = kwargs['checkpointDir']
+    # The minimum and maximum are only calculated if requested
+    minMax = ('hMin' in kwargs['auxVariables']) or ('hMax' in kwargs['auxVariables'])
+    heightDtype = np.float32 if kwargs['singlePrecision'] else np.float64
+    # The backend is resolved here so worker processes use the same one
+    kernelBackend = kernels.check_backend(kwargs['kernelBackend'])
+    msg = ("Using the %s kernel backend" % (kernelBackend))
+    grd.printMsg(msg, level=logging.INFO)
+    if checkpointDir:
+        os.makedirs(checkpointDir, exist_ok=True)
+        sourceKey = source_checkpoint_key(topo_lons, topo_lats, topo_elvs)
+    blockResults = [None]*(xb*yb)
+    blocksToDo = []
+    for part in range(0,xb*yb):
+        if checkpointDir:
+            key = block_checkpoint_key(lons[part], lats[part], dsName, sourceKey, depthName, max_mb,
+                    lonShift, kwargs['open_channels'], kwargs['predictRefinement'], minMax, kwargs['singlePrecision'])
+            blockResults[part] = os.path.join(checkpointDir, 'roughness_block_%s.npz' % (key))
+            if os.path.isfile(blockResults[part]):
+                msg = ("Using checkpoint for block number %d: %s" % (part, blockResults[part]))
+                grd.printMsg(msg, level=logging.INFO)
+                continue
+        blocksToDo.append(part)
+
+    def keepBlock(part, result):
+        if checkpointDir:
+            save_block_checkpoint(blockResults[part], *result)
+        else:
+            blockResults[part] = result
+
+    executor = kwargs['executor']
+    if executor is None and kwargs['nWorkers'] > 1 and len(blocksToDo) > 0:
+        # Worker processes are spawned, not forked, as forking a process
+        # that has started the threads of the numba kernels can deadlock.
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=kwargs['nWorkers'],
+                mp_context=multiprocessing.get_context('spawn'))
+    if executor is None:
+        for part in blocksToDo:
+            lon = lons[part]
+            lat = lats[part]
+            keepBlock(part, do_block(grd, part, lon, lat, topo_lons, topo_lats, topo_elvs,
+                    max_mb=max_mb, lon_shift=lonShift, predict_levels=kwargs['predictRefinement'], min_max=minMax,
+                    dtype=heightDtype, backend=kernelBackend))
+    else:
+        # Only the window of the data source needed by each block is read
+        # and sent to the workers.
+        futures = {}
+        for part in blocksToDo:
+            lon = np.array(lons[part])
+            lat = np.array(lats[part])
+            tjs, tis = block_source_window(lon, lat, topo_lons, topo_lats)
+            msg = ("Submitting block number %d: target sub mesh shape: %s, topographic grid slice: %s %s" %\
+                    (part, str(lon.shape), str(tjs), str(tis)))
+            grd.printMsg(msg, level=logging.INFO)
+            window = [topo_lons[tis], topo_lats[tjs], read_source_window(topo_elvs, tjs, tis, lon_shift=lonShift)]
+            window = [w.load() if isinstance(w, xr.DataArray) else w for w in window]
+            futures[executor.submit(refine_block, part, lon, lat, *window, max_mb=max_mb,
+                predict_levels=kwargs['predictRefinement'], min_max=minMax, dtype=heightDtype,
+                backend=kernelBackend)] = part
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                part = futures[future]
+                h, hstd, hmin, hmax, hits, msgs = future.result()
+                msg = ("Finished block number %d" % (part))
+                grd.printMsg(msg, level=logging.INFO)
+                for msg in msgs:
+                    grd.printMsg(msg, level=logging.INFO)
+                keepBlock(part, (h, hstd, hmin, hmax, hits))
+        finally:
+            # Only shut down a pool created by this routine
+            if kwargs['executor'] is None:
+                executor.shutdown()
+
+    # Merge one variable at a time
+    def mergeBlocks(varIndex):
+        if checkpointDir:
+            varList = [load_block_checkpoint(f, BLOCK_CHECKPOINT_VARIABLES[varIndex]) for f in blockResults]
+        else:
+            varList = [r[varIndex] for r in blockResults]
+        return undo_break_array_to_blocks(varList, xb, yb, useOverlap=useOverlap,
+            extendedGrid=extendedGrid, useSupergrid=useSupergrid, useQHGridShift=useQHGridShift, halo=blockHalo)
 
     msg = ("Merging the blocks ...")
     grd.printMsg(msg, level=logging.INFO)
-    height_refsamp = undo_break_array_to_blocks(Hlist, xb, yb, useOverlap=useOverlap,
-            extendedGrid=extendedGrid, useSupergrid=useSupergrid, useQHGridShift=useQHGridShift)
-    hstd_refsamp = undo_break_array_to_blocks(Hstdlist, xb, yb, useOverlap=useOverlap,
-            extendedGrid=extendedGrid, useSupergrid=useSupergrid, useQHGridShift=useQHGridShift)
-    hmin_refsamp = undo_break_array_to_blocks(Hminlist, xb, yb, useOverlap=useOverlap,
-            extendedGrid=extendedGrid, useSupergrid=useSupergrid, useQHGridShift=useQHGridShift)
-    hmax_refsamp = undo_break_array_to_blocks(Hmaxlist, xb, yb, useOverlap=useOverlap,
-            extendedGrid=extendedGrid, useSupergrid=useSupergrid, useQHGridShift=useQHGridShift)
+    height_refsamp = mergeBlocks(0)
+    hstd_refsamp = mergeBlocks(1)
+    hmin_refsamp, hmax_refsamp = None, None
+    if minMax:
+        hmin_refsamp = mergeBlocks(2)
+        hmax_refsamp = mergeBlocks(3)
+
 
     #Niki: Why isn't h periodic in x?  I.e., height_refsamp[:,0] != height_refsamp[:,-1]
     # ANS?: The overlapping grid row was clipped?
@@ -998,48 +1563,48 @@ def computeBathymetricRoughness(grd, dsName, **kwargs):
     bathymetricRoughness[h2Name].attrs['units'] = 'meters^2'
     bathymetricRoughness[h2Name].attrs['standard_name'] =\
             'Subgrid scale topography height variance at Arakawa C %s-points' % (kwargs['gridPoint'])
-    bathymetricRoughness[h2Name].attrs['sha256'] = hashlib.sha256( np.array( hstd_refsamp * hstd_refsamp ) ).hexdigest()
+    utils.deferSha256sum(bathymetricRoughness[h2Name])
 
     if 'hStd' in kwargs['auxVariables']:
         bathymetricRoughness['hStd'] = (('ny','nx'), hstd_refsamp)
         bathymetricRoughness['hStd'].attrs['units'] = 'meters'
         bathymetricRoughness['hStd'].attrs['standard_name'] =\
                 'Subgrid scale topography height standard deviation at Arakawa C %s-points' % (kwargs['gridPoint'])
-        bathymetricRoughness['hStd'].attrs['sha256'] = hashlib.sha256( np.array( hstd_refsamp ) ).hexdigest()
+        utils.deferSha256sum(bathymetricRoughness['hStd'])
 
     if 'hMin' in kwargs['auxVariables']:
         bathymetricRoughness['hMin'] = (('ny','nx'), hmin_refsamp)
         bathymetricRoughness['hMin'].attrs['units'] = 'meters'
         bathymetricRoughness['hMin'].attrs['standard_name'] =\
                 'Subgrid scale topography height standard deviation minimum at Arakawa C %s-points' % (kwargs['gridPoint'])
-        bathymetricRoughness['hMin'].attrs['sha256'] = hashlib.sha256( np.array( hmin_refsamp ) ).hexdigest()
+        utils.deferSha256sum(bathymetricRoughness['hMin'])
 
     if 'hMax' in kwargs['auxVariables']:
         bathymetricRoughness['hMax'] = (('ny','nx'), hmax_refsamp)
         bathymetricRoughness['hMax'].attrs['units'] = 'meters'
         bathymetricRoughness['hMax'].attrs['standard_name'] =\
                 'Subgrid scale topography height standard deviation maximum at Arakawa C %s-points' % (kwargs['gridPoint'])
-        bathymetricRoughness['hMax'].attrs['sha256'] = hashlib.sha256( np.array( hmax_refsamp ) ).hexdigest()
+        utils.deferSha256sum(bathymetricRoughness['hMax'])
 
     if 'depth' in kwargs['auxVariables']:
         # Do not invert the value here, it is done later!
         bathymetricRoughness['depth'] = (('ny','nx'), height_refsamp)
         bathymetricRoughness['depth'].attrs['units'] = 'meters'
         bathymetricRoughness['depth'].attrs['standard_name'] = 'topographic depth at Arakawa C %s-points' % (kwargs['gridPoint'])
-        bathymetricRoughness['depth'].attrs['sha256'] = hashlib.sha256( np.array( height_refsamp ) ).hexdigest()
+        utils.deferSha256sum(bathymetricRoughness['depth'])
 
     try:
         # xarray=0.19.0 requires unpacking of Dataset variables by using .data
         bathymetricRoughness['x'] = (('ny','nx'), grid_lon.data)
         bathymetricRoughness['x'].attrs['units'] = 'degrees_east'
         bathymetricRoughness['x'].attrs['standard_name'] = 'longitude'
-        bathymetricRoughness['x'].attrs['sha256'] = hashlib.sha256( np.array( grid_lon ) ).hexdigest()
+        utils.deferSha256sum(bathymetricRoughness['x'])
 
         # xarray=0.19.0 requires unpacking of Dataset variables by using .data
         bathymetricRoughness['y'] = (('ny','nx'), grid_lat.data)
         bathymetricRoughness['y'].attrs['units'] = 'degrees_north'
         bathymetricRoughness['y'].attrs['standard_name'] = 'latitude'
-        bathymetricRoughness['y'].attrs['sha256'] = hashlib.sha256( np.array( grid_lat ) ).hexdigest()
+        utils.deferSha256sum(bathymetricRoughness['y'])
     except:
         #print('hstd:',hstd_refsamp.shape)
         #print('grid_lon:',grid_lon.shape)
@@ -1048,6 +1613,8 @@ def computeBathymetricRoughness(grd, dsName, **kwargs):
 
     # Add metadata to dataset
 
+    # Hash all variables at once
+    utils.updateSha256sums(bathymetricRoughness)
 
     # Return finished dataset
     return bathymetricRoughness
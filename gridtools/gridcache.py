@@ -0,0 +1,130 @@
+# On-disk cache of generated grids
+'''
+On-disk cache of grids created by :func:`gridtools.gridutils.GridUtils.makeGrid`.
+
+Entries are keyed by a sha256 hash of the canonical JSON form of the grid
+parameters and the library version.  Each entry is a directory with one
+``.npy`` file for each grid variable, which is loaded memory mapped, and a
+``grid.json`` file with the dimensions, attributes and final grid parameters.
+
+Entries are written to a temporary directory and renamed into place, and
+removed by renaming them out of the way first, so concurrent processes only
+ever see complete entries.  The least recently used entries are removed once
+the cache grows beyond its size limit.
+'''
+
+import os, json, shutil, hashlib
+import numpy as np
+import xarray as xr
+
+def cache_dir(cacheDir=None):
+    """Returns the grid cache directory: cacheDir or, if None, the ``grids``
+    subdirectory of the environment variable GRIDTOOLS_CACHE_DIR.  Returns
+    None if neither is defined."""
+    if cacheDir:
+        return cacheDir
+    if os.environ.get('GRIDTOOLS_CACHE_DIR', None):
+        return os.path.join(os.environ['GRIDTOOLS_CACHE_DIR'], 'grids')
+    return None
+
+def _json_default(obj):
+    """Converts numpy values, and anything else as a string, for json."""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    return str(obj)
+
+def grid_key(gridParameters, version):
+    """Returns a sha256 hash of the canonical JSON form of the grid
+    parameters and library version."""
+    text = json.dumps({'gridParameters': gridParameters, 'version': version},
+        sort_keys=True, separators=(',', ':'), default=_json_default)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def load_grid(cacheDir, key):
+    """Returns the grid and final grid parameters of the cache entry key, or
+    (None, None) if there is no such entry.  Grid variables are memory mapped
+    copy-on-write so they can be modified without changing the entry."""
+    entryDir = os.path.join(cacheDir, key)
+    try:
+        with open(os.path.join(entryDir, 'grid.json')) as f:
+            meta = json.load(f)
+        grid = xr.Dataset()
+        for varMeta in meta['variables']:
+            if 'value' in varMeta:
+                grid[varMeta['name']] = varMeta['value']
+            else:
+                data = np.load(os.path.join(entryDir, "%s.npy" % (varMeta['name'])), mmap_mode='c')
+                grid[varMeta['name']] = (tuple(varMeta['dims']), data)
+            grid[varMeta['name']].attrs.update(varMeta['attrs'])
+        grid.attrs.update(meta['attrs'])
+        # Mark the entry as recently used
+        os.utime(entryDir)
+    except (OSError, ValueError, KeyError):
+        return None, None
+
+    return grid, meta['gridParameters']
+
+def save_grid(cacheDir, key, grid, gridParameters, maxBytes):
+    """Saves the grid and final grid parameters as the cache entry key, then
+    removes least recently used entries until the cache holds at most
+    maxBytes.  Returns False if the entry could not be saved, which includes
+    another process saving the same entry first."""
+    entryDir = os.path.join(cacheDir, key)
+    if os.path.isdir(entryDir):
+        return False
+
+    os.makedirs(cacheDir, exist_ok=True)
+    tmpDir = "%s.tmp%d" % (entryDir, os.getpid())
+    try:
+        os.makedirs(tmpDir)
+        variables = list()
+        for (varName, xrVar) in grid.variables.items():
+            varMeta = {'name': varName, 'dims': list(xrVar.dims), 'attrs': dict(xrVar.attrs)}
+            if xrVar.dtype.kind in 'biufc':
+                np.save(os.path.join(tmpDir, "%s.npy" % (varName)), xrVar.values)
+            else:
+                varMeta['value'] = xrVar.values.tolist()
+            variables.append(varMeta)
+        meta = {'key': key, 'variables': variables, 'attrs': dict(grid.attrs), 'gridParameters': gridParameters}
+        with open(os.path.join(tmpDir, 'grid.json'), 'w') as f:
+            json.dump(meta, f, default=_json_default)
+        os.rename(tmpDir, entryDir)
+    except OSError:
+        shutil.rmtree(tmpDir, ignore_errors=True)
+        return False
+
+    evict(cacheDir, maxBytes, keep=key)
+
+    return True
+
+def evict(cacheDir, maxBytes, keep=None):
+    """Removes the least recently used entries of the cache until it holds
+    at most maxBytes.  The entry keep is not removed."""
+    entries = list()
+    for entryName in os.listdir(cacheDir):
+        entryDir = os.path.join(cacheDir, entryName)
+        # Skip temporary directories of entries being written or removed
+        if '.' in entryName or not(os.path.isdir(entryDir)):
+            continue
+        try:
+            entrySize = sum([os.path.getsize(os.path.join(entryDir, f)) for f in os.listdir(entryDir)])
+            entries.append((os.path.getmtime(entryDir), entrySize, entryName))
+        except OSError:
+            continue
+
+    totalSize = sum([entry[1] for entry in entries])
+    for (entryTime, entrySize, entryName) in sorted(entries):
+        if totalSize <= maxBytes:
+            break
+        if entryName == keep:
+            continue
+        # Rename first so readers never see a partially removed entry
+        delDir = os.path.join(cacheDir, "%s.del%d" % (entryName, os.getpid()))
+        try:
+            os.rename(os.path.join(cacheDir, entryName), delDir)
+        except OSError:
+            continue
+        shutil.rmtree(delDir, ignore_errors=True)
+        totalSize = totalSize - entrySize
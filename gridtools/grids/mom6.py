@@ -38,13 +38,13 @@ class MOM6(object):
             ds['x'] = (('nyp','nxp'), lonGrid)
             ds['x'].attrs['standard_name'] = 'geographic_longitude'
             ds['x'].attrs['units'] = 'degrees_east'
-            ds['x'].attrs['sha256'] = utils.sha256sum( lonGrid )
+            utils.deferSha256sum(ds['x'])
 
             latGrid = self.mom6_grid['supergrid']['lat']
             ds['y'] = (('nyp','nxp'), latGrid)
             ds['y'].attrs['standard_name'] = 'geographic_latitude'
             ds['y'].attrs['units'] = 'degrees_north'
-            ds['y'].attrs['sha256'] = utils.sha256sum( latGrid )
+            utils.deferSha256sum(ds['y'])
 
             ds.tile.attrs['geometry'] = "spherical"
         else:
@@ -52,32 +52,32 @@ class MOM6(object):
             ds['x'] = (('nyp','nxp'), xGrid)
             ds['x'].attrs['standard_name'] = 'geographic_longitude'
             ds['x'].attrs['units'] = 'meters'
-            ds['x'].attrs['sha256'] = utils.sha256sum( xGrid )
+            utils.deferSha256sum(ds['x'])
 
             yGrid = self.mom6_grid['supergrid']['y']
             ds['y'] = (('nyp','nxp'), yGrid)
             ds['y'].attrs['standard_name'] = 'geographic_latitude'
             ds['y'].attrs['units'] = 'meters'
-            ds['y'].attrs['sha256'] = utils.sha256sum( yGrid )
+            utils.deferSha256sum(ds['y'])
 
             ds.tile.attrs['geometry'] = "cartesian"
 
         # xarray=0.19.0 requires unpacking of Dataset variables by using .data
         ds['dx'] = (('nyp', 'nx'), self.mom6_grid['supergrid']['dx'].data)
         ds['dx'].attrs['units'] = 'meters'
-        ds['dx'].attrs['sha256'] = utils.sha256sum( self.mom6_grid['supergrid']['dx'] )
+        utils.deferSha256sum(ds['dx'])
         # xarray=0.19.0 requires unpacking of Dataset variables by using .data
         ds['dy'] = (('ny', 'nxp'), self.mom6_grid['supergrid']['dy'].data)
         ds['dy'].attrs['units'] = 'meters'
-        ds['dy'].attrs['sha256'] = utils.sha256sum( self.mom6_grid['supergrid']['dy'] )
+        utils.deferSha256sum(ds['dy'])
         # xarray=0.19.0 requires unpacking of Dataset variables by using .data
         ds['area'] = (('ny','nx'), self.mom6_grid['supergrid']['area'].data)
         ds['area'].attrs['units'] = 'meters^2'
-        ds['area'].attrs['sha256'] = utils.sha256sum( self.mom6_grid['supergrid']['area'] )
+        utils.deferSha256sum(ds['area'])
         # xarray=0.19.0 requires unpacking of Dataset variables by using .data
         ds['angle_dx'] = (('nyp','nxp'), self.mom6_grid['supergrid']['angle'].data)
         ds['angle_dx'].attrs['units'] = 'radians'
-        ds['angle_dx'].attrs['sha256'] = utils.sha256sum( self.mom6_grid['supergrid']['angle'] )
+        utils.deferSha256sum(ds['angle_dx'])
 
         self._add_global_attributes(ds)
 
@@ -271,7 +271,7 @@ class MOM6(object):
         ds['depth'] = (('ny', 'nx'), kwargs['topographyGrid'].data)
         ds['depth'].attrs['units'] = 'meters'
         ds['depth'].attrs['standard_name'] = 'topographic depth at Arakawa C h-points'
-        ds['depth'].attrs['sha256'] = utils.sha256sum( kwargs['topographyGrid'] )
+        utils.deferSha256sum(ds['depth'])
 
         #    # Variables & Values
         #    hdepth = topog_ds.createVariable('depth', 'f4', ('ny','nx',))
@@ -282,6 +282,7 @@ class MOM6(object):
         self._add_global_attributes(ds)
 
         # Perform write
+        utils.updateSha256sums(ds)
         ds.to_netcdf(destinationFile, encoding=grd.removeFillValueAttributes(data=ds))
 
         return
@@ -393,7 +394,7 @@ class MOM6(object):
         ds['mask'] = (('ny', 'nx'), landMask.data)
         ds['mask'].attrs['standard_name'] = 'land fraction at T-cell centers'
         ds['mask'].attrs['units'] = 'none'
-        ds['mask'].attrs['sha256'] = utils.sha256sum( ds['mask'] )
+        utils.deferSha256sum(ds['mask'])
 
         if 'supergrid' in self.mom6_grid:
             # xarray=0.19.0 requires unpacking of Dataset variables by using .data
@@ -401,7 +402,7 @@ class MOM6(object):
         else:
             # xarray=0.19.0 requires unpacking of Dataset variables by using .data
             ds['x'] = (('ny', 'nx'), grd.grid['x'][1::2,1::2].data)
-        ds['x'].attrs['sha256'] = utils.sha256sum( ds['x'] )
+        utils.deferSha256sum(ds['x'])
         ds['x'].attrs['standard_name'] = 'longitude'
         ds['x'].attrs['units'] = 'degrees_east'
         if 'supergrid' in self.mom6_grid:
@@ -410,13 +411,14 @@ class MOM6(object):
         else:
             # xarray=0.19.0 requires unpacking of Dataset variables by using .data
             ds['y'] = (('ny', 'nx'), grd.grid['y'][1::2,1::2].data)
-        ds['y'].attrs['sha256'] = utils.sha256sum( ds['y'] )
+        utils.deferSha256sum(ds['y'])
         ds['y'].attrs['standard_name'] = 'latitude'
         ds['y'].attrs['units'] = 'degrees_north'
 
         # Global attributes
         self._add_global_attributes(ds)
 
+        utils.updateSha256sums(ds)
         ds.to_netcdf(destinationFile, encoding=grd.removeFillValueAttributes(data=ds))
 
         return
@@ -457,7 +459,7 @@ class MOM6(object):
         ds['mask'] = (('ny', 'nx'), oceanMask.data)
         ds['mask'].attrs['standard_name'] = 'ocean fraction at T-cell centers'
         ds['mask'].attrs['units'] = 'none'
-        ds['mask'].attrs['sha256'] = utils.sha256sum( ds['mask'] )
+        utils.deferSha256sum(ds['mask'])
 
         if 'supergrid' in self.mom6_grid:
             # xarray=0.19.0 requires unpacking of Dataset variables by using .data
@@ -465,7 +467,7 @@ class MOM6(object):
         else:
             # xarray=0.19.0 requires unpacking of Dataset variables by using .data
             ds['x'] = (('ny', 'nx'), grd.grid['x'][1::2,1::2].data)
-        ds['x'].attrs['sha256'] = utils.sha256sum( ds['x'] )
+        utils.deferSha256sum(ds['x'])
         ds['x'].attrs['standard_name'] = 'longitude'
         ds['x'].attrs['units'] = 'degrees_east'
         if 'supergrid' in self.mom6_grid:
@@ -474,13 +476,14 @@ class MOM6(object):
         else:
             # xarray=0.19.0 requires unpacking of Dataset variables by using .data
             ds['y'] = (('ny', 'nx'), grd.grid['y'][1::2,1::2].data)
-        ds['y'].attrs['sha256'] = utils.sha256sum( ds['y'] )
+        utils.deferSha256sum(ds['y'])
         ds['y'].attrs['standard_name'] = 'latitude'
         ds['y'].attrs['units'] = 'degrees_north'
 
         # Global attributes
         self._add_global_attributes(ds)
 
+        utils.updateSha256sums(ds)
         ds.to_netcdf(destinationFile, encoding=grd.removeFillValueAttributes(data=ds))
 
         return
@@ -19,6 +19,7 @@ from matplotlib.backends.backend_agg import FigureCanvas
 #  * ROMS to MOM6 grid conversion
 #  * Computation of MOM6 grid metrics
 from . import spherical
+from . import gridcache
 
 # Other utilities
 from . import fileutils
@@ -44,6 +45,8 @@ class GridUtils(object):
         self.grid = self.xrDS
         # Native grid variable (ROMS, etc)
         self.nativeGrid = None
+        # Mesh of a grid that is written to disk in blocks of rows (see makeGrid)
+        self.gridMesh = None
         # Allow setting of chunk parameter for grids
         self.xrChunks = None
         # Internal parameters
@@ -475,6 +478,7 @@ class GridUtils(object):
         self.xrDS = xr.Dataset()
         self.grid = self.xrDS
         self.nativeGrid = None
+        self.gridMesh = None
         self.xrChunks = None
         self.gridInfo = dict()
         self.gridInfo['dimensions'] = dict()
@@ -547,48 +551,31 @@ class GridUtils(object):
         # R = self._default_Re # (GRS80 is the default for the proj python package)
         R = self.getRadius(self.gridInfo['gridParameters'])
 
-        # Make a copy of the lon grid as values are changed for computation
         # xarray=0.19.0 requires unpacking of Dataset variables by using .data
-        lon = self.grid.x.copy().data
-        lat = self.grid.y.copy().data
+        lon = self.grid.x.data
+        lat = self.grid.y.data
 
         # Approximate edge lengths as great arcs
-        self.grid['dx'] = (('nyp', 'nx'),  R * spherical.angle_through_center( (lat[ :,1:],lon[ :,1:]), (lat[:  ,:-1],lon[:  ,:-1]) ))
+        dx, dy, angle_dx, area = spherical.grid_metrics(lat, lon, R)
+        self.grid['dx'] = (('nyp', 'nx'), dx)
         self.grid['dx'].attrs['standard_name'] = 'grid_edge_x_distance'
         self.grid['dx'].attrs['units'] = 'meters'
-        self.grid['dx'].attrs['sha256'] = hashlib.sha256( np.array( self.grid['dx'] ) ).hexdigest()
-        self.grid['dy'] = (('ny' , 'nxp'), R * spherical.angle_through_center( (lat[1:, :],lon[1:, :]), (lat[:-1,:  ],lon[:-1,:  ]) ))
+        utils.deferSha256sum(self.grid['dx'])
+        self.grid['dy'] = (('ny' , 'nxp'), dy)
         self.grid['dy'].attrs['standard_name'] = 'grid_edge_y_distance'
         self.grid['dy'].attrs['units'] = 'meters'
-        self.grid['dy'].attrs['sha256'] = hashlib.sha256( np.array( self.grid['dy'] ) ).hexdigest()
-
-        # Scaling by latitude?
-        cos_lat = np.cos(np.radians(lat))
-
-        # Presize the angle_dx array
-        angle_dx = np.zeros(lat.shape)
-        angle2_dx = np.zeros(lat.shape)
-
-        # This was commented out in the original conversion code?
-        #angle_dx[:,1:-1] = np.arctan2( (lat[:,2:] - lat[:,:-2]) , ((lon[:,2:] - lon[:,:-2]) * cos_lat[:,1:-1]) )
-        #angle_dx[:, 0  ] = np.arctan2( (lat[:, 1] - lat[:, 0 ]) , ((lon[:, 1] - lon[:, 0 ]) * cos_lat[:, 0  ]) )
-        #angle_dx[:,-1  ] = np.arctan2( (lat[:,-1] - lat[:,-2 ]) , ((lon[:,-1] - lon[:,-2 ]) * cos_lat[:,-1  ]) )
-
-        # Fix lon so they are 0 to 360 for computation of angle_dx
-        lon = np.where(lon < 0., lon+360, lon)
-        angle2_dx[:,1:-1] = np.arctan2( (lat[:,2:] - lat[:,:-2]) , ((lon[:,2:] - lon[:,:-2]) * cos_lat[:,1:-1]) )
-        angle2_dx[:, 0  ] = np.arctan2( (lat[:, 1] - lat[:, 0 ]) , ((lon[:, 1] - lon[:, 0 ]) * cos_lat[:, 0  ]) )
-        angle2_dx[:,-1  ] = np.arctan2( (lat[:,-1] - lat[:,-2 ]) , ((lon[:,-1] - lon[:,-2 ]) * cos_lat[:,-1  ]) )
-        self.grid['angle_dx'] = (('nyp', 'nxp'), np.maximum(angle_dx, angle2_dx))
+        utils.deferSha256sum(self.grid['dy'])
+
+        self.grid['angle_dx'] = (('nyp', 'nxp'), angle_dx)
         #self.grid.angle_dx.attrs['standard_name'] = 'grid_vertex_x_angle_WRT_geographic_east'
         #self.grid.angle_dx.attrs['units'] = 'degrees_east'
         self.grid['angle_dx'].attrs['units'] = 'radians'
-        self.grid['angle_dx'].attrs['sha256'] = hashlib.sha256( np.array( angle_dx ) ).hexdigest()
+        utils.deferSha256sum(self.grid['angle_dx'])
 
-        self.grid['area'] = (('ny','nx'), R * R * spherical.quad_area(lat, lon))
+        self.grid['area'] = (('ny','nx'), area)
         self.grid['area'].attrs['standard_name'] = 'grid_cell_area'
         self.grid['area'].attrs['units'] = 'm2'
-        self.grid['area'].attrs['sha256'] = hashlib.sha256( np.array( self.grid['area'] ) ).hexdigest()
+        utils.deferSha256sum(self.grid['area'])
 
         return
 
@@ -646,12 +633,64 @@ class GridUtils(object):
 
         return dst
 
-    def makeGrid(self, setFilename=None):
-        '''Using supplied grid parameters, populate a grid in memory.'''
+    def makeGrid(self, setFilename=None, **kwargs):
+        '''Using supplied grid parameters, populate a grid in memory.
+
+        If *outputFile* is given, the grid is instead generated in blocks of rows
+        that are written directly to a netCDF file, so the full supergrid and its
+        metrics never have to be held in memory.  The file is then opened as the
+        current grid.
+
+        **Keyword arguments**:
+
+            * *outputFile* (``string``) -- write the grid to this netCDF file in
+              blocks of rows. Default: None (grid is created in memory)
+            * *blockRows* (``integer``) -- number of grid rows per block.
+              Default: determined from *maxMb*
+            * *maxMb* (``float``) -- approximate memory, in megabytes, used by
+              each block of rows. Default: 256
+            * *nWorkers* (``integer``) -- number of processes used to compute
+              blocks of rows.  The processes are spawned rather than forked.
+              Default: 1
+            * *useCache* (``boolean``) -- reuse a grid, including its metrics,
+              previously made with the same grid parameters and library version
+              from an on-disk cache, see :mod:`gridtools.gridcache`.  This is not
+              used with *outputFile*. Default: False
+            * *cacheDir* (``string``) -- grid cache directory.
+              Default: ``grids`` under the environment variable GRIDTOOLS_CACHE_DIR
+            * *cacheMaxMb* (``float``) -- size limit of the grid cache in megabytes.
+              Least recently used grids are removed beyond it. Default: 2048
+        '''
 
         # New grid created flag
         newGridCreated = False
 
+        # A grid written to disk in blocks only keeps the mesh axes in memory
+        outputFile = kwargs.get('outputFile', None)
+        deferMesh = outputFile is not None
+        self.gridMesh = None
+
+        # Reuse a grid made with the same parameters from the grid cache
+        gridCacheDir = None
+        if kwargs.get('useCache', False) and not(deferMesh):
+            gridCacheDir = gridcache.cache_dir(kwargs.get('cacheDir', None))
+            if gridCacheDir is None:
+                msg = "WARNING: Grid cache requires cacheDir or GRIDTOOLS_CACHE_DIR to be set."
+                self.printMsg(msg, level=logging.WARNING)
+        if gridCacheDir:
+            gridKey = gridcache.grid_key(self.gridInfo['gridParameters'], self.getVersion())
+            cachedGrid, cachedParameters = gridcache.load_grid(gridCacheDir, gridKey)
+            if cachedGrid is not None:
+                msg = "INFO: Using cached grid (%s)." % (gridKey[:12])
+                self.printMsg(msg, level=logging.INFO)
+                self.xrDS = cachedGrid
+                self.grid = self.xrDS
+                self.gridInfo['gridParameters'].update(cachedParameters)
+                self.xrOpen = True
+                if setFilename:
+                    self.xrFilename = setFilename
+                return
+
         # PRESCREEN PARAMETERS
 
         # Review grid type
@@ -791,23 +830,12 @@ class GridUtils(object):
                     gridType=gridType,
                     gridMode=gridMode,
                     ensureEvenI=ensureEvenI,
-                    ensureEvenJ=ensureEvenJ
+                    ensureEvenJ=ensureEvenJ,
+                    deferMesh=deferMesh
                 )
 
                 if hasattr(lonGrid, 'shape'):
-                    # Adjust lonGrid to -180 to +180
-                    lonGrid = np.where(lonGrid > 180.0, lonGrid - 360.0, lonGrid)
-
-                    (nxp, nyp) = lonGrid.shape
-
-                    self.grid['x'] = (('nyp','nxp'), lonGrid)
-                    self.grid['x'].attrs['standard_name'] = 'geographic_longitude'
-                    self.grid['x'].attrs['units'] = 'degrees_east'
-                    self.grid['x'].attrs['sha256'] = hashlib.sha256( np.array( lonGrid ) ).hexdigest()
-                    self.grid['y'] = (('nyp','nxp'), latGrid)
-                    self.grid['y'].attrs['standard_name'] = 'geographic_latitude'
-                    self.grid['y'].attrs['units'] = 'degrees_north'
-                    self.grid['y'].attrs['sha256'] = hashlib.sha256( np.array( latGrid ) ).hexdigest()
+                    self.setGridCoordinates(lonGrid, latGrid, deferMesh=deferMesh)
 
                     newGridCreated = True
 
@@ -838,23 +866,12 @@ class GridUtils(object):
                         gridType=gridType,
                         gridMode=gridMode,
                         ensureEvenI=ensureEvenI,
-                        ensureEvenJ=ensureEvenJ
+                        ensureEvenJ=ensureEvenJ,
+                        deferMesh=deferMesh
                     )
 
                     if hasattr(lonGrid, 'shape'):
-                        # Adjust lonGrid to -180 to +180
-                        lonGrid = np.where(lonGrid > 180.0, lonGrid - 360.0, lonGrid)
-
-                        (nxp, nyp) = lonGrid.shape
-
-                        self.grid['x'] = (('nyp','nxp'), lonGrid)
-                        self.grid.x.attrs['standard_name'] = 'geographic_longitude'
-                        self.grid.x.attrs['units'] = 'degrees_east'
-                        self.grid.x.attrs['sha256'] = hashlib.sha256( np.array( lonGrid ) ).hexdigest()
-                        self.grid['y'] = (('nyp','nxp'), latGrid)
-                        self.grid.y.attrs['standard_name'] = 'geographic_latitude'
-                        self.grid.y.attrs['units'] = 'degrees_north'
-                        self.grid.y.attrs['sha256'] = hashlib.sha256( np.array( latGrid ) ).hexdigest()
+                        self.setGridCoordinates(lonGrid, latGrid, deferMesh=deferMesh)
 
                         newGridCreated = True
                     
@@ -874,23 +891,12 @@ class GridUtils(object):
                         gridType=gridType,
                         gridMode=gridMode,
                         ensureEvenI=ensureEvenI,
-                        ensureEvenJ=ensureEvenJ
+                        ensureEvenJ=ensureEvenJ,
+                        deferMesh=deferMesh
                     )
 
                     if hasattr(lonGrid, 'shape'):
-                        # Adjust lonGrid to -180 to +180
-                        lonGrid = np.where(lonGrid > 180.0, lonGrid - 360.0, lonGrid)
-
-                        (nxp, nyp) = lonGrid.shape
-
-                        self.grid['x'] = (('nyp','nxp'), lonGrid)
-                        self.grid.x.attrs['standard_name'] = 'geographic_longitude'
-                        self.grid.x.attrs['units'] = 'degrees_east'
-                        self.grid.x.attrs['sha256'] = hashlib.sha256( np.array( lonGrid ) ).hexdigest()
-                        self.grid['y'] = (('nyp','nxp'), latGrid)
-                        self.grid.y.attrs['standard_name'] = 'geographic_latitude'
-                        self.grid.y.attrs['units'] = 'degrees_north'
-                        self.grid.y.attrs['sha256'] = hashlib.sha256( np.array( latGrid ) ).hexdigest()
+                        self.setGridCoordinates(lonGrid, latGrid, deferMesh=deferMesh)
 
                         newGridCreated = True
                     
@@ -901,21 +907,10 @@ class GridUtils(object):
                 self.gridInfo['gridParameters']['projection']['lon_0'], self.gridInfo['gridParameters']['dx'],
                 self.gridInfo['gridParameters']['projection']['lat_0'], self.gridInfo['gridParameters']['dy'],
                 tilt,
-                self.gridInfo['gridParameters']['gridResolution'], self.gridInfo['gridParameters']['gridMode']
+                self.gridInfo['gridParameters']['gridResolution'], self.gridInfo['gridParameters']['gridMode'],
+                deferMesh=deferMesh
             )
-            # Adjust lonGrid to -180 to +180
-            lonGrid = np.where(lonGrid > 180.0, lonGrid - 360.0, lonGrid)
-
-            (nxp, nyp) = lonGrid.shape
-
-            self.grid['x'] = (('nyp','nxp'), lonGrid)
-            self.grid.x.attrs['standard_name'] = 'geographic_longitude'
-            self.grid.x.attrs['units'] = 'degrees_east'
-            self.grid.x.attrs['sha256'] = hashlib.sha256( np.array( lonGrid ) ).hexdigest()
-            self.grid['y'] = (('nyp','nxp'), latGrid)
-            self.grid.y.attrs['standard_name'] = 'geographic_latitude'
-            self.grid.y.attrs['units'] = 'degrees_north'
-            self.grid.y.attrs['sha256'] = hashlib.sha256( np.array( latGrid ) ).hexdigest()
+            self.setGridCoordinates(lonGrid, latGrid, deferMesh=deferMesh)
 
             newGridCreated = True
 
@@ -931,21 +926,10 @@ class GridUtils(object):
                 self.gridInfo['gridParameters']['projection']['lon_0'], self.gridInfo['gridParameters']['dx'],
                 self.gridInfo['gridParameters']['projection']['lat_0'], self.gridInfo['gridParameters']['dy'],
                 tilt,
-                self.gridInfo['gridParameters']['gridResolution'], self.gridInfo['gridParameters']['gridMode']
+                self.gridInfo['gridParameters']['gridResolution'], self.gridInfo['gridParameters']['gridMode'],
+                deferMesh=deferMesh
             )
-            # Adjust lonGrid to -180 to +180
-            lonGrid = np.where(lonGrid > 180.0, lonGrid - 360.0, lonGrid)
-
-            (nxp, nyp) = lonGrid.shape
-
-            self.grid['x'] = (('nyp','nxp'), lonGrid)
-            self.grid.x.attrs['standard_name'] = 'geographic_longitude'
-            self.grid.x.attrs['units'] = 'degrees_east'
-            self.grid.x.attrs['sha256'] = hashlib.sha256( np.array( lonGrid ) ).hexdigest()
-            self.grid['y'] = (('nyp','nxp'), latGrid)
-            self.grid.y.attrs['standard_name'] = 'geographic_latitude'
-            self.grid.y.attrs['units'] = 'degrees_north'
-            self.grid.y.attrs['sha256'] = hashlib.sha256( np.array( latGrid ) ).hexdigest()
+            self.setGridCoordinates(lonGrid, latGrid, deferMesh=deferMesh)
 
             newGridCreated = True
 
@@ -991,22 +975,11 @@ class GridUtils(object):
                         gridType=gridType,
                         gridMode=gridMode,
                         ensureEvenI=ensureEvenI,
-                        ensureEvenJ=ensureEvenJ
+                        ensureEvenJ=ensureEvenJ,
+                        deferMesh=deferMesh
                     )
             
-            # Adjust lonGrid to -180 to +180
-            lonGrid = np.where(lonGrid > 180.0, lonGrid - 360.0, lonGrid)
-
-            (nxp, nyp) = lonGrid.shape
-
-            self.grid['x'] = (('nyp','nxp'), lonGrid)
-            self.grid.x.attrs['standard_name'] = 'geographic_longitude'
-            self.grid.x.attrs['units'] = 'degrees_east'
-            self.grid.x.attrs['sha256'] = hashlib.sha256( np.array( lonGrid ) ).hexdigest()
-            self.grid['y'] = (('nyp','nxp'), latGrid)
-            self.grid.y.attrs['standard_name'] = 'geographic_latitude'
-            self.grid.y.attrs['units'] = 'degrees_north'
-            self.grid.y.attrs['sha256'] = hashlib.sha256( np.array( latGrid ) ).hexdigest()
+            self.setGridCoordinates(lonGrid, latGrid, deferMesh=deferMesh)
 
             # This technique seems to return a Lambert Conformal Projection with the following properties
             # This only works if the grid does not overlap a polar point
@@ -1044,12 +1017,21 @@ class GridUtils(object):
             self.xrOpen = True
 
             # Compute grid metrics
-            if gridType == 'MOM6':
+            if deferMesh:
+                self.writeGridBlocks(outputFile, gridType == 'MOM6' and gridMode == 2, **kwargs)
+            elif gridType == 'MOM6':
                 if gridMode == 2:
                     self.computeGridMetricsSpherical()
                 else:
                     msg = "NOTE: Grid metrics were not computed."
                     self.printMsg(msg, level=logging.INFO)
+
+            if gridCacheDir:
+                utils.updateSha256sums(self.grid)
+                if gridcache.save_grid(gridCacheDir, gridKey, self.grid, self.gridInfo['gridParameters'],
+                        kwargs.get('cacheMaxMb', 2048) * 2**20):
+                    msg = "INFO: Saved grid to the grid cache (%s)." % (gridKey[:12])
+                    self.printMsg(msg, level=logging.INFO)
         else:
             msg = "WARNING: Grid generation failed."
             self.printMsg(msg, level=logging.WARNING)
@@ -1057,7 +1039,127 @@ class GridUtils(object):
         # If the grid was just created, the user can provide using setFilename
         if setFilename:
             self.xrFilename = setFilename
+
+    def setGridCoordinates(self, lonGrid, latGrid, deferMesh=False):
+        '''Set the grid vertices (x,y) from a generated mesh.  Longitudes are
+        adjusted to -180 to +180.  If deferMesh is True, the mesh is kept in
+        `gridMesh` to be written in blocks of rows by :func:`writeGridBlocks`.'''
+
+        if isinstance(lonGrid, spherical.RotatedLatLonMesh):
+            self.gridMesh = lonGrid
+            return
+
+        # Adjust lonGrid to -180 to +180
+        lonGrid = np.where(lonGrid > 180.0, lonGrid - 360.0, lonGrid)
+
+        if deferMesh:
+            # Meshes from a projection transform are only available in memory
+            self.gridMesh = spherical.ArrayMesh(lonGrid, latGrid)
+            return
+
+        self.grid['x'] = (('nyp','nxp'), lonGrid)
+        self.grid['x'].attrs['standard_name'] = 'geographic_longitude'
+        self.grid['x'].attrs['units'] = 'degrees_east'
+        utils.deferSha256sum(self.grid['x'])
+        self.grid['y'] = (('nyp','nxp'), latGrid)
+        self.grid['y'].attrs['standard_name'] = 'geographic_latitude'
+        self.grid['y'].attrs['units'] = 'degrees_north'
+        utils.deferSha256sum(self.grid['y'])
                                 
+    def writeGridBlocks(self, filename, computeMetrics, **kwargs):
+        '''Write the mesh held in `gridMesh` to a netCDF file in blocks of rows
+        and, if computeMetrics is True, the MOM6 grid metrics: angle_dx, dx, dy
+        and area.  Each block is computed with a one row halo so the result
+        matches the grid computed in memory.  The file is written under a
+        temporary name and renamed once complete, then opened as the current
+        grid.  If writing fails, the temporary file is removed and the error is
+        raised.  See :func:`makeGrid` for keyword arguments.
+        '''
+        import netCDF4 as netCDF
+
+        mesh = self.gridMesh
+        (nyp, nxp) = mesh.shape
+
+        R = None
+        if computeMetrics:
+            self.updateGridMetadata()
+            R = self.getRadius(self.gridInfo['gridParameters'])
+
+        blockRows = kwargs.get('blockRows', None)
+        if blockRows is None:
+            # About 16 double precision arrays of a row are in use while a block is computed
+            maxMb = kwargs.get('maxMb', 256)
+            blockRows = int(maxMb * 2**20 / (16 * 8 * nxp))
+        blockRows = max(1, min(int(blockRows), nyp))
+        nWorkers = int(kwargs.get('nWorkers', 1))
+
+        gridVars = [
+            ('x', ('nyp','nxp'), {'standard_name': 'geographic_longitude', 'units': 'degrees_east'}),
+            ('y', ('nyp','nxp'), {'standard_name': 'geographic_latitude', 'units': 'degrees_north'}),
+        ]
+        if computeMetrics:
+            gridVars = gridVars + [
+                ('dx', ('nyp','nx'), {'standard_name': 'grid_edge_x_distance', 'units': 'meters'}),
+                ('dy', ('ny','nxp'), {'standard_name': 'grid_edge_y_distance', 'units': 'meters'}),
+                ('angle_dx', ('nyp','nxp'), {'units': 'radians'}),
+                ('area', ('ny','nx'), {'standard_name': 'grid_cell_area', 'units': 'm2'}),
+            ]
+
+        msg = "Writing grid (%d x %d) in blocks of %d rows to %s" % (nyp, nxp, blockRows, filename)
+        self.printMsg(msg, level=logging.INFO)
+
+        tmpName = "%s.tmp%d" % (filename, os.getpid())
+        ncFile = None
+        try:
+            ncFile = netCDF.Dataset(tmpName, 'w', format='NETCDF4')
+            dimSizes = {'nyp': nyp, 'nxp': nxp, 'nx': nxp-1, 'ny': nyp-1}
+            for dimName in ['nyp', 'nxp', 'nx', 'ny']:
+                if computeMetrics or dimName in ['nyp', 'nxp']:
+                    ncFile.createDimension(dimName, dimSizes[dimName])
+
+            ncVars = dict()
+            varHashes = dict()
+            for (varName, varDims, varAttrs) in gridVars:
+                chunks = (min(blockRows, dimSizes[varDims[0]]), dimSizes[varDims[1]])
+                ncVars[varName] = ncFile.createVariable(varName, 'f8', varDims, chunksizes=chunks)
+                ncVars[varName].setncatts(varAttrs)
+                varHashes[varName] = hashlib.sha256()
+                if varName == 'y':
+                    tile = ncFile.createVariable('tile', str)
+                    tile[0] = str(self.grid['tile'].values)
+
+            for (j0, j1, block) in spherical.grid_blocks(mesh, blockRows, R=R, workers=nWorkers):
+                for (varName, varDims, varAttrs) in gridVars:
+                    data = np.ascontiguousarray(block[varName])
+                    ncVars[varName][j0:j0+data.shape[0], :] = data
+                    varHashes[varName].update(data)
+
+            for (varName, varDims, varAttrs) in gridVars:
+                ncVars[varName].setncattr('sha256', varHashes[varName].hexdigest())
+            ncFile.setncatts(dict(self.grid.attrs))
+            ncFile.close()
+            os.replace(tmpName, filename)
+        except Exception:
+            msg = "Failed to write netCDF file to %s" % (filename)
+            self.printMsg(msg, level=logging.ERROR)
+            if ncFile is not None and ncFile.isopen():
+                ncFile.close()
+            if os.path.isfile(tmpName):
+                os.remove(tmpName)
+            # There is no grid to fall back on
+            self.gridMesh = None
+            self.xrOpen = False
+            raise
+
+        msg = "Successfully wrote netCDF file to %s" % (filename)
+        self.printMsg(msg, level=logging.INFO)
+
+        # The grid on disk becomes the current grid
+        self.gridMesh = None
+        self.xrDS = xr.open_dataset(filename)
+        self.grid = self.xrDS
+        self.xrFilename = filename
+
     # Original grid generation functions from Niki Zadeh
     # Replace above comment with attribution in each function to mark lineage
 
@@ -1091,18 +1193,15 @@ class GridUtils(object):
         zp= r31*x+r32*y+r33*z
         return xp,yp,zp
 
+    def rotation_matrix_u(self, ux, uy, uz, theta):
+        """Returns the matrix of a rotation by angle :math:`\\theta` around a general axis (ux,uy,uz)."""
+        x,y,z = self.rotate_u(np.eye(3)[0], np.eye(3)[1], np.eye(3)[2], ux, uy, uz, theta)
+        return np.array([x,y,z])
+
     def rotate_u_mesh(self, lam, phi, ux, uy, uz, theta):
-        #Bring the angle to be in [-pi,pi] so that atan2 would work
-        lam = np.where(lam>180,lam-360,lam)
-        #Change to Cartesian coord
-        x,y,z = self.pol2cart(lam,phi)
-        #Rotate
-        xp,yp,zp = self.rotate_u(x,y,z,ux,uy,uz,theta)
-        #Change back to polar coords using atan2, in [-pi,pi]
-        lamp,phip = self.cart2pol(xp,yp,zp)
-        #Bring the angle back to be in [0,2*pi]
-        lamp = np.where(lamp<0,lamp+360,lamp)
-        return lamp,phip
+        """Rotate the whole mesh on globe by angle theta around a general axis (ux,uy,uz)."""
+        """Returns the rotated mesh."""
+        return self.rotate_mesh(lam, phi, self.rotation_matrix_u(ux, uy, uz, theta))
 
     def generate_rotated_grid(self, lon0, lon_span, lat0, lat_span, tilt, refine):
         Ni = int(lon_span*refine)
@@ -1177,54 +1276,55 @@ class GridUtils(object):
         z   = np.sin(phi)
         return x,y,z
 
+    def rotation_matrix_x(self, theta):
+        """Returns the matrix of a rotation by angle theta around x axis, see rotate_x()."""
+        cost = np.cos(theta)
+        sint = np.sin(theta)
+        return np.array([[1., 0., 0.], [0., cost, -sint], [0., sint, cost]])
+
+    def rotation_matrix_y(self, theta):
+        """Returns the matrix of a rotation by angle theta around y axis, see rotate_y()."""
+        cost = np.cos(theta)
+        sint = np.sin(theta)
+        return np.array([[cost, 0., sint], [0., 1., 0.], [-sint, 0., cost]])
+
+    def rotation_matrix_z(self, theta):
+        """Returns the matrix of a rotation by angle theta around z axis, see rotate_z()."""
+        cost = np.cos(theta)
+        sint = np.sin(theta)
+        return np.array([[cost, -sint, 0.], [sint, cost, 0.], [0., 0., 1.]])
+
+    def rotation_matrix_regional(self, lon0, lat0, tilt):
+        """Returns the matrix of the rotations that take a mesh centered at (lon0,0) on the
+        equator to a mesh centered at (lon0,lat0) tilted by angle tilt (degrees)."""
+        R = self.rotation_matrix_z((90.-lon0)*self.PI_180)            #rotate around z to bring it centered at y axis
+        R = np.dot(self.rotation_matrix_y(tilt*self.PI_180), R)       #rotate around y axis to tilt it as desired
+        R = np.dot(self.rotation_matrix_x(lat0*self.PI_180), R)       #rotate around x to bring it centered at (lon0,lat0)
+        R = np.dot(self.rotation_matrix_z(-(90.-lon0)*self.PI_180), R) #rotate around z to bring it back
+        return R
+
+    def rotate_mesh(self, lam, phi, R):
+        """Rotate the whole mesh on globe by the rotation matrix R."""
+        """Returns the rotated mesh."""
+        return spherical.rotate_mesh(lam, phi, R)
+
     def rotate_z_mesh(self, lam, phi, theta):
         """Rotate the whole mesh on globe by angle theta around z axis (globe polar axis)."""
         """Returns the rotated mesh."""
-        #Bring the angle to be in [-pi,pi] so that atan2 would work
-        lam       = np.where(lam>180, lam-360, lam)
-        #Change to Cartesian coord
-        x,y,z     = self.pol2cart(lam, phi)
-        #Rotate
-        xp,yp,zp  = self.rotate_z(x, y, z, theta)
-        #Change back to polar coords using atan2, in [-pi,pi]
-        lamp,phip = self.cart2pol(xp, yp, zp)
-        #Bring the angle back to be in [0,2*pi]
-        lamp      = np.where(lamp<0, lamp+360, lamp)
-        return lamp,phip
+        return self.rotate_mesh(lam, phi, self.rotation_matrix_z(theta))
 
     def rotate_x_mesh(self, lam, phi, theta):
         """Rotate the whole mesh on globe by angle theta around x axis (passing through equator and prime meridian.)."""
         """Returns the rotated mesh."""
-        #Bring the angle to be in [-pi,pi] so that atan2 would work
-        lam       = np.where(lam>180, lam-360, lam)
-        #Change to Cartesian coord
-        x,y,z     = self.pol2cart(lam, phi)
-        #Rotate
-        xp,yp,zp  = self.rotate_x(x, y, z, theta)
-        #Change back to polar coords using atan2, in [-pi,pi]
-        lamp,phip = self.cart2pol(xp, yp, zp)
-        #Bring the angle back to be in [0,2*pi]
-        lamp      = np.where(lamp<0, lamp+360, lamp)
-        return lamp,phip
+        return self.rotate_mesh(lam, phi, self.rotation_matrix_x(theta))
 
     def rotate_y_mesh(self, lam, phi, theta):
         """Rotate the whole mesh on globe by angle theta around y axis (passing through equator and prime meridian+90.)."""
         """Returns the rotated mesh."""
-        #Bring the angle to be in [-pi,pi] so that atan2 would work
-        lam       = np.where(lam>180, lam-360, lam)
-        #Change to Cartesian coord
-        x,y,z     = self.pol2cart(lam, phi)
-        #Rotate
-        xp,yp,zp  = self.rotate_y(x, y, z, theta)
-        #Change back to polar coords using atan2, in [-pi,pi]
-        lamp,phip = self.cart2pol(xp, yp, zp)
-        #Bring the angle back to be in [0,2*pi]
-        lamp      = np.where(lamp<0, lamp+360, lamp)
-        return lamp,phip
+        return self.rotate_mesh(lam, phi, self.rotation_matrix_y(theta))
 
-    #def generate_latlon_mesh_centered(self, lni, lnj, llon0, llen_lon, llat0, llen_lat, ensure_nj_even=True):
-    def generate_latlon_mesh_centered(self, lni, lnj, llon0, llen_lon, llat0, llen_lat, **kwargs):
-        """Generate a regular lat-lon grid"""
+    def generate_latlon_axes_centered(self, lni, lnj, llon0, llen_lon, llat0, llen_lat, **kwargs):
+        """Generate the 1D longitude and latitude axes of a regular lat-lon grid"""
         ensure_ni_even = True
         ensure_nj_even = True
         if 'ensureEvenI' in kwargs.keys():
@@ -1244,12 +1344,18 @@ class GridUtils(object):
             msg = "   The number of j's is not even. Fixing this by cutting one row at south."
             self.printMsg(msg, level=logging.INFO)
             llatSP = np.delete(llatSP, 0, 0)
-        llamSP = np.tile(llonSP,(llatSP.shape[0], 1))
-        lphiSP = np.tile(llatSP.reshape((llatSP.shape[0], 1)), (1, llonSP.shape[0]))
-        msg = '   Generated regular lat-lon grid between latitudes %.2f %.2f' % (lphiSP[0,0], lphiSP[-1,0])
+        msg = '   Generated regular lat-lon grid between latitudes %.2f %.2f' % (llatSP[0], llatSP[-1])
         self.printMsg(msg, level=logging.INFO)
-        msg = '   Number of js=%d' % (lphiSP.shape[0])
+        msg = '   Number of js=%d' % (llatSP.shape[0])
         self.printMsg(msg, level=logging.INFO)
+        return llonSP,llatSP
+
+    #def generate_latlon_mesh_centered(self, lni, lnj, llon0, llen_lon, llat0, llen_lat, ensure_nj_even=True):
+    def generate_latlon_mesh_centered(self, lni, lnj, llon0, llen_lon, llat0, llen_lat, **kwargs):
+        """Generate a regular lat-lon grid"""
+        llonSP,llatSP = self.generate_latlon_axes_centered(lni, lnj, llon0, llen_lon, llat0, llen_lat, **kwargs)
+        llamSP = np.tile(llonSP,(llatSP.shape[0], 1))
+        lphiSP = np.tile(llatSP.reshape((llatSP.shape[0], 1)), (1, llonSP.shape[0]))
         #h_i_inv=llen_lon*self.PI_180*np.cos(lphiSP*self.PI_180)/lni
         #h_j_inv=llen_lat*self.PI_180*np.ones(lphiSP.shape)/lnj
         #delsin_j = np.roll(np.sin(lphiSP*self.PI_180),shift=-1,axis=0) - np.sin(lphiSP*self.PI_180)
@@ -1258,8 +1364,10 @@ class GridUtils(object):
         #area=delsin_j[:-1,:-1]*self._default_Re*self._default_Re*llen_lon*self.self.PI_180/lni
         return llamSP,lphiSP
 
-    def generate_regional_spherical(self, lon0, lon_span, lat0, lat_span, tilt, gRes, gMode):
-        """Generate a regional grid centered at (lon0,lat0) with spans of (lon_span,lat_span) and tilted by angle tilt"""
+    def generate_regional_spherical(self, lon0, lon_span, lat0, lat_span, tilt, gRes, gMode, **kwargs):
+        """Generate a regional grid centered at (lon0,lat0) with spans of (lon_span,lat_span) and tilted by angle tilt.
+        If the keyword argument deferMesh is True, the rotated mesh is returned as a
+        :class:`gridtools.spherical.RotatedLatLonMesh` (and None) that generates rows on demand."""
         
         Ni = int(lon_span / gRes)
         Nj = int(lat_span / gRes)
@@ -1268,12 +1376,15 @@ class GridUtils(object):
             Ni = Ni * 2
             Nj = Nj * 2
 
+        R = self.rotation_matrix_regional(lon0, lat0, tilt)
+        if kwargs.get('deferMesh', False):
+            lon_,lat_ = self.generate_latlon_axes_centered(Ni, Nj, lon0, lon_span, 0.0, lat_span)
+            return spherical.RotatedLatLonMesh(lon_, lat_, R), None
+
         # Generate a mesh at equator centered at (lon0, 0)
         lam_,phi_ = self.generate_latlon_mesh_centered(Ni, Nj, lon0, lon_span, 0.0, lat_span)
-        lam_,phi_ = self.rotate_z_mesh(lam_,phi_, (90.-lon0)*self.PI_180)   #rotate around z to bring it centered at y axis
-        lam_,phi_ = self.rotate_y_mesh(lam_,phi_, tilt*self.PI_180)         #rotate around y axis to tilt it as desired
-        lam_,phi_ = self.rotate_x_mesh(lam_,phi_, lat0*self.PI_180)         #rotate around x to bring it centered at (lon0,lat0)
-        lam_,phi_ = self.rotate_z_mesh(lam_,phi_, -(90.-lon0)*self.PI_180)  #rotate around z to bring it back
+        #Rotate it to be centered at (lon0,lat0) and tilted in a single pass
+        lam_,phi_ = self.rotate_mesh(lam_,phi_, R)
 
         return lam_,phi_
 
@@ -1310,10 +1421,14 @@ class GridUtils(object):
 
             # Generate a mesh centered at (lon0, lat0) -> (cX, cY)
             #lam_,phi_ = self.generate_latlon_mesh_centered(Ni, Nj, lon0, lon_span, lat0, lat_span)
-            lam_,phi_  = self.generate_latlon_mesh_centered(Ni, Nj, cX, dx, cY, dy, ensureEvenI=ensureEvenI, ensureEvenJ=ensureEvenJ)
             ux, uy, uz = self.pol2cart(cX, cY)
-            # Rotate mesh around u by theta
-            lam_,phi_  = self.rotate_u_mesh(lam_, phi_, ux, uy, uz, tilt*self.PI_180)
+            if kwargs.get('deferMesh', False):
+                lon_,lat_ = self.generate_latlon_axes_centered(Ni, Nj, cX, dx, cY, dy, ensureEvenI=ensureEvenI, ensureEvenJ=ensureEvenJ)
+                lam_ = spherical.RotatedLatLonMesh(lon_, lat_, self.rotation_matrix_u(ux, uy, uz, tilt*self.PI_180))
+            else:
+                lam_,phi_  = self.generate_latlon_mesh_centered(Ni, Nj, cX, dx, cY, dy, ensureEvenI=ensureEvenI, ensureEvenJ=ensureEvenJ)
+                # Rotate mesh around u by theta
+                lam_,phi_  = self.rotate_u_mesh(lam_, phi_, ux, uy, uz, tilt*self.PI_180)
 
         if not(hasattr(lam_, 'shape')):
             msg = 'ERROR: Failed to create mercator grid!'
@@ -1425,12 +1540,15 @@ class GridUtils(object):
                 Ni = Ni * 2
                 Nj = Nj * 2
                 
+            R = self.rotation_matrix_regional(cX, cY, tilt)
+            if kwargs.get('deferMesh', False):
+                lon_,lat_ = self.generate_latlon_axes_centered(Ni, Nj, cX, dx, 0.0, dy)
+                return spherical.RotatedLatLonMesh(lon_, lat_, R), None
+
             # Generate a mesh at equator centered at (lon0, 0)
             lam_,phi_ = self.generate_latlon_mesh_centered(Ni, Nj, cX, dx, 0.0, dy)
-            lam_,phi_ = self.rotate_z_mesh(lam_, phi_, (90.-cX)*self.PI_180)   #rotate around z to bring it centered at y axis
-            lam_,phi_ = self.rotate_y_mesh(lam_, phi_, tilt*self.PI_180)       #rotate around y axis to tilt it as desired
-            lam_,phi_ = self.rotate_x_mesh(lam_, phi_, cY*self.PI_180)         #rotate around x to bring it centered at (lon0,lat0)
-            lam_,phi_ = self.rotate_z_mesh(lam_, phi_, -(90.-cX)*self.PI_180)  #rotate around z to bring it back
+            #Rotate it to be centered at (lon0,lat0) and tilted in a single pass
+            lam_,phi_ = self.rotate_mesh(lam_, phi_, R)
         
         return lam_,phi_
 
@@ -1811,13 +1929,16 @@ class GridUtils(object):
 
         # Generic longitude check
         if self.grid['x'].attrs['units'] == 'degrees_east':
-            self.grid['x'].values = np.where(self.grid['x'].values>180, self.grid['x'].values-360, self.grid['x'].values)
+            if (self.grid['x'].values > 180).any():
+                self.grid['x'].values = np.where(self.grid['x'].values>180, self.grid['x'].values-360, self.grid['x'].values)
+                utils.deferSha256sum(self.grid['x'])
 
         #Duplicate
         #self.grid.to_netcdf(self.xrFilename, encoding=self.removeFillValueAttributes())
 
         # Save the grid here
         try:
+            utils.updateSha256sums(self.grid)
             gridEncoding = self.removeFillValueAttributes()
             if enc:
                 for vrb in ['x', 'y', 'dx', 'dy', 'angle_dx', 'area']:
@@ -3213,12 +3334,12 @@ class GridUtils(object):
         if len(hashVariables) > 0:
             for hVar in hashVariables:
                 if hVar in dsData or hVar in dsData.coords:
-                    dsData[hVar].attrs['sha256'] = utils.sha256sum(dsData[hVar])
+                    utils.deferSha256sum(dsData[hVar])
             # Edge case where dsData is only one variable
             if not(hasattr(dsData, 'variables')):
                 if hasattr(dsData, 'name'):
                     if dsData.name in hashVariables:
-                        dsData.attrs['sha256'] = utils.sha256sum(dsData)
+                        utils.deferSha256sum(dsData)
 
         if os.path.isfile(urlToOpen) and not(overwrite):
             msg = ("WARNING: Use overwrite=True to overwrite existing file (%s)." % (urlToOpen))
@@ -3226,6 +3347,7 @@ class GridUtils(object):
             return
 
         try:
+            utils.updateSha256sums(dsData)
             dsData.to_netcdf(urlToOpen, encoding=self.removeFillValueAttributes(data=dsData))
             msg = ("INFO: Successfully wrote to file (%s)." % (urlToOpen))
             self.printMsg(msg, level=logging.INFO)
@@ -3316,6 +3438,15 @@ class GridUtils(object):
         # Add history metadata
         return ice9Grids
 
+    def ice9Sweep(self, **kwargs):
+        '''This calls the ice-9 algorithm from bathyutils for several masking depths.
+        See: :func:`gridtools.bathyutils.ice9Sweep()`'''
+        from . import bathyutils
+        ice9Sweep = bathyutils.ice9Sweep(self, **kwargs)
+
+        # Add history metadata
+        return ice9Sweep
+
     # meshutils routines
 
     def generateGridByRefinement(self, dsName, **kwargs):
@@ -3341,7 +3472,8 @@ class GridUtils(object):
         topoVarName = "elevation", coarsenInt = 10, method = 'conservative',
         superGrid = True, periodic = True, gridDimX = None, gridDimY = None,
         gridLatName = None, gridLonName = None, topoDimX = None, topoDimY = None,
-        topoLatName = None, topoLonName = None, convert_to_depth = True):
+        topoLatName = None, topoLonName = None, convert_to_depth = True,
+        weightsCacheDir = None):
         '''Generate a bathymetry and ocean mask for a given data source
         topography or bathymetry.  See :func:`gridtools.topoutils.TopoUtils.regridTopo`.
         '''
@@ -3355,4 +3487,5 @@ class GridUtils(object):
             gridLatName = gridLatName, gridLonName = gridLonName,\
             topoDimX = topoDimX, topoDimY = topoDimY,\
             topoLatName = topoLatName, topoLonName = topoLonName,\
-            convert_to_depth = convert_to_depth)
+            convert_to_depth = convert_to_depth,\
+            weightsCacheDir = weightsCacheDir)
@@ -0,0 +1,453 @@
+'''
+Numerical kernels for grid refinement.  Each kernel has a numpy
+implementation and, if numba is installed, a compiled implementation
+that produces the same results to round off.
+
+The backend is chosen with the backend argument of each kernel.  If it
+is None, the default backend is used.  The default is 'numpy' unless the
+environment variable GRIDTOOLS_KERNEL_BACKEND is set, and can be changed
+with set_backend().  The numba kernels run in parallel with the number of
+threads set by numba, see NUMBA_NUM_THREADS.
+'''
+
+import os
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+_default_backend = os.environ.get('GRIDTOOLS_KERNEL_BACKEND', 'numpy')
+
+def numba_available():
+    '''Returns True if numba is installed.'''
+    return numba is not None
+
+def check_backend(backend=None):
+    '''Returns the backend to use for a kernel.  If backend is None the default
+    backend is used.  The numba backend falls back to numpy if numba is not
+    installed.'''
+    if backend is None:
+        backend = _default_backend
+    if not(backend in ['numpy', 'numba']):
+        raise Exception("Unknown kernel backend: %s" % (backend))
+    if backend == 'numba' and numba is None:
+        return 'numpy'
+    return backend
+
+def set_backend(backend):
+    '''Sets the default backend, 'numpy' or 'numba', and returns the previous one.
+    The default is per process so worker processes started with spawn use
+    GRIDTOOLS_KERNEL_BACKEND unless the backend is passed to them.'''
+    global _default_backend
+    check_backend(backend)
+    previous, _default_backend = _default_backend, backend
+    return previous
+
+def get_backend():
+    '''Returns the backend used when the backend of a kernel is None.'''
+    return check_backend(None)
+
+def refine_2x2(A, backend=None):
+    '''Returns the array with shape (2*nj-1,2*ni-1) linearly interpolated from A with
+    shape (nj,ni).  The nodes of A are shared, the other nodes are the mid-points of the
+    edges and cells of A.'''
+    if check_backend(backend) == 'numba':
+        A = np.ascontiguousarray(A, dtype=np.float64)
+        a = np.empty((2*A.shape[0]-1, 2*A.shape[1]-1))
+        _refine_2x2_numba(A, a)
+        return a
+    nj,ni = A.shape
+    a = np.zeros( (2*nj-1,2*ni-1) )
+    a[::2,::2] = A[:,:] # Shared nodes
+    a[::2,1::2] = 0.5 * ( A[:,:-1] + A[:,1:] ) # Mid-point along i-direction on original mesh
+    a[1::2,::2] = 0.5 * ( A[:-1,:] + A[1:,:] ) # Mid-point along j-direction on original mesh
+    a[1::2,1::2] = 0.25 * ( ( A[:-1,:-1] + A[1:,1:] ) + ( A[1:,:-1] + A[:-1,1:] ) ) # Mid-point of cell on original mesh
+    return a
+
+def refine_xyz_2x2(X, Y, Z, backend=None):
+    '''Returns the 3d coordinates (X,Y,Z) of a mesh refined by refine_2x2() and projected
+    back onto the unit sphere.'''
+    if check_backend(backend) == 'numba':
+        X, Y, Z = [np.ascontiguousarray(A, dtype=np.float64) for A in (X, Y, Z)]
+        out = np.empty((3, 2*X.shape[0]-1, 2*X.shape[1]-1))
+        _refine_xyz_2x2_numba(X, Y, Z, out)
+        return out[0], out[1], out[2]
+    X, Y, Z = refine_2x2(X, 'numpy'), refine_2x2(Y, 'numpy'), refine_2x2(Z, 'numpy')
+    R = 1. / np.sqrt((X*X + Y*Y) + Z*Z)
+    return R*X, R*Y, R*Z
+
+def uniform_index(x, origin, spacing, count, period=None, backend=None):
+    '''Returns the index of the nearest point to each of x on the uniform axis with count
+    points (the upper one if equidistant).  Points beyond the ends take the nearest end,
+    modulo period if it is not None.  See meshrefinement.UniformAxis.'''
+    if check_backend(backend) == 'numba':
+        xf = np.ascontiguousarray(x, dtype=np.float64).ravel()
+        n = np.empty(xf.shape, dtype=np.int64)
+        _uniform_index_numba(xf, origin, spacing, count, 0. if period is None else period, n)
+        return n.reshape(np.shape(x))
+    if period is None:
+        n = np.floor(0.5+(x-origin)/spacing)
+        return np.minimum(np.maximum(n, 0), count-1).astype(int)
+    r = np.mod(x-origin+0.5*spacing,period)
+    n = np.floor(r/spacing)
+    # Points in the gap after the last point are nearest to either end
+    gap_mid = 0.5*((count-1)*spacing+period)+0.5*spacing
+    n = np.where(n<=count-1, n, np.where(r<gap_mid, count-1, 0))
+    return n.astype(int)
+
+def gather_nn(zs, xs, ys, i, j, dtype=np.float64, backend=None):
+    '''Returns the height zs[j,i] with the given dtype and the source coordinates xs[i]
+    and ys[j] of the nearest neighbors (i,j) on a source grid with 1D coordinates.'''
+    if check_backend(backend) == 'numba':
+        shape = np.shape(i)
+        i = np.ascontiguousarray(i, dtype=np.int64).ravel()
+        j = np.ascontiguousarray(j, dtype=np.int64).ravel()
+        zm = np.empty(i.shape, dtype=dtype)
+        xm, ym = np.empty(i.shape), np.empty(i.shape)
+        _gather_nn_numba(np.asarray(zs), np.asarray(xs), np.asarray(ys), i, j, zm, xm, ym)
+        return zm.reshape(shape), xm.reshape(shape), ym.reshape(shape)
+    zm = np.asarray(zs)[j,i].astype(dtype, copy=False)
+    xm = np.asarray(xs)[i].astype(np.float64, copy=False)
+    ym = np.asarray(ys)[j].astype(np.float64, copy=False)
+    return zm, xm, ym
+
+def plane_residual_std(xs, ys, zs, xm, ym, zm, alphd, betad, denom, rf, max_elements=2**22, backend=None):
+    '''Returns the standard deviation of denom*D in each coarse cell where D is the
+    vertical distance of the points (xs,ys,zs) of the finest mesh from the
+    least-square plane of the cell.  The plane passes through the mean point
+    (xm,ym,zm) of the cell with slopes alphd/denom and betad/denom.
+
+    The finest mesh has a shape of (rf*(nj-1)+1,rf*(ni-1)+1) rather than
+    (rf*nj,rf*ni) and is padded with zeros, as with extend_by_zeros().  Each
+    coarse cell takes an (rf,rf) block of the padded mesh.  The numpy kernel
+    works on strips of coarse rows with at most max_elements points so the
+    repeated coarse arrays and the padded mesh are never formed in full.  The
+    numba kernel works cell by cell without temporary arrays.
+    '''
+    nj, ni = zm.shape
+    if check_backend(backend) == 'numba':
+        D_std = np.empty((nj, ni))
+        _plane_residual_std_numba(np.asarray(xs), np.asarray(ys), np.asarray(zs), xm, ym, zm,
+                alphd, betad, denom, rf, D_std)
+        return D_std
+
+    nr = max(1, max_elements//(rf*rf*ni))
+    D_std = np.zeros((nj, ni))
+
+    for j0 in range(0, nj, nr):
+        j1 = min(j0+nr, nj)
+
+        def fine(a):
+            # Strip of the finest mesh padded with zeros, shape (nr,rf,ni,rf)
+            s = np.zeros(((j1-j0)*rf, ni*rf))
+            a = a[j0*rf:j1*rf,:]
+            s[:a.shape[0],:a.shape[1]] = a
+            return s.reshape((j1-j0, rf, ni, rf))
+
+        def coarse(a):
+            # Strip of a coarse array broadcast to the finest mesh
+            return a[j0:j1,np.newaxis,:,np.newaxis]
+
+        D_times_denom = coarse(denom)*(fine(zs)-coarse(zm)) - coarse(alphd)*(fine(xs)-coarse(xm)) -\
+                coarse(betad)*(fine(ys)-coarse(ym))
+        D_std[j0:j1,:] = D_times_denom.std(axis=(1,3))
+
+    return D_std
+
+def path_minimum(order, parent, values, backend=None):
+    '''Returns the minimum of values on the path from each node of a forest to its
+    root.  Roots are their own parent and order lists the nodes reached from the
+    roots with each parent before its children, as returned by a breadth first search.
+    Nodes not in order keep their value.'''
+    if check_backend(backend) == 'numba':
+        out = np.array(values, dtype=np.float64)
+        _path_minimum_numba(np.asarray(order, dtype=np.int64), np.asarray(parent, dtype=np.int64), out)
+        return out
+    # Pointer jumping
+    out = np.array(values, dtype=np.float64)
+    parent = np.asarray(parent)
+    while True:
+        out = np.minimum(out, out[parent])
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent): break
+        parent = grandparent
+    return out
+
+def coarsen_2x2(zm, xm, ym, moments=None, min_max=True, dtype=np.float64, backend=None):
+    '''Coarsens the data of a refined mesh node array with shape (2*nj-1,2*ni-1) to the
+    parent mesh with shape (nj,ni).  Each parent node, except the last row and column,
+    takes the average of the (2,2) block of refined nodes starting at the same node.  The
+    last row and column are copied from the shared nodes.
+
+    :param zm: height on the refined mesh
+    :type zm: numpy.ndarray
+    :param xm: mean source longitude on the refined mesh
+    :type xm: numpy.ndarray
+    :param ym: mean source latitude on the refined mesh
+    :type ym: numpy.ndarray
+    :param moments: second moments (xxm,yym,xym,xzm,yzm) on the refined mesh, as returned
+                    by this function with the same dtype.  If None, the moments are formed
+                    from xm, ym and zm.
+    :type moments: tuple
+    :param min_max: if True, also return the minimum and maximum of zm in each block
+    :type min_max: boolean
+    :param dtype: data type of the returned height, minimum, maximum and moments
+    :type dtype: numpy.dtype
+    :param backend: 'numpy', 'numba' or None for the default backend
+    :type backend: string
+    :return: height, h_min, h_max, zm, xm, ym and the tuple of moments (xxm,yym,xym,xzm,yzm)
+             on the parent mesh.  The minimum and maximum are None unless min_max is True.
+             zm is the height.
+    :rtype: tuple
+
+    The means and moments are accumulated in double precision and stored with the given
+    dtype, except xm and ym which are always double precision.  With dtype float64 the
+    moments are raw moments, e.g. xxm is the mean of x*x.  Plane fits take differences
+    of raw moments, e.g. xxm-xm*xm, which would lose all precision if they were stored
+    in single precision.  With other dtypes the moments are central moments instead, e.g.
+    xxm is the mean of (x-xm)*(x-xm), formed from the central moments of the refined
+    nodes and their offsets from the block mean.  Central moments keep their relative
+    precision in single precision.
+    '''
+    central = np.dtype(dtype) != np.float64
+    if check_backend(backend) == 'numba':
+        nj, ni = (zm.shape[0]+1)//2, (zm.shape[1]+1)//2
+        out = np.empty((8, nj, ni), dtype=dtype)
+        outxy = np.empty((2, nj, ni))
+        if moments is None:
+            _coarsen_2x2_numba(zm, xm, ym, zm, zm, zm, zm, zm, False, min_max, central, out, outxy)
+        else:
+            _coarsen_2x2_numba(zm, xm, ym, *moments, True, min_max, central, out, outxy)
+        zc, hmin, hmax, xc, yc = out[0], out[1], out[2], outxy[0], outxy[1]
+        mc = (out[3], out[4], out[5], out[6], out[7])
+    else:
+        zc, hmin, hmax, xc, yc, mc = _coarsen_2x2_numpy(zm, xm, ym, moments, min_max, dtype)
+
+    if not min_max:
+        hmin, hmax = None, None
+    return zc, hmin, hmax, zc, xc, yc, mc
+
+def _blocks(a):
+    '''Returns the four (nj-1,ni-1) views a00, a11, a10 and a01 of the (2,2) blocks of a.'''
+    b = a[:-1,:-1].reshape((a.shape[0]//2, 2, a.shape[1]//2, 2))
+    return b[:,0,:,0], b[:,1,:,1], b[:,1,:,0], b[:,0,:,1]
+
+def _blocks64(a):
+    '''Returns _blocks(a) with the first block in double precision so sums of the
+    blocks are done in double precision.'''
+    a00, a11, a10, a01 = _blocks(a)
+    return a00.astype(np.float64, copy=False), a11, a10, a01
+
+def _average(a, product=None):
+    '''Returns the average of a, or of a*product, over each (2,2) block with the shared
+    nodes copied to the last row and column.  The summation order matches fourPointAve().'''
+    if product is None:
+        ave = np.array(a[::2,::2], dtype=np.float64)
+        a00, a11, a10, a01 = _blocks64(a)
+    else:
+        ave = np.multiply(a[::2,::2], product[::2,::2], dtype=np.float64)
+        a00, a11, a10, a01 = [np.multiply(p, q, dtype=np.float64) for (p,q) in zip(_blocks(a), _blocks(product))]
+    ave[:-1,:-1] = 0.25*(((a00 + a11) + a10) + a01)
+    return ave
+
+def _central(a, ac, b, bc, m=None):
+    '''Returns the average of m+(a-ac)*(b-bc) over each (2,2) block, where ac and bc are the
+    block averages of a and b, with m of the shared nodes copied to the last row and column.
+    m is zero if None.'''
+    if m is None:
+        c = np.zeros(ac.shape)
+    else:
+        c = np.array(m[::2,::2], dtype=np.float64)
+    blocks = zip(_blocks(a), _blocks(b), _blocks(m) if m is not None else (None,)*4)
+    acc = None
+    for (ak, bk, mk) in blocks:
+        t = (ak - ac[:-1,:-1])*(bk - bc[:-1,:-1])
+        if mk is not None:
+            t += mk
+        acc = t if acc is None else acc + t
+    c[:-1,:-1] = 0.25*acc
+    return c
+
+def _coarsen_2x2_numpy(zm, xm, ym, moments, min_max, dtype):
+    zc = _average(zm)
+    xc = _average(xm)
+    yc = _average(ym)
+    if np.dtype(dtype) != np.float64:
+        # Central moments, see coarsen_2x2()
+        if moments is None:
+            moments = (None,)*5
+        mc = tuple([m.astype(dtype) for m in (_central(xm, xc, xm, xc, moments[0]),
+            _central(ym, yc, ym, yc, moments[1]), _central(xm, xc, ym, yc, moments[2]),
+            _central(xm, xc, zm, zc, moments[3]), _central(ym, yc, zm, zc, moments[4]))])
+    elif moments is None:
+        # Moments of the finest mesh are formed block by block
+        mc = (_average(xm, xm), _average(ym, ym), _average(xm, ym), _average(xm, zm), _average(ym, zm))
+    else:
+        mc = tuple([_average(m) for m in moments])
+    zc = zc.astype(dtype, copy=False)
+
+    hmin, hmax = None, None
+    if min_max:
+        a00, a11, a10, a01 = _blocks(zm)
+        hmin = np.array(zm[::2,::2], dtype=dtype)
+        hmin[:-1,:-1] = np.minimum(np.minimum(np.minimum(a00, a11), a10), a01)
+        hmax = np.array(zm[::2,::2], dtype=dtype)
+        hmax[:-1,:-1] = np.maximum(np.maximum(np.maximum(a00, a11), a10), a01)
+
+    return zc, hmin, hmax, xc, yc, mc
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _central_numba(m, j, i, have_moments, d0, d1, d2, d3, e0, e1, e2, e3):
+        if have_moments:
+            return 0.25*((((m[j,i] + d0*e0) + (m[j+1,i+1] + d1*e1)) + (m[j+1,i] + d2*e2)) + (m[j,i+1] + d3*e3))
+        return 0.25*(((d0*e0 + d1*e1) + d2*e2) + d3*e3)
+
+    @numba.njit(parallel=True, cache=True)
+    def _coarsen_2x2_numba(zm, xm, ym, xxm, yym, xym, xzm, yzm, have_moments, min_max, central, out, outxy):
+        nj, ni = out.shape[1], out.shape[2]
+        for J in numba.prange(nj):
+            for I in range(ni):
+                j, i = 2*J, 2*I
+                if J == nj-1 or I == ni-1:
+                    # Shared nodes
+                    z, x, y = np.float64(zm[j,i]), np.float64(xm[j,i]), np.float64(ym[j,i])
+                    out[0,J,I] = z
+                    out[1,J,I] = z
+                    out[2,J,I] = z
+                    outxy[0,J,I] = x
+                    outxy[1,J,I] = y
+                    if have_moments:
+                        out[3,J,I] = xxm[j,i]
+                        out[4,J,I] = yym[j,i]
+                        out[5,J,I] = xym[j,i]
+                        out[6,J,I] = xzm[j,i]
+                        out[7,J,I] = yzm[j,i]
+                    elif central:
+                        out[3:8,J,I] = 0.
+                    else:
+                        out[3,J,I] = x*x
+                        out[4,J,I] = y*y
+                        out[5,J,I] = x*y
+                        out[6,J,I] = x*z
+                        out[7,J,I] = y*z
+                    continue
+                # Nodes in the order of fourPointAve(): (0,0), (1,1), (1,0), (0,1)
+                z0, z1, z2, z3 = np.float64(zm[j,i]), np.float64(zm[j+1,i+1]), np.float64(zm[j+1,i]), np.float64(zm[j,i+1])
+                x0, x1, x2, x3 = np.float64(xm[j,i]), np.float64(xm[j+1,i+1]), np.float64(xm[j+1,i]), np.float64(xm[j,i+1])
+                y0, y1, y2, y3 = np.float64(ym[j,i]), np.float64(ym[j+1,i+1]), np.float64(ym[j+1,i]), np.float64(ym[j,i+1])
+                z = 0.25*(((z0 + z1) + z2) + z3)
+                x = 0.25*(((x0 + x1) + x2) + x3)
+                y = 0.25*(((y0 + y1) + y2) + y3)
+                out[0,J,I] = z
+                if min_max:
+                    out[1,J,I] = min(min(min(z0, z1), z2), z3)
+                    out[2,J,I] = max(max(max(z0, z1), z2), z3)
+                outxy[0,J,I] = x
+                outxy[1,J,I] = y
+                if central:
+                    # Central moments, see coarsen_2x2()
+                    dx0, dx1, dx2, dx3 = x0-x, x1-x, x2-x, x3-x
+                    dy0, dy1, dy2, dy3 = y0-y, y1-y, y2-y, y3-y
+                    dz0, dz1, dz2, dz3 = z0-z, z1-z, z2-z, z3-z
+                    out[3,J,I] = _central_numba(xxm, j, i, have_moments, dx0, dx1, dx2, dx3, dx0, dx1, dx2, dx3)
+                    out[4,J,I] = _central_numba(yym, j, i, have_moments, dy0, dy1, dy2, dy3, dy0, dy1, dy2, dy3)
+                    out[5,J,I] = _central_numba(xym, j, i, have_moments, dx0, dx1, dx2, dx3, dy0, dy1, dy2, dy3)
+                    out[6,J,I] = _central_numba(xzm, j, i, have_moments, dx0, dx1, dx2, dx3, dz0, dz1, dz2, dz3)
+                    out[7,J,I] = _central_numba(yzm, j, i, have_moments, dy0, dy1, dy2, dy3, dz0, dz1, dz2, dz3)
+                elif have_moments:
+                    out[3,J,I] = 0.25*(((xxm[j,i] + xxm[j+1,i+1]) + xxm[j+1,i]) + xxm[j,i+1])
+                    out[4,J,I] = 0.25*(((yym[j,i] + yym[j+1,i+1]) + yym[j+1,i]) + yym[j,i+1])
+                    out[5,J,I] = 0.25*(((xym[j,i] + xym[j+1,i+1]) + xym[j+1,i]) + xym[j,i+1])
+                    out[6,J,I] = 0.25*(((xzm[j,i] + xzm[j+1,i+1]) + xzm[j+1,i]) + xzm[j,i+1])
+                    out[7,J,I] = 0.25*(((yzm[j,i] + yzm[j+1,i+1]) + yzm[j+1,i]) + yzm[j,i+1])
+                else:
+                    out[3,J,I] = 0.25*(((x0*x0 + x1*x1) + x2*x2) + x3*x3)
+                    out[4,J,I] = 0.25*(((y0*y0 + y1*y1) + y2*y2) + y3*y3)
+                    out[5,J,I] = 0.25*(((x0*y0 + x1*y1) + x2*y2) + x3*y3)
+                    out[6,J,I] = 0.25*(((x0*z0 + x1*z1) + x2*z2) + x3*z3)
+                    out[7,J,I] = 0.25*(((y0*z0 + y1*z1) + y2*z2) + y3*z3)
+
+    @numba.njit(cache=True)
+    def _refine_node(A, J, I):
+        j, i = J//2, I//2
+        if J%2 == 0 and I%2 == 0:
+            return A[j,i]
+        elif J%2 == 0:
+            return 0.5 * ( A[j,i] + A[j,i+1] )
+        elif I%2 == 0:
+            return 0.5 * ( A[j,i] + A[j+1,i] )
+        return 0.25 * ( ( A[j,i] + A[j+1,i+1] ) + ( A[j+1,i] + A[j,i+1] ) )
+
+    @numba.njit(parallel=True, cache=True)
+    def _refine_2x2_numba(A, a):
+        for J in numba.prange(a.shape[0]):
+            for I in range(a.shape[1]):
+                a[J,I] = _refine_node(A, J, I)
+
+    @numba.njit(parallel=True, cache=True)
+    def _refine_xyz_2x2_numba(X, Y, Z, out):
+        nj, ni = out.shape[1], out.shape[2]
+        for J in numba.prange(nj):
+            for I in range(ni):
+                x, y, z = _refine_node(X, J, I), _refine_node(Y, J, I), _refine_node(Z, J, I)
+                r = 1. / np.sqrt((x*x + y*y) + z*z)
+                out[0,J,I] = r*x
+                out[1,J,I] = r*y
+                out[2,J,I] = r*z
+
+    @numba.njit(parallel=True, cache=True)
+    def _uniform_index_numba(x, origin, spacing, count, period, n):
+        gap_mid = 0.5*((count-1)*spacing+period)+0.5*spacing
+        for k in numba.prange(x.shape[0]):
+            if period == 0.:
+                m = np.floor(0.5+(x[k]-origin)/spacing)
+                m = min(max(m, 0.), count-1.)
+            else:
+                r = (x[k]-origin+0.5*spacing) % period
+                m = np.floor(r/spacing)
+                if m > count-1:
+                    if r < gap_mid: m = count-1.
+                    else: m = 0.
+            n[k] = int(m)
+
+    @numba.njit(parallel=True, cache=True)
+    def _gather_nn_numba(zs, xs, ys, i, j, zm, xm, ym):
+        for k in numba.prange(i.shape[0]):
+            zm[k] = zs[j[k],i[k]]
+            xm[k] = xs[i[k]]
+            ym[k] = ys[j[k]]
+
+    @numba.njit(parallel=True, cache=True)
+    def _plane_residual_std_numba(xs, ys, zs, xm, ym, zm, alphd, betad, denom, rf, D_std):
+        nj, ni = zm.shape
+        mj, mi = zs.shape
+        n = rf*rf
+        for J in numba.prange(nj):
+            for I in range(ni):
+                # Points beyond the finest mesh are zero, as in the padded mesh
+                s = 0.
+                for j in range(J*rf, (J+1)*rf):
+                    for i in range(I*rf, (I+1)*rf):
+                        x, y, z = 0., 0., 0.
+                        if j < mj and i < mi:
+                            x, y, z = xs[j,i], ys[j,i], zs[j,i]
+                        s += denom[J,I]*(z-zm[J,I]) - alphd[J,I]*(x-xm[J,I]) - betad[J,I]*(y-ym[J,I])
+                mean = s/n
+                s = 0.
+                for j in range(J*rf, (J+1)*rf):
+                    for i in range(I*rf, (I+1)*rf):
+                        x, y, z = 0., 0., 0.
+                        if j < mj and i < mi:
+                            x, y, z = xs[j,i], ys[j,i], zs[j,i]
+                        d = denom[J,I]*(z-zm[J,I]) - alphd[J,I]*(x-xm[J,I]) - betad[J,I]*(y-ym[J,I]) - mean
+                        s += d*d
+                D_std[J,I] = np.sqrt(s/n)
+
+    @numba.njit(cache=True)
+    def _path_minimum_numba(order, parent, out):
+        for k in range(order.shape[0]):
+            n = order[k]
+            out[n] = min(out[n], out[parent[n]])
@@ -1,8 +1,17 @@
 '''This was originally GMesh.py from Niki Zahdah.  :cite:p:`Zadeh_2020_ocean_model_topog_generator`
 
 '''
+import collections, weakref
 import numpy as np
 import pdb
+from . import kernels
+
+# Nearest neighbor indexes of recently used non-uniform sources, see MeshRefinement.find_nn_source()
+_source_index_cache = collections.OrderedDict()
+_source_index_cache_size = 4
+# Descriptors of recently used source axes, see uniform_axis()
+_uniform_axis_cache = collections.OrderedDict()
+_uniform_axis_cache_size = 16
 
 def fourPointAve(x):
     xave = np.copy(x[::2,::2])
@@ -17,6 +26,9 @@ def is_mesh_uniform(lon,lat):
         error = np.abs( array )
         error = np.maximum( error[1:], error[:-1] ) # Error in difference
         #derror = np.abs( delta - delta.flatten()[0] ) # Tolerance to which comparison can be made
+        if not hasattr(delta, 'stack'): # numpy arrays
+            derror = np.abs( delta - delta.flatten()[0] )
+            return np.all( derror < ( error + error.flatten()[0] ) )
         derror = np.abs( delta - delta.stack(z=(delta.coords)).reset_index('z')[0] )
         #return np.all( derror < ( error + error.flatten()[0] ) )
         return np.all( derror < ( error + error.stack(z=(error.coords)).reset_index('z')[0] ) )
@@ -29,6 +41,255 @@ def is_mesh_uniform(lon,lat):
     #pdb.set_trace()
     return compare(lat) and compare(lon.T)
 
+class UniformAxis(collections.namedtuple('UniformAxis', ['origin', 'spacing', 'count', 'period', 'periodic', 'eps'])):
+    """Describes a uniform 1D coordinate axis of a source grid.
+
+    origin and spacing are the first coordinate and the spacing, count is the number of
+    distinct points (a repeated longitude at the end of the axis is not counted), period is
+    360 for longitudes and None otherwise, periodic is True if the axis covers the whole
+    period, and eps is the precision of the coordinate data type.  See uniform_axis()."""
+    __slots__ = ()
+
+    def index(self, x, backend=None):
+        """Returns the index of the nearest point on the axis to each of x (the upper one if
+           equidistant).  Points beyond the ends of the axis take the nearest end, for longitudes
+           the nearest one modulo the period.  See kernels.uniform_index()."""
+        return kernels.uniform_index(x, self.origin, self.spacing, self.count, self.period, backend=backend)
+
+def _uniform_axis(array, period):
+    """Returns the UniformAxis of the 1D coordinate array, or None if it is not uniform"""
+    a = np.asarray(array)
+    if a.shape[0]<2 or not _is_uniform_axis(a): return None
+    eps = np.finfo( a.dtype ).eps if np.issubdtype( a.dtype, np.floating ) else 0.
+    count = a.shape[0]
+    # Spacing computed in the precision of the coordinates, as find_nn_uniform_source() did
+    spacing = ((a[-1]-a[0])/max(count-1,1)).tolist()
+    periodic = False
+    if period is not None:
+        if abs( (a[-1]-a[0])-period )<=period*eps:
+            print("Detected repeated longitude ",a[0],a[-1])
+            count-=1 # Account for repeated longitude
+        periodic = abs( count*spacing-period )<=0.5*abs(spacing)
+    return UniformAxis(a[0].tolist(), spacing, count, period, periodic, eps)
+
+def uniform_axis(array, period=None):
+    """Returns the UniformAxis describing the 1D coordinate array, or None if the spacing of
+       the array is not constant.  Use period=360 for longitudes.  Descriptors are cached for
+       the most recently used arrays, identified by their data, which must not be modified in
+       place while cached."""
+    return _cached(_uniform_axis_cache, _uniform_axis_cache_size, (array,), period,
+                   lambda a: _uniform_axis(a, period))
+
+def _cached(cache, size, arrays, option, factory):
+    """Returns factory(*arrays), cached by the identity of the data of arrays and option."""
+    arrays = [np.asarray(a) for a in arrays]
+    key = tuple([id(a) for a in arrays])+(option,)
+    if key in cache:
+        refs,value = cache[key]
+        if all([r() is a for (r,a) in zip(refs,arrays)]):
+            cache.move_to_end(key)
+            return value
+    value = factory(*arrays)
+    cache[key] = ([weakref.ref(a) for a in arrays],value)
+    while len(cache)>size: cache.popitem(last=False)
+    return value
+
+def _is_uniform_axis(array):
+    """Returns True if the spacing of the 1D coordinate array is constant to within the
+       rounding of the coordinate values"""
+    a = np.asarray(array)
+    if a.shape[0]<3: return True
+    eps = np.finfo( a.dtype ).eps if np.issubdtype( a.dtype, np.floating ) else 0.
+    delta = np.diff( a.astype(np.float64) )
+    return bool( np.all( np.abs( delta - delta.mean() ) <= 4.*eps*np.abs( a ).max() ) )
+
+def source_shape(lon, lat):
+    """Returns the shape (nj,ni) of the source grid with 1D or 2D coordinates (lon,lat)"""
+    if len(lon.shape)==2: return lon.shape
+    return lat.shape[0],lon.shape[0]
+
+class _NonUniformAxesIndex(object):
+    """Nearest neighbor indexes on a source grid with non-uniform 1D coordinates (lon,lat).
+       Each axis is searched separately like find_nn_uniform_source(); points half way between
+       two source points take the upper one."""
+    def __init__(self, lon, lat):
+        lon,lat = np.asarray(lon,dtype=np.float64),np.asarray(lat,dtype=np.float64)
+        self.lat_descending = lat[-1]<lat[0]
+        if self.lat_descending: lat = lat[::-1]
+        self.nlat = lat.shape[0]
+        self.lat_mid = 0.5*(lat[1:]+lat[:-1])
+        self.nlon = lon.shape[0]
+        self.lon0 = lon[0]
+        # Longitudes relative to the first one, the first one repeated after a full turn
+        rlon = np.mod(lon-lon[0],360.)
+        rlon = np.append(rlon,360.)
+        # Points up to half a spacing west of the first longitude are nearest to it,
+        # so the search is done on longitudes shifted east by half that spacing
+        self.lon_shift = 0.5*(rlon[1]-rlon[0])
+        self.lon_mid = 0.5*(rlon[1:]+rlon[:-1]) + self.lon_shift
+    def __call__(self, lon, lat):
+        nn_j = np.searchsorted(self.lat_mid, lat, side='right')
+        if self.lat_descending: nn_j = self.nlat-1-nn_j
+        nn_i = np.searchsorted(self.lon_mid, np.mod(lon-self.lon0+self.lon_shift,360.), side='right')
+        # Points past the midpoint of the gap after the last longitude are nearest to the first
+        nn_i = np.where(nn_i==self.nlon, 0, nn_i)
+        return nn_i.astype(int),nn_j.astype(int)
+
+class _KDTreeIndex(object):
+    """Nearest neighbor indexes on a source grid with 2D coordinates (lon,lat) using a k-d tree
+       of the points on the unit sphere."""
+    def __init__(self, lon, lat):
+        from scipy.spatial import cKDTree
+        self.shape = lon.shape
+        X,Y,Z = _lonlat_to_XYZ(np.asarray(lon,dtype=np.float64),np.asarray(lat,dtype=np.float64))
+        self.tree = cKDTree(np.column_stack((X.ravel(),Y.ravel(),Z.ravel())))
+    def __call__(self, lon, lat):
+        X,Y,Z = _lonlat_to_XYZ(lon,lat)
+        d,k = self.tree.query(np.column_stack((X.ravel(),Y.ravel(),Z.ravel())))
+        nn_j,nn_i = np.unravel_index(k,self.shape)
+        return nn_i.reshape(lon.shape),nn_j.reshape(lon.shape)
+
+def _lonlat_to_XYZ(lon, lat):
+    """Returns 3d coordinates (X,Y,Z) of spherical coordiantes (lon,lat)."""
+    deg2rad = np.pi/180.
+    lonr,latr = deg2rad*lon, deg2rad*lat
+    return np.cos( latr )*np.cos( lonr ), np.cos( latr )*np.sin( lonr ), np.sin( latr )
+
+def _source_index(lon, lat):
+    """Returns the nearest neighbor index of the non-uniform source grid (lon,lat).  Indexes
+       are cached for the most recent sources.  Sources are identified by the data of the
+       coordinates, which must not be modified in place while cached."""
+    def index(lon, lat):
+        if len(lon.shape)==2: return _KDTreeIndex(lon,lat)
+        return _NonUniformAxesIndex(lon,lat)
+    return _cached(_source_index_cache, _source_index_cache_size, (lon,lat), None, index)
+
+class CellLocator(object):
+    """Locates the cells of a curvilinear mesh with vertices (lon,lat) of shape (nj+1,ni+1)
+       that contain points.  Candidate cells are the cells with the nearest centers, found
+       with a k-d tree on the unit sphere, and are accepted if the point is on the inner
+       side of the great circles along all four edges of the cell."""
+    def __init__(self, lon, lat):
+        from scipy.spatial import cKDTree
+        X,Y,Z = _lonlat_to_XYZ(np.asarray(lon,dtype=np.float64),np.asarray(lat,dtype=np.float64))
+        self.shape = (X.shape[0]-1, X.shape[1]-1)
+        P = np.stack((X,Y,Z), axis=-1)
+        # Corners of each cell in order around the cell, shape (nj*ni,4,3)
+        C = np.stack((P[:-1,:-1], P[:-1,1:], P[1:,1:], P[1:,:-1]), axis=2).reshape(-1,4,3)
+        # Normals of the great circles along the edges
+        self.normals = np.cross(C, np.roll(C, -1, axis=1))
+        center = C.sum(axis=1)
+        center /= np.sqrt((center*center).sum(axis=1))[:,None]
+        self.tree = cKDTree(center)
+        # Points farther than this from all centers are outside of all cells
+        self.radius = np.sqrt(((C-center[:,None,:])**2).sum(axis=2)).max()*(1.+1.e-9)
+    def inside(self, k, P):
+        """Returns True for points P (n,3) inside cells with flat indices k."""
+        s = np.einsum('nej,nj->ne', self.normals[k], P)
+        return np.all(s >= 0, axis=1) | np.all(s <= 0, axis=1)
+    def __call__(self, X, Y, Z, candidates=8):
+        """Returns the flat index of the cell containing each point (X,Y,Z) on the unit sphere,
+           or -1 for points not in any of the cells with the nearest candidates centers."""
+        P = np.column_stack((X.ravel(),Y.ravel(),Z.ravel()))
+        cell = np.full(P.shape[0], -1)
+        d,k = self.tree.query(P, distance_upper_bound=self.radius, workers=-1)
+        near = np.flatnonzero(np.isfinite(d))
+        found = self.inside(k[near], P[near])
+        cell[near[found]] = k[near[found]]
+        miss = near[~found]
+        candidates = min(candidates, self.tree.n)
+        if miss.size > 0 and candidates > 1:
+            d,k = self.tree.query(P[miss], k=candidates, distance_upper_bound=self.radius, workers=-1)
+            for n in range(1, candidates):
+                found = np.isfinite(d[:,n])
+                found[found] = self.inside(k[found,n], P[miss[found]])
+                cell[miss[found]] = k[found,n]
+                miss, d, k = miss[~found], d[~found], k[~found]
+                if miss.size == 0: break
+        return cell.reshape(X.shape)
+
+def _cell_widths(x, period=None):
+    """Returns the widths of cells centered on the 1D coordinates x.  If period is given,
+    jumps of x by a multiple of period, such as longitudes wrapped at 180, are removed first."""
+    x = np.asarray(x, dtype=np.float64)
+    if x.size < 2: return np.ones_like(x)
+    if period is not None: x = np.unwrap(x, period=period)
+    edges = np.empty(x.size+1)
+    edges[1:-1] = 0.5*( x[1:] + x[:-1] )
+    edges[0] = 1.5*x[0] - 0.5*x[1]
+    edges[-1] = 1.5*x[-1] - 0.5*x[-2]
+    return np.abs( np.diff( edges ) )
+
+def block_average(lon, lat, src_lon, src_lat, src, wet_depth=0.000001, max_elements=2**22):
+    """Averages source data src (nlat,nlon) with 1D coordinates (src_lon,src_lat) on the cells
+    of a curvilinear mesh with vertices (lon,lat) of shape (nj+1,ni+1).
+
+    Each source point is assigned to the cell containing it (see CellLocator) and weighted by
+    the area of its source cell.  The source is read and reduced in strips of rows with at
+    most max_elements points, so src may be a lazily loaded array.  Source points outside of
+    the mesh and missing (NaN) values are ignored.
+
+    Returns the weighted mean, the wet fraction (the weighted fraction of source points with
+    depth of at least wet_depth), the minimum and the maximum of each cell, each of shape
+    (nj,ni).  Cells without any source points are NaN.
+    """
+    locate = CellLocator(lon, lat)
+    ncell = locate.shape[0]*locate.shape[1]
+    src_lon = np.asarray(src_lon, dtype=np.float64)
+    src_lat = np.asarray(src_lat, dtype=np.float64)
+    wx = _cell_widths(src_lon, period=360.)
+    wy = _cell_widths(src_lat)*np.cos(np.deg2rad(src_lat))
+
+    sumw = np.zeros(ncell)
+    sumz = np.zeros(ncell)
+    sumwet = np.zeros(ncell)
+    hmin = np.full(ncell, np.inf)
+    hmax = np.full(ncell, -np.inf)
+    rows = max(1, max_elements//max(1,src_lon.size))
+    for j0 in range(0, src_lat.size, rows):
+        j1 = min(src_lat.size, j0+rows)
+        z = np.asarray(src[j0:j1], dtype=np.float64)
+        X,Y,Z = _lonlat_to_XYZ(src_lon[None,:], src_lat[j0:j1,None])
+        cell = locate(*np.broadcast_arrays(X,Y,Z))
+        w = wy[j0:j1,None]*wx[None,:]
+        keep = (cell >= 0) & np.isfinite(z)
+        cell, w, z = cell[keep], w[keep], z[keep]
+        sumw += np.bincount(cell, weights=w, minlength=ncell)
+        sumz += np.bincount(cell, weights=w*z, minlength=ncell)
+        sumwet += np.bincount(cell, weights=w*(z >= wet_depth), minlength=ncell)
+        np.minimum.at(hmin, cell, z)
+        np.maximum.at(hmax, cell, z)
+
+    empty = sumw == 0
+    sumw[empty] = np.nan
+    hmin[empty] = np.nan
+    hmax[empty] = np.nan
+    return ( (sumz/sumw).reshape(locate.shape), (sumwet/sumw).reshape(locate.shape),
+             hmin.reshape(locate.shape), hmax.reshape(locate.shape) )
+
+def refine_levels(lon, lat, src_lon, src_lat):
+    """Returns the number of refinements by 2 needed for the largest extent of a cell edge of the mesh
+       (lon,lat), in either longitude or latitude, to be no larger than the spacing of the source grid
+       (src_lon,src_lat).  The smallest spacing is used if the source grid is not uniform."""
+    if len(src_lon.shape)==2:
+        # Convert to 1D arrays
+        src_lon,src_lat = src_lon[0,:],src_lat[:,0]
+    xaxis,yaxis = uniform_axis(src_lon,period=360.),uniform_axis(src_lat)
+    src_lon,src_lat = np.asarray(src_lon),np.asarray(src_lat)
+    if xaxis is not None and yaxis is not None:
+        # Spacing on uniform mesh
+        dellon,dellat = abs(xaxis.spacing),abs(yaxis.spacing)
+    else:
+        # Smallest spacing on non-uniform mesh
+        dellon = MeshRefinement.mdist(src_lon[1:],src_lon[:-1]).min()
+        dellat = np.abs(src_lat[1:]-src_lat[:-1]).min()
+    lon,lat = np.asarray(lon),np.asarray(lat)
+    dlon = max(MeshRefinement.mdist(lon[:,1:],lon[:,:-1]).max(), MeshRefinement.mdist(lon[1:,:],lon[:-1,:]).max())
+    dlat = max(np.abs(lat[:,1:]-lat[:,:-1]).max(), np.abs(lat[1:,:]-lat[:-1,:]).max())
+    ratio = max(dlon/dellon, dlat/dellat)
+    if ratio <= 1.: return 0
+    return int(np.ceil(np.log2(ratio)))
+
 class MeshRefinement(object):
     """Describes 2D meshes for ESMs.
 
@@ -48,7 +309,7 @@ class MeshRefinement(object):
     area  - area of cells, shape (nj,ni)
     """
 
-    def __init__(self, shape=None, lon=None, lat=None, area=None, lon0=-180., from_cell_center=False, rfl=0):
+    def __init__(self, shape=None, lon=None, lat=None, area=None, lon0=-180., from_cell_center=False, rfl=0, xyz=None):
         """Constructor for Mesh:
         shape - shape of cell array, (nj,ni)
         ni    - number of cells in i-direction (last index)
@@ -58,7 +319,18 @@ class MeshRefinement(object):
         area  - area of cells (2d)
         lon0  - used when generating a spherical grid in absence of (lon,lat)
         rfl   - refining level of this mesh
+        xyz   - 3d coordinates (X,Y,Z) of mesh (cell corners) on the unit sphere (2d),
+                instead of (lon,lat) which are then only calculated when needed
         """
+        self._lon, self._lat, self._xyz = None, None, None
+        if xyz is not None:
+            if (lon is not None) or (lat is not None): raise Exception('Either xyz or lon and lat must be specified')
+            (nj,ni) = xyz[0].shape[0]-1, xyz[0].shape[1]-1
+            self.ni, self.nj, self.shape = ni, nj, (nj,ni)
+            self._xyz = xyz
+            self.area = None
+            self.rfl = rfl
+            return
         if (shape is None) and (lon is None) and (lat is None): raise Exception('Either shape must be specified or both lon and lat')
         if (lon is None) and (lat is not None): raise Exception('Either shape must be specified or both lon and lat')
         if (lon is not None) and (lat is None): raise Exception('Either shape must be specified or both lon and lat')
@@ -115,6 +387,51 @@ class MeshRefinement(object):
 
         self.rfl = rfl #refining level
 
+    @property
+    def lon(self):
+        """Longitude of mesh (cell corners)"""
+        if self._lon is None: self.__derive_lonlat()
+        return self._lon
+
+    @lon.setter
+    def lon(self, lon):
+        if self._lat is None and self._xyz is not None: self.__derive_lonlat()
+        self._lon, self._xyz = lon, None
+
+    @property
+    def lat(self):
+        """Latitude of mesh (cell corners)"""
+        if self._lat is None: self.__derive_lonlat()
+        return self._lat
+
+    @lat.setter
+    def lat(self, lat):
+        if self._lon is None and self._xyz is not None: self.__derive_lonlat()
+        self._lat, self._xyz = lat, None
+
+    def __derive_lonlat(self):
+        """Private method. Calculates (lon,lat) from the 3d coordinates of the mesh."""
+        if self._xyz is None: raise Exception('The coordinates of this mesh have been released')
+        self._lon, self._lat = MeshRefinement.__XYZ_to_lonlat(*self._xyz)
+
+    def release_coordinates(self):
+        """Releases all coordinates of the mesh.  The shape of the mesh and any sampled data are kept."""
+        self._lon, self._lat, self._xyz = None, None, None
+
+    def release_data(self):
+        """Releases the data sampled on, or coarsened to, the mesh."""
+        for name in ['height', 'h_min', 'h_max', 'xm', 'ym', 'zm', 'xxm', 'yym', 'xym', 'xzm', 'yzm']:
+            if hasattr(self, name): delattr(self, name)
+
+    def xyz(self):
+        """Returns the 3d coordinates (X,Y,Z) of the mesh (cell corners) on the unit sphere."""
+        if self._xyz is not None: return self._xyz
+        return MeshRefinement.__lonlat_to_XYZ(self.lon, self.lat)
+
+    def release_xyz(self):
+        """Releases the 3d coordinates of the mesh, if kept, once (lon,lat) have been calculated."""
+        if self._xyz is not None and self._lon is not None and self._lat is not None: self._xyz = None
+
     def __repr__(self):
         return '<MeshRefinement nj:%i ni:%i shape:(%i,%i)>'%(self.nj,self.ni,self.shape[0],self.shape[1])
 
@@ -138,9 +455,7 @@ class MeshRefinement(object):
 
     def __lonlat_to_XYZ(lon, lat):
         """Private method. Returns 3d coordinates (X,Y,Z) of spherical coordiantes (lon,lat)."""
-        deg2rad = np.pi/180.
-        lonr,latr = deg2rad*lon, deg2rad*lat
-        return np.cos( latr )*np.cos( lonr ), np.cos( latr )*np.sin( lonr ), np.sin( latr )
+        return _lonlat_to_XYZ(lon, lat)
 
     def __XYZ_to_lonlat(X, Y, Z):
         """Private method. Returns spherical coordinates (lon,lat) of 3d coordinates (X,Y,Z)."""
@@ -153,27 +468,18 @@ class MeshRefinement(object):
         lon = np.where( Y>=0, lon, -lon ) # Handle -180 .. 0
         return lon,lat
 
-    def refineby2(self, work_in_3d=True):
-        """Returns new Mesh instance with twice the resolution"""
-
-        def local_refine(A):
-            """Retruns a refined variable a with shape (2*nj-1,2*ni-1) by linearly interpolation A with shape (nj,ni)."""
-            nj,ni = A.shape
-            a = np.zeros( (2*nj-1,2*ni-1) )
-            a[::2,::2] = A[:,:] # Shared nodes
-            a[::2,1::2] = 0.5 * ( A[:,:-1] + A[:,1:] ) # Mid-point along i-direction on original mesh
-            a[1::2,::2] = 0.5 * ( A[:-1,:] + A[1:,:] ) # Mid-point along j-direction on original mesh
-            a[1::2,1::2] = 0.25 * ( ( A[:-1,:-1] + A[1:,1:] ) + ( A[1:,:-1] + A[:-1,1:] ) ) # Mid-point of cell on original mesh
-            return a
+    def refineby2(self, work_in_3d=True, backend=None):
+        """Returns new Mesh instance with twice the resolution.  Nodes are linearly interpolated,
+           see kernels.refine_2x2()."""
 
         if work_in_3d:
             # Calculate 3d coordinates of nodes (X,Y,Z), Z points along pole, Y=0 at lon=0,180, X=0 at lon=+-90
-            X,Y,Z = MeshRefinement.__lonlat_to_XYZ(self.lon, self.lat)
+            # A mesh refined in 3d keeps these so they do not have to be calculated again.
+            X,Y,Z = self.xyz()
+            self.release_xyz()
 
             # Refine mesh in 3d and project onto sphere
-            X,Y,Z = local_refine(X), local_refine(Y), local_refine(Z)
-            R = 1. / np.sqrt((X*X + Y*Y) + Z*Z)
-            X,Y,Z = R*X, R*Y, R*Z
+            X,Y,Z = kernels.refine_xyz_2x2(X, Y, Z, backend=backend)
 
             # Normalize X,Y to unit circle
             #sub_roundoff = 2./np.finfo(X[0,0]).max
@@ -181,11 +487,11 @@ class MeshRefinement(object):
             #X = R * X
             #Y = R * Y
 
-            # Convert from 3d to spherical coordinates
-            lon,lat = MeshRefinement.__XYZ_to_lonlat(X, Y, Z)
+            # Spherical coordinates are only calculated when needed
+            return MeshRefinement(xyz=(X,Y,Z), rfl=self.rfl+1)
 
         else:
-            lon,lat = local_refine(self.lon), local_refine(self.lat)
+            lon,lat = kernels.refine_2x2(self.lon, backend=backend), kernels.refine_2x2(self.lat, backend=backend)
 
         return MeshRefinement(lon=lon, lat=lat, rfl=self.rfl+1)
 
@@ -206,53 +512,46 @@ class MeshRefinement(object):
 
         return self
 
-    def coarsenby2(self, coarser_mesh):
-        """Set the height for lower level Mesh by coarsening"""
+    def coarsenby2(self, coarser_mesh, min_max=True, dtype=np.float64, backend=None):
+        """Set the height for lower level Mesh by coarsening.  The minimum and maximum height, h_min
+           and h_max, are only set if min_max is True.  If this mesh only has the first moments
+           (xm,ym,zm), as set by sample_source_data_on_target_mesh(), the second moments are formed
+           here.  The height, h_min, h_max, zm and the moments are stored with the given dtype, xm
+           and ym are always double precision.  Moments of any dtype other than float64 are central
+           moments.  See kernels.coarsen_2x2() and covariances()."""
         if(self.rfl == 0):
             raise Exception('Coarsest grid, no more coarsening possible!')
 
-        coarser_mesh.height = np.copy(self.height[::2,::2])
-        coarser_mesh.height[:-1,:-1] = 0.25*(self.height[:-1:2,:-1:2]
-                                           + self.height[1::2,1::2]
-                                           + self.height[1::2,0:-1:2]
-                                           + self.height[0:-1:2,1::2])
-
-        coarser_mesh.h_min = np.copy(self.height[::2,::2])
-        coarser_mesh.h_min[:-1,:-1] = np.minimum(self.height[:-1:2,:-1:2],self.height[1::2,1::2])
-        coarser_mesh.h_min[:-1,:-1] = np.minimum(coarser_mesh.h_min[:-1,:-1],self.height[1::2,0:-1:2])
-        coarser_mesh.h_min[:-1,:-1] = np.minimum(coarser_mesh.h_min[:-1,:-1],self.height[0:-1:2,1::2])
-
-        coarser_mesh.h_max = np.copy(self.height[::2,::2])
-        coarser_mesh.h_max[:-1,:-1] = np.maximum(self.height[:-1:2,:-1:2],self.height[1::2,1::2])
-        coarser_mesh.h_max[:-1,:-1] = np.maximum(coarser_mesh.h_max[:-1,:-1],self.height[1::2,0:-1:2])
-        coarser_mesh.h_max[:-1,:-1] = np.maximum(coarser_mesh.h_max[:-1,:-1],self.height[0:-1:2,1::2])
-
-        coarser_mesh.h_std = np.zeros(coarser_mesh.height.shape)
-        coarser_mesh.zm = coarser_mesh.height
-        coarser_mesh.xm = fourPointAve(self.xm)
-        coarser_mesh.ym = fourPointAve(self.ym)
-        coarser_mesh.xxm = fourPointAve(self.xxm)
-        coarser_mesh.yym = fourPointAve(self.yym)
-        coarser_mesh.xym = fourPointAve(self.xym)
-        coarser_mesh.xzm = fourPointAve(self.xzm)
-        coarser_mesh.yzm = fourPointAve(self.yzm)
+        moments = None
+        if hasattr(self, 'xxm'):
+            moments = (self.xxm, self.yym, self.xym, self.xzm, self.yzm)
+        height, h_min, h_max, zm, xm, ym, moments = kernels.coarsen_2x2(self.zm, self.xm, self.ym,
+                moments=moments, min_max=min_max, dtype=dtype, backend=backend)
+
+        coarser_mesh.height, coarser_mesh.h_min, coarser_mesh.h_max = height, h_min, h_max
+        coarser_mesh.zm, coarser_mesh.xm, coarser_mesh.ym = zm, xm, ym
+        coarser_mesh.xxm, coarser_mesh.yym, coarser_mesh.xym, coarser_mesh.xzm, coarser_mesh.yzm = moments
+
+    def covariances(self):
+        """Returns the double precision covariances (xx,yy,xy,xz,yz) of the source data about the
+           means (xm,ym,zm) in each cell, from the moments set by coarsenby2().  Double precision
+           moments are raw moments, others are already central moments."""
+        if self.xxm.dtype != np.float64:
+            return tuple([m.astype(np.float64) for m in (self.xxm, self.yym, self.xym, self.xzm, self.yzm)])
+        return (self.xxm-self.xm*self.xm, self.yym-self.ym*self.ym, self.xym-self.xm*self.ym,
+                self.xzm-self.xm*self.zm, self.yzm-self.ym*self.zm)
 
     def mdist(x1,x2):
         """Returns positive distance modulo 360."""
         return np.minimum( np.mod(x1-x2,360.), np.mod(x2-x1,360.) )
 
-    def find_nn_uniform_source(self, lon, lat):
+    def find_nn_uniform_source(self, lon, lat, backend=None):
         """Returns the i,j arrays for the indexes of the nearest neighbor point to grid (lon,lat)"""
-        assert is_mesh_uniform(lon,lat), 'Grid (lon,lat) is not uniform, this method will not work properly'
         if len(lon.shape)==2:
             # Convert to 1D arrays
             lon,lat = lon[0,:],lat[:,0]
-        sni,snj =lon.shape[0],lat.shape[0] # Shape of source
-        # Spacing on uniform mesh
-        dellon, dellat = (lon[-1]-lon[0])/(sni-1), (lat[-1]-lat[0])/(snj-1)
-        # Convert to numbers
-        dellon = dellon.data.tolist()
-        dellat = dellat.data.tolist()
+        xaxis,yaxis = uniform_axis(lon,period=360.),uniform_axis(lat)
+        assert xaxis is not None and yaxis is not None, 'Grid (lon,lat) is not uniform, this method will not work properly'
 #original
 #        assert self.lat.max()<=lat.max()+0.5*dellat, 'Mesh has latitudes above range of regular grid '+str(self.lat.max())+' '+str(lat.max()+0.5*dellat)
 #        assert self.lat.min()>=lat.min()-0.5*dellat, 'Mesh has latitudes below range of regular grid '+str(self.lat.min())+' '+str(lat.min()-0.5*dellat)
@@ -261,97 +560,230 @@ class MeshRefinement(object):
 #        assert self.lat.min()<=lat.min()+0.5*dellat, 'Source has latitudes below range of target mesh '+str(self.lat.min())+' '+str(lat.min()+0.5*dellat)
 #neither works for bipole
 
-        if abs( (lon[-1]-lon[0])-360 )<=360.*np.finfo( lon.dtype ).eps:
-            print("Detected repeated longitude ",lon[0],lon[-1])
-            sni-=1 # Account for repeated longitude
         # Nearest integer (the upper one if equidistant)
-        #pdb.set_trace()
-        #nn_i = np.floor(np.mod(self.lon-lon[0]+0.5*dellon,360)/dellon)
-        #nn_j = np.floor(0.5+(self.lat-lat[0])/dellat)
-        nn_i = np.floor(np.mod(self.lon-lon[0].data.tolist()+0.5*dellon,360)/dellon)
-        nn_j = np.floor(0.5+(self.lat-lat[0].data.tolist())/dellat)
-        nn_i = np.minimum(nn_i, sni-1)
-        nn_j = np.minimum(nn_j, snj-1)
-        nn_i = np.maximum(nn_i, 0)
-        nn_j = np.maximum(nn_j, 0)
-        assert nn_j.min()>=0, 'Negative j index calculated! j='+str(nn_j.min())
-        assert nn_j.max()<snj, 'Out of bounds j index calculated! j='+str(nn_j.max())+'snj='+str(snj)
-        assert nn_i.min()>=0, 'Negative i index calculated! i='+str(nn_i.min())
-        assert nn_i.max()<sni, 'Out of bounds i index calculated! i='+str(nn_i.max())+'sni='+str(sni)
-        return nn_i.astype(int),nn_j.astype(int)
-
-    def source_hits(self, xs, ys, singularity_radius=0.25):
-        """Returns an mask array of 1's if a cell with center (xs,ys) is intercepted by a node
-           on the mesh, 0 if no node falls in a cell"""
+        return xaxis.index(self.lon, backend=backend),yaxis.index(self.lat, backend=backend)
+
+    def find_nn_source(self, lon, lat, backend=None):
+        """Returns the i,j arrays for the indexes of the nearest neighbor point to grid (lon,lat).
+           The source grid may be uniform, see find_nn_uniform_source(), 1D non-uniform, or 2D.
+           For 2D sources, i and j are the column and row of the nearest source point.  The search
+           structures of non-uniform sources are kept for the most recently used sources."""
+        if len(lon.shape)==1 and uniform_axis(lon,period=360.) is not None and uniform_axis(lat) is not None:
+            return self.find_nn_uniform_source(lon,lat,backend=backend)
+        index = _source_index(lon,lat)
+        return index(np.asarray(self.lon),np.asarray(self.lat))
+
+    def source_hits(self, xs, ys, singularity_radius=0.25, backend=None):
+        """Returns a boolean mask array, True if a cell with center (xs,ys) is intercepted by a node
+           on the mesh, False if no node falls in a cell"""
         # Indexes of nearest xs,ys to each node on the mesh
-        i,j = self.find_nn_uniform_source(xs,ys)
-        sni,snj = xs.shape[0],ys.shape[0] # Shape of source
-        hits = np.zeros((snj,sni))
-        if singularity_radius>0: hits[np.abs(ys)>90-singularity_radius] = 1
-        hits[j,i] = 1
+        i,j = self.find_nn_source(xs,ys,backend=backend)
+        snj,sni = source_shape(xs,ys) # Shape of source
+        hits = np.zeros((snj,sni), dtype=bool)
+        if singularity_radius>0: hits[np.abs(ys)>90-singularity_radius] = True
+        hits[j,i] = True
         return hits
 
-    def refine_loop(self, src_lon, src_lat, max_stages=32, max_mb=500, verbose=True, singularity_radius=0.25):
+    def source_hit_count(self, xs, ys, singularity_radius=0.25, backend=None):
+        """Returns the number of cells with center (xs,ys) intercepted by a node on the mesh and the
+           total number of cells, the count and size of source_hits().  The boolean mask is the size
+           of the source grid so no mesh sized arrays are sorted or kept."""
+        hits = self.source_hits(xs, ys, singularity_radius=singularity_radius, backend=backend)
+        return int(np.count_nonzero(hits)), hits.size
+
+    def predict_refine_levels(self, src_lon, src_lat):
+        """Returns the number of refinements by 2 needed for the largest extent of a cell edge of the mesh,
+           in either longitude or latitude, to be no larger than the spacing of the source grid,
+           see refine_levels()."""
+        return refine_levels(self.lon, self.lat, src_lon, src_lat)
+
+    def refine_loop(self, src_lon, src_lat, max_stages=32, max_mb=500, verbose=True, singularity_radius=0.25, predict_levels=False,
+                    backend=None):
         """Repeatedly refines the mesh until all cells in the source grid are intercepted by mesh nodes.
-           Returns a list of the refined meshes starting with parent mesh."""
-        Mesh_list, this = [self], self
-        hits = this.source_hits(src_lon, src_lat, singularity_radius=singularity_radius)
-        nhits, prev_hits, mb = hits.sum().astype(int), 0, 2*8*this.shape[0]*this.shape[1]/1024/1024
-        if verbose: print(this, 'Hit', nhits, 'out of', hits.size, 'cells (%.4f'%mb,'Mb)')
+           Returns a list of the refined meshes starting with parent mesh.
+           If predict_levels is True, the number of refinements is predicted from the cell size
+           and the spacing of the source grid, see predict_refine_levels(), and the source hits are
+           only checked after the predicted refinements.  If not all source cells are hit, the
+           refinement continues as usual."""
+        Mesh_list, this = MeshHierarchy([self]), self
+        if predict_levels:
+            levels = this.predict_refine_levels(src_lon, src_lat)
+            if verbose: print(this, 'Predicted', levels, 'refinements')
+            mb = 2*8*this.shape[0]*this.shape[1]/1024/1024
+            while(len(Mesh_list)<=levels and len(Mesh_list)<max_stages and 4*mb<max_mb):
+                this = this.refineby2(backend=backend)
+                mb = 2*8*this.shape[0]*this.shape[1]/1024/1024
+                Mesh_list.append_level( this )
+        nhits, nsrc = this.source_hit_count(src_lon, src_lat, singularity_radius=singularity_radius, backend=backend)
+        prev_hits, mb = 0, 2*8*this.shape[0]*this.shape[1]/1024/1024
+        if verbose: print(this, 'Hit', nhits, 'out of', nsrc, 'cells (%.4f'%mb,'Mb)')
         # Conditions to refine
         # 1) Not all cells are intercepted
         # 2) A refinement intercepted more cells
-        converged = np.all(hits) or (nhits==prev_hits)
+        converged = (nhits==nsrc) or (nhits==prev_hits)
         while(not converged and len(Mesh_list)<max_stages and 4*mb<max_mb):
-            this = this.refineby2()
-            hits = this.source_hits(src_lon, src_lat, singularity_radius=singularity_radius)
-            nhits, prev_hits, mb = hits.sum().astype(int), nhits, 2*8*this.shape[0]*this.shape[1]/1024/1024
-            converged = np.all(hits) or (nhits==prev_hits)
+            this = this.refineby2(backend=backend)
+            prev_hits = nhits
+            nhits, nsrc = this.source_hit_count(src_lon, src_lat, singularity_radius=singularity_radius, backend=backend)
+            mb = 2*8*this.shape[0]*this.shape[1]/1024/1024
+            converged = (nhits==nsrc) or (nhits==prev_hits)
             if nhits>prev_hits:
-                Mesh_list.append( this )
-                if verbose: print(this, 'Hit', nhits, 'out of', hits.size, 'cells (%.4f'%mb,'Mb)')
+                Mesh_list.append_level( this )
+                if verbose: print(this, 'Hit', nhits, 'out of', nsrc, 'cells (%.4f'%mb,'Mb)')
 
         if not converged:
             print("Warning: Maximum number of allowed refinements reached without all source cells hit.")
 
+        for mesh in Mesh_list: mesh.release_xyz()
+
         return Mesh_list
 
-    def sample_source_data_on_target_mesh(self,xs,ys,zs):
-        """Returns the array on target mesh with values equal to the nearest-neighbor source point data"""
+    def sample_source_data_on_target_mesh(self,xs,ys,zs,dtype=np.float64,backend=None):
+        """Returns the array on target mesh with values equal to the nearest-neighbor source point data.
+           Only the first moments (xm,ym,zm) needed for calculating the roughness are kept, zm is the
+           height.  The second moments are formed by coarsenby2().  The height is stored with the
+           given dtype."""
         # Indexes of nearest xs,ys to each node on the mesh
-        i,j = self.find_nn_uniform_source(xs,ys)
-        self.height = np.zeros(self.lon.shape)
-        #self.height[:,:] = zs[j[:],i[:]]
-        self.height[:,:] = zs.data[j[:],i[:]]
-        self.h_std = np.zeros(self.lon.shape)
-        self.h_min = np.zeros(self.lon.shape)
-        self.h_max = np.zeros(self.lon.shape)
-
-	# Quantities needed for calculating the roughness
-        self.xm = np.zeros(self.lon.shape)
-        self.ym = np.zeros(self.lon.shape)
-        self.zm = np.zeros(self.lon.shape)
-        self.xxm = np.zeros(self.lon.shape)
-        self.yym = np.zeros(self.lon.shape)
-        self.xym = np.zeros(self.lon.shape)
-        self.xzm = np.zeros(self.lon.shape)
-        self.yzm = np.zeros(self.lon.shape)
-        #self.xm[:,:] = xs[i[:]]
-        self.xm[:,:] = xs.data[i[:]]
-        #self.ym[:,:] = ys[j[:]]
-        self.ym[:,:] = ys.data[j[:]]
-        # We just need a copy here
-        #self.zm[:,:] = zs[j[:],i[:]]
-        self.zm = self.height.copy()
-        self.xxm[:,:] = self.xm[:,:] * self.xm[:,:]
-        self.yym[:,:] = self.ym[:,:] * self.ym[:,:]
-        self.xym[:,:] = self.xm[:,:] * self.ym[:,:]
-        self.xzm[:,:] = self.xm[:,:] * self.zm[:,:]
-        self.yzm[:,:] = self.ym[:,:] * self.zm[:,:]
+        i,j = self.find_nn_source(xs,ys,backend=backend)
+
+        # Quantities needed for calculating the roughness
+        if len(xs.shape)==2:
+            self.height = np.asarray(zs)[j[:],i[:]].astype(dtype)
+            self.xm = np.asarray(xs)[j[:],i[:]].astype(np.float64)
+            self.ym = np.asarray(ys)[j[:],i[:]].astype(np.float64)
+        else:
+            self.height,self.xm,self.ym = kernels.gather_nn(zs,xs,ys,i,j,dtype=dtype,backend=backend)
+        # The height is not changed so a copy is not needed
+        self.zm = self.height
 
         return
 
-    def least_square_plane_estimate(self, xs,ys,zs):
+    def least_square_plane_estimate(self, xs, ys, zs, max_points=2**22):
+        """This function returns the estimates for h2 and h and also mean,min,max of the date
+           in each grid cell.  See least_square_plane_estimate_old() for the algorithm.
+
+           Each source point is assigned to the cells it falls in once, and the sums
+           of each cell are segmented reductions over these points.  Cells are processed in
+           strips of rows holding about max_points candidate source points.  The results
+           are the same as least_square_plane_estimate_old() to round off."""
+        epsilon=1.0e-5
+        #indices of nearest neighbor source point to each target mesh point
+        ti,tj = self.find_nn_uniform_source(xs,ys)
+        ti,tj = np.asarray(ti),np.asarray(tj)
+        lon,lat = np.asarray(self.lon),np.asarray(self.lat)
+        xs,ys,zs = np.asarray(xs),np.asarray(ys),np.asarray(zs)
+
+        #Bounds of each target cell and the indexes of the NN source cells, as in
+        #least_square_plane_estimate_old()
+        dlon=np.roll(lon,shift=-1,axis=1)-lon
+        dlat=np.roll(lat,shift=-1,axis=0)-lat
+        dti =np.roll(ti,shift=-1,axis=1)-ti
+        dtj =np.roll(tj,shift=-1,axis=0)-tj
+        dlon[:,-1]=dlon[:,-2]
+        dlat[-1,:]=dlat[-2,:]
+        dti[:,-1]=dti[:,-2]
+        dtj[-1,:]=dtj[-2,:]
+        ti_max=np.minimum(ti+dti,xs.shape[0]-1)
+        tj_max=np.minimum(tj+dtj,ys.shape[0]-1)
+        ncols=np.maximum(ti_max-ti+1,0)
+        nrows=np.maximum(tj_max-tj+1,0)
+
+        #Initialize to the NN source value
+        Zmean=zs[tj,ti].astype(np.float64)
+        Zmin =Zmean.copy()
+        Zmax =Zmean.copy()
+        Zstd =np.zeros(lon.shape)
+
+        #Strips of rows of cells
+        candidates=np.cumsum((nrows*ncols).sum(axis=1))
+        J0=0
+        while J0<lon.shape[0]:
+            J1=max(J0+1,np.searchsorted(candidates,candidates[J0]-(nrows[J0]*ncols[J0]).sum()+max_points,side='right'))
+            J1=min(J1,lon.shape[0])
+            sl=slice(J0,J1)
+            cell_std,cell_mean,cell_min,cell_max,cells,bad=MeshRefinement.__plane_fit_cells(
+                xs,ys,zs,lon[sl].ravel(),(lon+dlon)[sl].ravel(),lat[sl].ravel(),(lat+dlat)[sl].ravel(),
+                ti[sl].ravel(),ncols[sl].ravel(),tj[sl].ravel(),nrows[sl].ravel(),epsilon)
+            cells=np.unravel_index(cells,(J1-J0,lon.shape[1]))
+            cells=(cells[0]+J0,cells[1])
+            Zstd[cells]=cell_std
+            Zmean[cells]=cell_mean
+            Zmin[cells]=cell_min
+            Zmax[cells]=cell_max
+            for (c,dsum) in bad:
+                J,I=np.unravel_index(c,(J1-J0,lon.shape[1]))
+                print("Bad fit: The sum of Distances is large at ("+str(I)+","+str(J+J0)+") = "+str(dsum)+" compared to min  "+str(Zmin[J+J0,I]))
+            J0=J1
+
+        return Zstd,Zmean,Zmin,Zmax
+
+    def __plane_fit_cells(xs, ys, zs, lon_min, lon_max, lat_min, lat_max, ti_min, ncols, tj_min, nrows, epsilon):
+        """Private method.  Fits a least-square plane to the source points in each of the cells
+           given as 1D arrays.  Returns the standard deviation of the distance from the plane, the
+           mean, minimum and maximum of the source data for the cells with a plane, the indexes of
+           these cells and a list of (cell, sum of distances) for bad fits."""
+        ncell=lon_min.shape[0]
+        cell=np.arange(ncell)
+
+        def expand(start, count):
+            #Cell of each candidate index and the candidate index
+            c=np.repeat(cell,count)
+            offset=np.arange(c.shape[0])-np.repeat(np.cumsum(count)-count,count)
+            return c,start[c]+offset
+
+        #Source rows and columns that fall into each cell
+        rc,jj=expand(tj_min,nrows)
+        keep=(ys[jj]>=lat_min[rc]) & (ys[jj]<lat_max[rc])
+        rc,jj=rc[keep],jj[keep]
+        cc,ii=expand(ti_min,ncols)
+        keep=(xs[ii]>=lon_min[cc]) & (xs[ii]<lon_max[cc])
+        cc,ii=cc[keep],ii[keep]
+        vr=np.bincount(rc,minlength=ncell)
+        vc=np.bincount(cc,minlength=ncell)
+
+        #Source points of each cell, ordered by row then column
+        N=vr*vc
+        c=np.repeat(cell,N)
+        k=np.arange(c.shape[0])-np.repeat(np.cumsum(N)-N,N)
+        J=jj[(np.cumsum(vr)-vr)[c]+k//vc[c]]
+        I=ii[(np.cumsum(vc)-vc)[c]+k%vc[c]]
+        X,Y,Z=xs[I],ys[J],zs[J,I].astype(np.float64)
+
+        #Segmented reductions over the contiguous points of each non-empty cell
+        has=N>0
+        starts=(np.cumsum(N)-N)[has]
+        n=N[has]
+        def segsum(a):
+            return np.add.reduceat(a,starts) if a.shape[0]>0 else np.zeros(0)
+        xm=segsum(X)/n
+        ym=segsum(Y)/n
+        zm=segsum(Z)/n
+        dX=X-np.repeat(xm,n)
+        dY=Y-np.repeat(ym,n)
+        dZ=Z-np.repeat(zm,n)
+        sxx=segsum(dX*dX)
+        syy=segsum(dY*dY)
+        sxy=segsum(dX*dY)
+        syz=segsum(dY*dZ)
+        sxz=segsum(dX*dZ)
+
+        det=(sxx*syy-sxy*sxy)
+        ok=np.abs(det)>=epsilon #No solutions otherwise
+        det=np.where(ok,det,1.)
+        ax=(sxz*syy-syz*sxy)/det
+        ay=(syz*sxx-sxz*sxy)/det
+        d=dZ-np.repeat(ax,n)*dX-np.repeat(ay,n)*dY
+        dsum=segsum(d)
+        dd=d-np.repeat(dsum/n,n)
+        std=np.sqrt(segsum(dd*dd)/n)
+        zmin=np.minimum.reduceat(Z,starts) if Z.shape[0]>0 else np.zeros(0)
+        zmax=np.maximum.reduceat(Z,starts) if Z.shape[0]>0 else np.zeros(0)
+
+        cells=cell[has][ok]
+        bad=[(c,s) for (c,s) in zip(cells,dsum[ok]) if abs(s)>epsilon]
+        return std[ok],zm[ok],zmin[ok],zmax[ok],cells,bad
+
+    def least_square_plane_estimate_old(self, xs,ys,zs):
         """This function returns the estimates for h2 and h and also mean,min,max of the date
            in each grid cell. """
         """It estimates h and h2 passing a least-square plane through the data points in each grid cell."""
@@ -466,4 +898,34 @@ class MeshRefinement(object):
 
         return Zstd,Zmean,Zmin,Zmax
 
+class MeshHierarchy(list):
+    """A list of successively refined meshes starting with the parent mesh, as returned
+    by MeshRefinement.refine_loop().
+
+    Only what is needed for the next step is kept.  The coordinates of intermediate
+    meshes are released when a finer mesh is added.  The coordinates of the finest mesh
+    are released once the source data has been sampled.  The data of intermediate
+    meshes is released once it has been coarsened.  The parent mesh keeps its
+    coordinates and the finest mesh keeps its first moments (xm,ym,zm).
+    """
 
+    def append_level(self, mesh):
+        """Adds a finer mesh and releases the coordinates of the previous finest mesh,
+        unless it is the parent mesh."""
+        if len(self) > 1:
+            self[-1].release_coordinates()
+        self.append(mesh)
+
+    def sample(self, xs, ys, zs, dtype=np.float64, backend=None):
+        """Samples the source data (xs,ys,zs) on the finest mesh."""
+        self[-1].sample_source_data_on_target_mesh(xs, ys, zs, dtype=dtype, backend=backend)
+        if len(self) > 1:
+            self[-1].release_coordinates()
+
+    def coarsen(self, min_max=True, dtype=np.float64, backend=None):
+        """Coarsens the data of the finest mesh back to the parent mesh.  The minimum
+        and maximum height are only calculated if min_max is True."""
+        for i in reversed(range(1,len(self))):   # 1, makes it stop at element 1 rather than 0
+            self[i].coarsenby2(self[i-1], min_max=min_max, dtype=dtype, backend=backend)
+            if i < len(self)-1:
+                self[i].release_data()
@@ -20,7 +20,7 @@ def writeLandmask(grd, dsData, dsVariable, outVariable, outFile, **kwargs):
 
     dsDataset = xr.Dataset()
     dsDataset[outVariable] = xr.where(dsData[dsVariable] <= masking_depth, 1.0, 0.0)
-    dsDataset[outVariable].attrs['sha256'] = utils.sha256sum(dsDataset[outVariable])
+    utils.deferSha256sum(dsDataset[outVariable])
     # Try to copy coordinates from the supplied variable otherwise, try
     # the supplied grid.
     copyCoords = ['x', 'y']
@@ -31,6 +31,7 @@ def writeLandmask(grd, dsData, dsVariable, outVariable, outFile, **kwargs):
             if hasattr(grd, varCoord):
                 dsDataset[varCoord] = grd[varCoord]
 
+    utils.updateSha256sums(dsDataset)
     dsDataset.to_netcdf(outFile, encoding=grd.removeFillValueAttributes(data=dsDataset))
 
     return
@@ -52,7 +53,7 @@ def writeOceanmask(grd, dsData, dsVariable, outVariable, outFile, **kwargs):
 
     dsDataset = xr.Dataset()
     dsDataset[outVariable] = xr.where(dsData[dsVariable] > masking_depth, 1.0, 0.0)
-    dsDataset[outVariable].attrs['sha256'] = utils.sha256sum(dsDataset[outVariable])
+    utils.deferSha256sum(dsDataset[outVariable])
     # Try to copy coordinates from the supplied variable otherwise, try
     # the supplied grid.
     copyCoords = ['x', 'y']
@@ -63,4 +64,5 @@ def writeOceanmask(grd, dsData, dsVariable, outVariable, outFile, **kwargs):
             if hasattr(grd, varCoord):
                 dsDataset[varCoord] = grd[varCoord]
 
+    utils.updateSha256sums(dsDataset)
     dsDataset.to_netcdf(outFile, encoding=grd.removeFillValueAttributes(data=dsDataset))
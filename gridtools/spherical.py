@@ -4,6 +4,7 @@
 # Code to compute distances and angles on a sphere.
 # Based on code written by Alistair Adcroft and Matthew Harrison of GFDL
 
+import collections, concurrent.futures, multiprocessing
 import numpy
 
 def angle_through_center(p1, p2):
@@ -49,3 +50,109 @@ def quad_area(lat, lon):
     a2 = angle_between(c3, c2, c0)
     a3 = angle_between(c0, c3, c1)
     return a0 + a1 + a2 + a3 - 2. * numpy.pi
+
+def rotate_mesh(lam, phi, R):
+    """Rotates the mesh (lam,phi), in degrees, on the sphere by the rotation matrix R.
+    Returns the rotated mesh with longitudes in [0,360)."""
+    d2r = numpy.pi/180.
+    # Bring the angle to be in [-pi,pi] so that atan2 would work
+    lam = numpy.where(lam>180, lam-360, lam)
+    lam = lam * d2r
+    phi = phi * d2r
+    x = numpy.cos(phi) * numpy.cos(lam)
+    y = numpy.cos(phi) * numpy.sin(lam)
+    z = numpy.sin(phi)
+    xp = R[0,0]*x + R[0,1]*y + R[0,2]*z
+    yp = R[1,0]*x + R[1,1]*y + R[1,2]*z
+    zp = R[2,0]*x + R[2,1]*y + R[2,2]*z
+    del x, y, z
+    # Change back to polar coords using atan2, in [-pi,pi]
+    lamp = numpy.arctan2(yp, xp)/d2r
+    phip = numpy.arctan(zp/numpy.sqrt(xp**2+yp**2))/d2r
+    # Bring the angle back to be in [0,2*pi]
+    lamp = numpy.where(lamp<0, lamp+360, lamp)
+    return lamp, phip
+
+class RotatedLatLonMesh(object):
+    """Regular lat-lon mesh with 1D coordinates (lon,lat), in degrees, rotated on the sphere
+    by the rotation matrix R.  Rows of the mesh are generated on demand so that large
+    meshes can be processed in blocks of rows."""
+    def __init__(self, lon, lat, R):
+        self.lon = numpy.asarray(lon, dtype=numpy.float64)
+        self.lat = numpy.asarray(lat, dtype=numpy.float64)
+        self.R = numpy.asarray(R, dtype=numpy.float64)
+        self.shape = (self.lat.shape[0], self.lon.shape[0])
+
+    def rows(self, j0, j1):
+        """Returns the rows j0:j1 of the rotated mesh (lam,phi) with longitudes in [0,360)."""
+        lam = numpy.tile(self.lon, (j1-j0, 1))
+        phi = numpy.tile(self.lat[j0:j1].reshape((j1-j0, 1)), (1, self.lon.shape[0]))
+        return rotate_mesh(lam, phi, self.R)
+
+class ArrayMesh(object):
+    """Mesh with 2D coordinates (lon,lat), in degrees, that are already in memory.  This
+    provides the same rows() interface as RotatedLatLonMesh."""
+    def __init__(self, lon, lat):
+        self.lon = numpy.asarray(lon, dtype=numpy.float64)
+        self.lat = numpy.asarray(lat, dtype=numpy.float64)
+        self.shape = self.lat.shape
+
+    def rows(self, j0, j1):
+        """Returns the rows j0:j1 of the mesh (lam,phi)."""
+        return self.lon[j0:j1], self.lat[j0:j1]
+
+def grid_metrics(lat, lon, R):
+    """Returns the MOM6 grid metrics (dx, dy, angle_dx, area) of a supergrid with vertices
+    (lat,lon) in degrees on a sphere of radius R.  Edge lengths are great arcs.  dy and area
+    have one row less than the vertices."""
+    dx = R * angle_through_center( (lat[ :,1:],lon[ :,1:]), (lat[:  ,:-1],lon[:  ,:-1]) )
+    dy = R * angle_through_center( (lat[1:, :],lon[1:, :]), (lat[:-1,:  ],lon[:-1,:  ]) )
+
+    # Fix lon so they are 0 to 360 for computation of angle_dx
+    cos_lat = numpy.cos(numpy.radians(lat))
+    lon360 = numpy.where(lon < 0., lon+360, lon)
+    angle_dx = numpy.zeros(lat.shape)
+    angle_dx[:,1:-1] = numpy.arctan2( (lat[:,2:] - lat[:,:-2]) , ((lon360[:,2:] - lon360[:,:-2]) * cos_lat[:,1:-1]) )
+    angle_dx[:, 0  ] = numpy.arctan2( (lat[:, 1] - lat[:, 0 ]) , ((lon360[:, 1] - lon360[:, 0 ]) * cos_lat[:, 0  ]) )
+    angle_dx[:,-1  ] = numpy.arctan2( (lat[:,-1] - lat[:,-2 ]) , ((lon360[:,-1] - lon360[:,-2 ]) * cos_lat[:,-1  ]) )
+    angle_dx = numpy.maximum(0., angle_dx)
+
+    area = R * R * quad_area(lat, lon360)
+    return dx, dy, angle_dx, area
+
+def grid_block(mesh, j0, j1, R=None):
+    """Returns the vertices (x,y) in rows j0:j1 of the mesh (RotatedLatLonMesh or ArrayMesh)
+    with longitudes in [-180,180] and, if R is not None, their grid metrics (see grid_metrics()).  The next
+    row of the mesh is used as a halo for dy and area, which are missing for the last row."""
+    jh = min(j1+1, mesh.shape[0])
+    lam, phi = mesh.rows(j0, jh)
+    lam = numpy.where(lam > 180.0, lam - 360.0, lam)
+    n = j1 - j0
+    block = {'x': lam[:n], 'y': phi[:n]}
+    if R is not None:
+        dx, dy, angle_dx, area = grid_metrics(phi, lam, R)
+        block.update(dx=dx[:n], dy=dy, angle_dx=angle_dx[:n], area=area)
+    return block
+
+def grid_blocks(mesh, block_rows, R=None, workers=1):
+    """Generates (j0, j1, block) for consecutive blocks of block_rows rows of the mesh, in
+    order, where block is returned by grid_block().  With workers > 1, blocks of a
+    RotatedLatLonMesh are computed by a pool of processes with at most 2*workers blocks
+    in flight.  The processes are spawned rather than forked."""
+    bounds = [(j0, min(j0+block_rows, mesh.shape[0])) for j0 in range(0, mesh.shape[0], block_rows)]
+    if workers <= 1 or not isinstance(mesh, RotatedLatLonMesh):
+        for (j0, j1) in bounds:
+            yield j0, j1, grid_block(mesh, j0, j1, R)
+        return
+    # Spawn the workers: a fork of a process running numba threads may hang
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn')) as pool:
+        pending = collections.deque()
+        for (j0, j1) in bounds:
+            pending.append((j0, j1, pool.submit(grid_block, mesh, j0, j1, R)))
+            if len(pending) >= 2*workers:
+                j0, j1, future = pending.popleft()
+                yield j0, j1, future.result()
+        while pending:
+            j0, j1, future = pending.popleft()
+            yield j0, j1, future.result()
@@ -1,5 +1,5 @@
 # General imports and definitions
-import os, sys, datetime, logging
+import os, sys, datetime, logging, hashlib, collections
 import xesmf as xe
 import xarray as xr
 import numpy as np
@@ -7,6 +7,120 @@ import pdb
 
 # Referencing other internal routines
 from . import datasource
+from . import meshrefinement
+
+# Regridders from recent calls to regridTopo() keyed by regridder_key()
+_regridder_cache = collections.OrderedDict()
+_regridder_cache_size = 4
+
+def regridder_key(dsIn, dsOut, method, periodic):
+    """Returns a sha256 hash of the source and target coordinates
+    (lon, lat, lon_b, lat_b), regrid method and periodicity that
+    determine the weights of a regridder."""
+    h = hashlib.sha256()
+    for ds in (dsIn, dsOut):
+        for v in ('lon', 'lat', 'lon_b', 'lat_b'):
+            if v in ds.variables:
+                a = np.ascontiguousarray(ds[v].values, dtype=np.float64)
+                h.update(("%s%s" % (v, a.shape)).encode('utf-8'))
+                h.update(a.tobytes())
+    h.update(repr((method, bool(periodic))).encode('utf-8'))
+    return h.hexdigest()
+
+def get_regridder(grd, dsIn, dsOut, method, periodic, cacheDir=None):
+    """Returns a xesmf.Regridder from dsIn to dsOut.  Regridders are
+    reused from an in-process cache of recent regridders or from weights
+    saved in cacheDir.  If cacheDir is None, the environment variable
+    GRIDTOOLS_CACHE_DIR is used.  New weights are saved to cacheDir, if
+    defined."""
+
+    key = regridder_key(dsIn, dsOut, method, periodic)
+    if key in _regridder_cache:
+        _regridder_cache.move_to_end(key)
+        msg = ("Reusing %s regridder weights (%s)." % (method, key[:12]))
+        grd.printMsg(msg, level=logging.INFO)
+        return _regridder_cache[key]
+
+    if cacheDir is None:
+        cacheDir = os.environ.get('GRIDTOOLS_CACHE_DIR', None)
+    weightsFile = None
+    if cacheDir:
+        weightsFile = os.path.join(cacheDir, "xesmf_%s_%s.nc" % (method, key))
+
+    regridder = None
+    if weightsFile and os.path.isfile(weightsFile):
+        try:
+            regridder = xe.Regridder(dsIn, dsOut, method=method, periodic=periodic, weights=weightsFile)
+            msg = ("Using %s regridder weights from %s." % (method, weightsFile))
+            grd.printMsg(msg, level=logging.INFO)
+        except Exception as e:
+            msg = ("WARNING: Unable to read regridder weights from %s (%s); regenerating." % (weightsFile, e))
+            grd.printMsg(msg, level=logging.WARNING)
+
+    if regridder is None:
+        regridder = xe.Regridder(dsIn, dsOut, method=method, periodic=periodic)
+        if weightsFile:
+            # Write under a temporary name so an interrupted write never
+            # leaves a partial weights file behind
+            os.makedirs(cacheDir, exist_ok=True)
+            tmpName = "%s.tmp%d" % (weightsFile, os.getpid())
+            regridder.to_netcdf(tmpName)
+            os.replace(tmpName, weightsFile)
+            msg = ("Saved %s regridder weights to %s." % (method, weightsFile))
+            grd.printMsg(msg, level=logging.INFO)
+
+    _regridder_cache[key] = regridder
+    while len(_regridder_cache) > _regridder_cache_size:
+        _regridder_cache.popitem(last=False)
+
+    return regridder
+
+def auto_coarsen_factor(topoLon, topoLat, gridLon, gridLat, cellsPerTarget=4):
+    """Returns a coarsening factor for topography with 1D coordinates
+    topoLon and topoLat so that there are about cellsPerTarget coarsened
+    topography cells across the smallest cell of a grid with corners
+    gridLon and gridLat (degrees)."""
+
+    def spacing(a, axis=-1):
+        d = np.abs(np.diff(np.asarray(a, dtype=np.float64), axis=axis))
+        d = np.where(d > 180., 360. - d, d)
+        d = d[d > 0]
+        if d.size == 0:
+            return np.inf
+        return d.min()
+
+    topoSpacing = max(np.median(np.abs(np.diff(topoLon))), np.median(np.abs(np.diff(topoLat))))
+    gridSpacing = min(spacing(gridLon, axis=-1), spacing(gridLat, axis=0))
+    if not(np.isfinite(gridSpacing)) or topoSpacing <= 0:
+        return 1
+
+    return max(1, int(gridSpacing / topoSpacing / cellsPerTarget))
+
+def coarsen_window(i0, i1, n, factor, halo=2):
+    """Returns a slice of an axis of length n covering indices i0 to i1
+    (in either order) plus halo coarsened cells on either side.  The
+    ends are aligned to multiples of factor, or the end of the axis."""
+    if i0 > i1:
+        i0, i1 = i1, i0
+    start = max(0, (i0 // factor - halo) * factor)
+    stop = min(n, (i1 // factor + 1 + halo) * factor)
+    return slice(start, stop)
+
+def stack_topo_fields(elev, topoVarName):
+    """Returns the topography elev (ny, nx) and its ocean fraction stacked
+    along a 'field' dimension so both are regridded with a single sparse
+    matrix multiply.  Ocean cells are 1 and land cells are 0; positive
+    depths below 0.000001 are kept as a fraction."""
+    fields = np.empty((2,) + elev.shape, dtype=elev.dtype)
+    fields[0] = elev
+
+    # The ocean fraction is filled in place
+    lm_ds = fields[1]
+    lm_ds[:] = 0.0
+    np.copyto(lm_ds, elev, where=elev > 0)
+    np.copyto(lm_ds, 1.0, where=elev >= 0.000001)
+
+    return xr.DataArray(fields, dims=('field', 'ny', 'nx'), coords={'field': [topoVarName, 'mask']})
 
 class TopoUtils(object):
 
@@ -19,6 +133,9 @@ class TopoUtils(object):
 
     # Functions called from within a class need self as the first argument
     def find_nearest(self, array, value):
+        axis = meshrefinement.uniform_axis(array)
+        if axis is not None:
+            return int(axis.index(value))
         array = np.asarray(array)
         idx = (np.abs(array - value)).argmin()
         return idx
@@ -31,7 +148,8 @@ class TopoUtils(object):
         topoVarName = "elevation", coarsenInt = 10, method = 'conservative',
         superGrid = True, periodic = True, gridDimX = None, gridDimY = None,
         gridLatName = None, gridLonName = None, topoDimX = None, topoDimY = None,
-        topoLatName = None, topoLonName = None, convert_to_depth = True):
+        topoLatName = None, topoLonName = None, convert_to_depth = True,
+        weightsCacheDir = None):
         """Regrid topography file to the grid of a given grid file. It is
         assumed that the topography file is on a rectangular grid and has a
         finer resolution than the grid file. It is also assumed that the
@@ -57,13 +175,17 @@ class TopoUtils(object):
               elevation. If it is not representing elevation, please set
               'convert_to_depth' to False.
             * coarsenInt: Integer value used to decrease resolution of a
-              given topography file - see `xarray.coarsen`
+              given topography file - see `xarray.coarsen`.  Use 'auto' to
+              choose the largest factor that keeps about four coarsened
+              topography cells across the smallest grid cell.  See
+              :py:func:`auto_coarsen_factor`.
             * superGrid: When true, this assumes the gridFile is a supergrid
               and the resulting topography is coarsened to a regular grid.  Not
               currently implemented.
             * method: Regrid method of xesmf regridder. Options are 'conservative',
               'bilinear', 'nearests2d', 'nearestd2s' or 'patch'.  See:
               `pangeo-xesmf regridding options <https://pangeo-xesmf.readthedocs.io/en/latest/notebooks/Compare_algorithms.html>`_.
+              The 'blockaverage' method does not use xesmf, see :py:meth:`blockAverageTopo`.
             * periodic: Boolean, either True or False - When dealing with global
               grids, we need to set periodic=True, otherwise data along the
               meridian line will be missing.
@@ -75,6 +197,11 @@ class TopoUtils(object):
             * topoDimY: The name of the dimension along the Y axis of the topography file
             * topoLatName: The name of the latitude variable within the topography file
             * topoLonName: The name of the longitude variable within the topography file
+            * weightsCacheDir: Directory where regridder weights are saved and
+              reused by later calls with the same source window, grid, method
+              and periodicity.  Defaults to the environment variable
+              GRIDTOOLS_CACHE_DIR.  Regridders are also reused within a
+              python session without a cache directory.
 
         """
 
@@ -295,9 +422,6 @@ class TopoUtils(object):
             else:
                 print ('Error: plase define topoDimY')
 
-        # coarsen topo file down based on coarsenInt
-        topo = topo.coarsen(nx=coarsenInt,ny=coarsenInt, boundary='pad').mean()
-
         if 'lat_centers' not in topo.variables:
             if topoLatName != None:
                 topo = topo.rename({topoLatName: 'lat_centers'})
@@ -316,11 +440,44 @@ class TopoUtils(object):
                 topo = topo.rename({'x': 'lon_centers'})
             elif 'lon' in topo.variables:
                 topo = topo.rename({'lon': 'lon_centers'})
-            elif 'longitude' in grid.variables:
+            elif 'longitude' in topo.variables:
                 topo = topo.rename({'longitude': 'lon_centers'})
             else:
                 print('Error: Please define gridLonName')
 
+        # Only read the part of the topography covering the grid.  The window
+        # is aligned to coarsenInt so the coarsened cells are the same as if
+        # the whole topography was coarsened.
+        topoLon = topo['lon_centers'].values
+        topoLat = topo['lat_centers'].values
+        gridLonName = 'lon_centers'
+        gridLatName = 'lat_centers'
+        if method == 'blockaverage':
+            # The topography is averaged at full resolution over the whole grid cells
+            coarsenInt = 1
+            gridLonName = 'lon_corners'
+            gridLatName = 'lat_corners'
+        if coarsenInt == 'auto':
+            coarsenInt = auto_coarsen_factor(topoLon, topoLat, grid['lon_corners'].values, grid['lat_corners'].values)
+            msg = ("Automatic topography coarsening factor: %d" % (coarsenInt))
+            grd.printMsg(msg, level=logging.INFO)
+
+        topoLon = np.where(topoLon > 180., topoLon - 360, topoLon)
+        latMinInd = self.find_nearest(array = topoLat, value = np.min(grid[gridLatName].values))
+        latMaxInd = self.find_nearest(array = topoLat, value = np.max(grid[gridLatName].values))
+        lonMinInd = self.find_nearest(array = topoLon, value = np.min(grid[gridLonName].values))
+        lonMaxInd = self.find_nearest(array = topoLon, value = np.max(grid[gridLonName].values))
+        nySlice = coarsen_window(latMinInd, latMaxInd, len(topoLat), coarsenInt)
+        nxSlice = coarsen_window(lonMinInd, lonMaxInd, len(topoLon), coarsenInt)
+        topo = topo.isel(nx=nxSlice, ny=nySlice)
+        msg = ("Using topography window nx=%d:%d ny=%d:%d of %dx%d points." %
+            (nxSlice.start, nxSlice.stop, nySlice.start, nySlice.stop, len(topoLon), len(topoLat)))
+        grd.printMsg(msg, level=logging.INFO)
+
+        # coarsen topo file down based on coarsenInt
+        if method != 'blockaverage':
+            topo = topo.coarsen(nx=coarsenInt,ny=coarsenInt, boundary='pad').mean()
+
         # if longitudes are 0 to 360, convert to -180 to 180
         if "lon_centers" in topo.coords:
             topo = topo.assign_coords(lon_centers=(np.where(topo['lon_centers'].values > 180., topo['lon_centers'].values - 360, topo['lon_centers'].values)))
@@ -328,6 +485,9 @@ class TopoUtils(object):
         if "lon_centers" in topo.data_vars:
             topo['lon_centers'].values =  np.where(topo['lon_centers'].values > 180., topo['lon_centers'].values - 360, topo['lon_centers'].values)
 
+        if method == 'blockaverage':
+            return self.blockAverageTopo(grd, grid, topo, topoVarName, superGrid = superGrid)
+
         # Function calls within a class need self.()
         latMinInd = self.find_nearest(array = topo.lat_centers.values, value = np.min(grid.lat_centers.values))
         latMaxInd = self.find_nearest(array = topo.lat_centers.values, value = np.max(grid.lat_centers.values))
@@ -392,25 +552,17 @@ class TopoUtils(object):
         grid["lat"] = grid["lat_centers"]
         grid["lon_b"] = grid["lon_corners"]
         grid["lat_b"] = grid["lat_corners"]
-        # create xarray data array of the topography variable name containing the topographic elevation data
-        ds = topo[topoVarName]
-
         # Because we are now using depth some conditions are flipped below?
 
-        # create ocean fraction array where ocean cells are 1 and land cells are 0
-        #lm_ds = topo[topoVarName].where(topo[topoVarName] < 0)
-        lm_ds = topo[topoVarName].where(topo[topoVarName] > 0)
-        lm_ds = lm_ds.fillna(0)
-        #lm_ds = lm_ds.where(lm_ds > -0.000001)
-        lm_ds = lm_ds.where(lm_ds < 0.000001)
-        lm_ds = lm_ds.fillna(1)
-        lm_ds.name = 'mask'
-        lm_ds.attrs['units'] = 'ocean fraction at T-cell centers'
+        # The topography and ocean fraction are regridded together
+        fields = stack_topo_fields(topo[topoVarName].values, topoVarName)
 
         # regrid our topography and land/ocean mask based on method
-        regridder = xe.Regridder(topo, grid, method=method, periodic=periodic)
-        topo_out = regridder(ds)
-        lm_ds_out = regridder(lm_ds)
+        regridder = get_regridder(grd, topo, grid, method, periodic, cacheDir=weightsCacheDir)
+        fields_out = regridder(fields)
+        topo_out = fields_out.isel(field=0, drop=True)
+        lm_ds_out = fields_out.isel(field=1, drop=True)
+        lm_ds_out.name = 'mask'
 
         # MOM6 really does not care about masking about heights over land
         #topo_out = topo_out.where(topo_out < 0.0000001)
@@ -442,3 +594,61 @@ class TopoUtils(object):
         resultFields['ocean_mask'] = lm_ds_out
 
         return resultFields
+
+    def blockAverageTopo(self, grd, grid, topo, topoVarName, superGrid = True):
+        """Average topography onto the cells of a grid without constructing
+        regridding weights.  This is used by :py:meth:`regridTopo` for
+        ``method='blockaverage'`` and suits topography that is much finer
+        than the grid.
+
+        Each topography point is assigned to the grid cell containing it and
+        the depth, ocean fraction, minimum and maximum depth of each cell are
+        computed from the points in the cell weighted by their area.  The
+        topography is read in strips of rows.
+        See :py:func:`~gridtools.meshrefinement.block_average`.
+
+        Parameters:
+          grd: grid class object
+          grid: grid with 'lon_corners' and 'lat_corners'
+          topo: topography with 1D 'lon_centers' and 'lat_centers'
+          topoVarName: name of the depth variable in topo
+
+        **Keyword arguments**:
+
+            * superGrid: When true, the grid is a supergrid and the
+              topography is averaged over the cells of the regular grid.
+
+        Returns a dataset with 'depth', 'ocean_mask', 'hMin' and 'hMax'.
+        """
+
+        lonCorners = grid['lon_corners'].values
+        latCorners = grid['lat_corners'].values
+        if superGrid == True:
+            lonCorners = lonCorners[::2,::2]
+            latCorners = latCorners[::2,::2]
+
+        msg = ("Averaging %dx%d topography points onto %dx%d grid cells." %
+            (topo.sizes['nx'], topo.sizes['ny'], lonCorners.shape[1]-1, lonCorners.shape[0]-1))
+        grd.printMsg(msg, level=logging.INFO)
+
+        depth, frac, hMin, hMax = meshrefinement.block_average(lonCorners, latCorners,
+            topo['lon_centers'].values, topo['lat_centers'].values,
+            topo[topoVarName].transpose('ny', 'nx'))
+
+        # Cells without topography points are treated as land
+        topo_out = xr.DataArray(depth, dims=('ny', 'nx'))
+        topo_out = topo_out.where(topo_out > 0.0000001)
+        topo_out = topo_out.fillna(0)
+        topo_out.name = 'depth'
+        topo_out.attrs['units'] = 'm'
+
+        lm_ds_out = xr.DataArray(frac, dims=('ny', 'nx')).fillna(0)
+        lm_ds_out.attrs['units'] = 'ocean fraction at T-cell centers'
+
+        resultFields = xr.Dataset()
+        resultFields['depth'] = topo_out
+        resultFields['ocean_mask'] = lm_ds_out
+        resultFields['hMin'] = xr.DataArray(hMin, dims=('ny', 'nx'), attrs={'units': 'm'})
+        resultFields['hMax'] = xr.DataArray(hMax, dims=('ny', 'nx'), attrs={'units': 'm'})
+
+        return resultFields
@@ -3,10 +3,14 @@
 Generic utility functions
 '''
 
-import copy, datetime, hashlib, platform, subprocess, sys
+import concurrent.futures, copy, datetime, hashlib, platform, subprocess, sys
 import numpy as np
 from . import sysinfo
 
+# Value of a sha256 attribute that is computed when the data is written.
+# See deferSha256sum() and updateSha256sums().
+SHA256_DEFERRED = 'deferred'
+
 def checkArgument(vDict, vKey, vVal):
     '''
     This checks to see if there is a key in the passed dictionary.  If the
@@ -111,6 +115,55 @@ def runningHow():
 
 def sha256sum(xrData):
     """Utility function that returns a hash of the data provided.
+
+    The hash is that of the data in C order.  Contiguous arrays are hashed
+    in place without a copy and dask arrays are computed and hashed one
+    block of rows at a time.
+    """
+
+    # Unwrap xarray variables and data arrays
+    data = xrData.data if hasattr(xrData, 'dims') else xrData
+
+    sha = hashlib.sha256()
+    if hasattr(data, 'dask') and data.ndim > 0:
+        rows = np.cumsum((0,) + data.chunks[0])
+        for j0, j1 in zip(rows[:-1], rows[1:]):
+            sha.update( np.ascontiguousarray( data[j0:j1].compute() ) )
+    else:
+        sha.update( np.ascontiguousarray( np.asarray( data ) ) )
+
+    return sha.hexdigest()
+
+def sha256sums(xrDataList, maxWorkers=None):
+    """Utility function that returns a list of hashes, see :func:`sha256sum`,
+    of the data provided.  The hashes are computed in a pool of threads;
+    hashlib releases the GIL while hashing large buffers.
     """
 
-    return hashlib.sha256( np.array( xrData ) ).hexdigest()
+    if len(xrDataList) < 2:
+        return [sha256sum(xrData) for xrData in xrDataList]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers) as pool:
+        return list(pool.map(sha256sum, xrDataList))
+
+def deferSha256sum(xrData):
+    """Utility function that marks the sha256 attribute of a variable or
+    data array to be computed when it is written, see :func:`updateSha256sums`.
+    """
+
+    xrData.attrs['sha256'] = SHA256_DEFERRED
+
+def updateSha256sums(dsData, maxWorkers=None):
+    """Utility function that computes the deferred sha256 attributes of the
+    variables of a dataset, or of a data array, in a pool of threads.
+    This is called before writing a dataset to a file.
+    """
+
+    if hasattr(dsData, 'variables'):
+        xrVars = list(dsData.variables.values())
+    else:
+        xrVars = [dsData]
+    xrVars = [xrVar for xrVar in xrVars if xrVar.attrs.get('sha256', None) == SHA256_DEFERRED]
+
+    for (xrVar, varHash) in zip(xrVars, sha256sums(xrVars, maxWorkers=maxWorkers)):
+        xrVar.attrs['sha256'] = varHash
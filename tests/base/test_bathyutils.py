@@ -0,0 +1,236 @@
+# Check partitioning of a target grid into blocks for the
+# bathymetric roughness calculation.
+import numpy as np
+from gridtools import bathyutils
+
+def test_blocks_roundtrip():
+    a = np.arange(21*33, dtype=float).reshape(21, 33)
+    for (yb, xb) in [(1, 1), (1, 4), (3, 2), (5, 7)]:
+        for halo in [0, 1]:
+            blocks = bathyutils.break_array_to_blocks(a, xb, yb, halo=halo)
+            assert len(blocks) == xb*yb
+            b = bathyutils.undo_break_array_to_blocks(blocks, xb, yb, halo=halo)
+            assert np.array_equal(a, b)
+
+def test_plan_blocks():
+    # A small grid fits into a single block
+    assert bathyutils.plan_blocks((20, 24), max_mb=8000, refine_factor=4) == (1, 1)
+    # A large refinement requires more blocks; each block must fit
+    yb, xb = bathyutils.plan_blocks((200, 400), max_mb=100, refine_factor=16)
+    assert yb*xb > 1
+    bj = max(200//yb + 1, 200//yb + 200%yb)
+    bi = max(400//xb + 1, 400//xb + 400%xb)
+    assert 2*8*(16*(bj-1)+1)*(16*(bi-1)+1)/1024/1024 < 100
+
+def test_source_window_shift():
+    import xarray as xr
+    lon = np.arange(0.5, 360.0, 1.0)
+    elv = xr.DataArray(np.arange(10*360, dtype=float).reshape(10, 360), dims=('lat', 'lon'))
+    shift = 250
+    # Compare with rolling the whole array
+    rlon = np.roll(lon, -shift)
+    rlon = np.where(rlon >= rlon[0], rlon-360, rlon)
+    relv = np.roll(elv.values, -shift, axis=1)
+    slon = bathyutils.shift_source_longitudes(xr.DataArray(lon, dims=('lon',)), shift)
+    assert np.array_equal(slon.values, rlon)
+    for (i0, i1) in [(0, 5), (100, 110), (105, 115), (110, 200), (0, 360)]:
+        w = bathyutils.read_source_window(elv, slice(2, 7), slice(i0, i1), lon_shift=shift)
+        assert np.array_equal(w.values, relv[2:7,i0:i1])
+
+def test_plane_residual_std():
+    # Compare with the residual on the padded, fully refined mesh
+    rng = np.random.default_rng(1)
+    nj, ni, rf = 5, 7, 4
+    xs, ys, zs = [rng.standard_normal((rf*(nj-1)+1, rf*(ni-1)+1)) for n in range(3)]
+    xm, ym, zm, alphd, betad = [rng.standard_normal((nj, ni)) for n in range(5)]
+    denom = rng.random((nj, ni)) + 0.5
+    rep = lambda a: bathyutils.refine_by_repeat(a, rf)
+    pad = lambda a: bathyutils.extend_by_zeros(a, (rf*nj, rf*ni))
+    D = rep(denom)*(pad(zs)-rep(zm)) - rep(alphd)*(pad(xs)-rep(xm)) - rep(betad)*(pad(ys)-rep(ym))
+    expected = D.reshape((nj, rf, ni, rf)).std(axis=(1,3))
+    for max_elements in [1, 2*rf*rf*ni, 2**22]:
+        std = bathyutils.plane_residual_std(xs, ys, zs, xm, ym, zm, alphd, betad, denom, rf,
+                max_elements=max_elements)
+        assert np.array_equal(std, expected)
+    std = bathyutils.plane_residual_std(xs, ys, zs, xm, ym, zm, alphd, betad, denom, rf, backend='numba')
+    assert np.allclose(std, expected, rtol=1e-12, atol=0)
+
+def test_ice9():
+    # Compare with a flood fill from each seed
+    class Grid:
+        def printMsg(self, msg, level=None):
+            pass
+    rng = np.random.default_rng(4)
+    depth = rng.standard_normal((30, 40)) + 0.2
+    def flood(seeds, periodic, tripolar):
+        nj, ni = depth.shape
+        wet = np.zeros(depth.shape, dtype=bool)
+        stack = list(seeds)
+        while stack:
+            (j, i) = stack.pop()
+            if wet[j,i] or depth[j,i] <= 0: continue
+            wet[j,i] = True
+            neighbors = [(j, i-1), (j, i+1), (j-1, i), (j+1, i)]
+            if tripolar and j == nj-1: neighbors.append((j, ni-1-i))
+            for (jj, ii) in neighbors:
+                if periodic: ii = ii % ni
+                if 0 <= jj < nj and 0 <= ii < ni: stack.append((jj, ii))
+        return wet
+    seeds = [(int(j), int(i)) for (j, i) in rng.integers(0, 30, (5, 2))]
+    for periodic in [False, True]:
+        for tripolar in [False, True]:
+            wetMask = bathyutils.ice9(Grid(), depth=depth, ocean_seeds=seeds, periodic=periodic,
+                    tripolar=tripolar)
+            expected = flood(seeds, periodic, tripolar)
+            assert np.array_equal(wetMask.values, expected)
+            assert wetMask.attrs['ocean_points'] == expected.sum()
+            assert wetMask.attrs['wet_points'] == (depth > 0).sum()
+
+def test_ice9_sweep():
+    # Compare with ice9 for each masking depth
+    class Grid:
+        def printMsg(self, msg, level=None):
+            pass
+    rng = np.random.default_rng(5)
+    depth = np.cumsum(np.cumsum(rng.standard_normal((25, 35)), axis=0), axis=1)*10
+    area = rng.random(depth.shape)
+    maskingDepths = np.append(np.round(rng.choice(depth.ravel(), 8)), [-1e9, 1e9])
+    # Few seeds, and many seeds with several in the same basins and some on land
+    fewSeeds = [(3, 4), (20, 30), (12, 2)]
+    manySeeds = [(int(j), int(i)) for (j, i) in zip(rng.integers(0, 25, 40), rng.integers(0, 35, 40))]
+    for (seeds, periodic, tripolar) in [(fewSeeds, False, False), (fewSeeds, True, False),
+            (fewSeeds, False, True), (fewSeeds, True, True), (manySeeds, False, False), (manySeeds, True, True)]:
+        sweep = bathyutils.ice9Sweep(Grid(), depth=depth, ocean_seeds=seeds, maskingDepths=maskingDepths,
+                periodic=periodic, tripolar=tripolar, area=area)
+        for (n, maskingDepth) in enumerate(maskingDepths):
+            wetMask = bathyutils.ice9(Grid(), depth=depth, ocean_seeds=seeds, periodic=periodic,
+                    tripolar=tripolar, MASKING_DEPTH=maskingDepth)
+            for name in ['wet_points', 'components', 'seeded_components', 'ocean_points']:
+                assert sweep[name][n] == wetMask.attrs[name]
+            assert np.isclose(sweep['ocean_area'][n], (area*wetMask.values).sum())
+
+def test_apply_mask_rules():
+    rng = np.random.default_rng(7)
+    depth = rng.uniform(-20.0, 50.0, (15, 21))
+    mask = (rng.random((15, 21)) > 0.5).astype(float)
+    mask[0, 0] = np.nan
+    # Land mask (1 = land) with masking depth shallower than minimum depth
+    new, (i, j, old, z), counts = bathyutils.apply_mask_rules(depth, mask, 5.0, 10.0, land_value=1)
+    land = mask == 1
+    ocean = mask == 0
+    assert np.all(new[land] <= 5.0)
+    assert np.all(new[ocean] >= 10.0)
+    assert new[0, 0] == depth[0, 0]
+    assert counts.sum() == len(i) == np.count_nonzero(new != depth)
+    # The edits reproduce the new depth from the original
+    edited = depth.copy()
+    edited[j, i] = z
+    assert np.array_equal(edited, new)
+    assert np.array_equal(old, depth[j, i])
+    # Ocean mask (0 = land) with masking depth equal to minimum depth
+    new, edits, counts = bathyutils.apply_mask_rules(depth, mask, 0.0, 0.0, epsilon=1.0e-3, land_value=0)
+    assert np.all(new[mask == 1] > 0.0)
+    assert np.all(new[mask == 0] <= 0.0)
+    assert counts[2] == 0
+
+def roughness_case(tmp_path):
+    # A small regional supergrid and an analytic data source
+    import xarray as xr
+    from gridtools.gridutils import GridUtils
+    lon = np.arange(0.05, 120., 0.1)
+    lat = np.arange(20.05, 40., 0.1)
+    x, y = np.meshgrid(lon, lat)
+    depth = -4000.*np.sin(np.deg2rad(7.*x))*np.cos(np.deg2rad(11.*y)) + 100.*np.cos(np.deg2rad(97.*x*y))
+    xr.Dataset({'depth': (('lat', 'lon'), depth)}, coords={'lon': lon, 'lat': lat}).to_netcdf(tmp_path / 'topo.nc')
+    grd = GridUtils()
+    sx, sy = np.meshgrid(np.arange(10., 20.01, 0.5), np.arange(25., 32.01, 0.5))
+    grd.grid = xr.Dataset({'x': (('nyp', 'nxp'), sx), 'y': (('nyp', 'nxp'), sy)})
+    return grd, 'file:%s' % (tmp_path / 'topo.nc')
+
+def assert_same_roughness(a, b):
+    for var in ['h2', 'hStd', 'hMin', 'hMax', 'depth']:
+        assert np.array_equal(a[var].values, b[var].values)
+
+def test_roughness_checkpoint(tmp_path, monkeypatch):
+    grd, dsName = roughness_case(tmp_path)
+    opts = dict(maxMb=100, xBlocks=2, yBlocks=2, auxVariables=['hStd', 'hMin', 'hMax', 'depth'])
+    expected = bathyutils.computeBathymetricRoughness(grd, dsName, **opts)
+    checkpointDir = tmp_path / 'checkpoints'
+    first = bathyutils.computeBathymetricRoughness(grd, dsName, checkpointDir=str(checkpointDir), **opts)
+    assert_same_roughness(first, expected)
+    files = sorted(checkpointDir.iterdir())
+    assert len(files) == 4
+    # A rerun loads every block from its checkpoint
+    def fail(*args, **kwargs):
+        raise AssertionError('block computed again')
+    with monkeypatch.context() as m:
+        m.setattr(bathyutils, 'do_block', fail)
+        again = bathyutils.computeBathymetricRoughness(grd, dsName, checkpointDir=str(checkpointDir), **opts)
+    assert_same_roughness(again, expected)
+    assert sorted(checkpointDir.iterdir()) == files
+    # Options that change the result of a block change its key
+    lon, lat = np.meshgrid(np.arange(3.), np.arange(2.))
+    key = bathyutils.block_checkpoint_key(lon, lat, dsName, 'depth', 100)
+    assert key == bathyutils.block_checkpoint_key(lon, lat, dsName, 'depth', 100)
+    assert key != bathyutils.block_checkpoint_key(lon, lat, dsName, 'depth', 200)
+    assert key != bathyutils.block_checkpoint_key(lon+1., lat, dsName, 'depth', 100)
+    bathyutils.computeBathymetricRoughness(grd, dsName, checkpointDir=str(checkpointDir), **dict(opts, maxMb=200))
+    assert len(list(checkpointDir.iterdir())) == 8
+    # A different data source under the same name does not reuse the blocks
+    import os
+    import xarray as xr
+    with xr.open_dataset(tmp_path / 'topo.nc') as topo:
+        changed = topo.assign(depth=topo['depth'] + 10.).load()
+    changed.to_netcdf(tmp_path / 'changed.nc')
+    os.replace(tmp_path / 'changed.nc', tmp_path / 'topo.nc')
+    expected = bathyutils.computeBathymetricRoughness(grd, dsName, **opts)
+    again = bathyutils.computeBathymetricRoughness(grd, dsName, checkpointDir=str(checkpointDir), **opts)
+    assert_same_roughness(again, expected)
+    assert len(list(checkpointDir.iterdir())) == 12
+    lons, lats = np.arange(3.), np.arange(2.)
+    sourceKey = bathyutils.source_checkpoint_key(lons, lats, None)
+    assert sourceKey == bathyutils.source_checkpoint_key(lons, lats, np.zeros((2, 3)))
+    assert sourceKey != bathyutils.source_checkpoint_key(lons + 0.5, lats, None)
+
+def test_roughness_workers(tmp_path):
+    import concurrent.futures
+    grd, dsName = roughness_case(tmp_path)
+    opts = dict(maxMb=100, xBlocks=2, yBlocks=2, auxVariables=['hStd', 'hMin', 'hMax', 'depth'])
+    expected = bathyutils.computeBathymetricRoughness(grd, dsName, **opts)
+    # Blocks computed by a pool give the same result as the serial loop
+    assert_same_roughness(bathyutils.computeBathymetricRoughness(grd, dsName, nWorkers=2, **opts), expected)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        assert_same_roughness(bathyutils.computeBathymetricRoughness(grd, dsName, executor=executor, **opts), expected)
+
+def test_roughness_single_precision(tmp_path):
+    grd, dsName = roughness_case(tmp_path)
+    opts = dict(maxMb=100, auxVariables=['hStd', 'hMin', 'hMax', 'depth'])
+    expected = bathyutils.computeBathymetricRoughness(grd, dsName, **opts)
+    single = bathyutils.computeBathymetricRoughness(grd, dsName, singlePrecision=True, **opts)
+    # The plane fit of the single precision moments keeps the roughness to single precision
+    for var in ['h2', 'hStd', 'hMin', 'hMax', 'depth']:
+        a = expected[var].values
+        assert np.allclose(single[var].values, a, rtol=1e-6, atol=1e-6*np.abs(a).max())
+
+def test_topo_edits_file(tmp_path):
+    # The edits written with TOPO_EDITS_FILE reproduce the new depth from the original
+    import xarray as xr
+    from gridtools.gridutils import GridUtils
+    rng = np.random.default_rng(3)
+    depth = xr.DataArray(rng.uniform(-20.0, 50.0, (15, 21)), dims=('ny', 'nx'))
+    mask = xr.DataArray((rng.random((15, 21)) > 0.5).astype(float), dims=('ny', 'nx'))
+    xr.Dataset({'mask': mask}).to_netcdf(tmp_path / 'mask.nc')
+    editsFile = tmp_path / 'edits.nc'
+    grd = GridUtils()
+    newDepth = bathyutils.applyExistingLandmask(grd, xr.Dataset({'depth': depth}), 'depth',
+            str(tmp_path / 'mask.nc'), 'mask', MINIMUM_DEPTH=10.0, MASKING_DEPTH=5.0,
+            TOPO_EDITS_FILE=str(editsFile))
+    with xr.open_dataset(editsFile) as edits:
+        assert edits['ni'].values == 21 and edits['nj'].values == 15
+        assert edits['ni'].dtype == np.int32 and edits['iEdit'].dtype == np.int32
+        i, j = edits['iEdit'].values, edits['jEdit'].values
+        changed = newDepth.values != depth.values
+        assert len(i) == np.count_nonzero(changed) > 0
+        assert np.all(changed[j, i])
+        assert np.array_equal(edits['zEdit'].values, newDepth.values[j, i])
+        assert np.array_equal(edits['zOld'].values, depth.values[j, i])
@@ -44,3 +44,109 @@ def test_import():
         assert "gridtools" == "gridtools"
     except:
         assert "failed" == "gridutils"
+
+def test_rotation_matrix_regional():
+    # The composite rotation matches rotating the mesh one axis at a time
+    import numpy as np
+    from gridtools.gridutils import GridUtils
+    grd = GridUtils()
+    lam, phi = np.meshgrid(np.linspace(215., 245., 31), np.linspace(-15., 15., 21))
+    for (lon0, lat0, tilt) in [(230., 40., 30.), (0., 80., 5.), (350., -60., -20.)]:
+        lam_,phi_ = grd.rotate_z_mesh(lam-230.+lon0, phi, (90.-lon0)*grd.PI_180)
+        lam_,phi_ = grd.rotate_y_mesh(lam_, phi_, tilt*grd.PI_180)
+        lam_,phi_ = grd.rotate_x_mesh(lam_, phi_, lat0*grd.PI_180)
+        lam_,phi_ = grd.rotate_z_mesh(lam_, phi_, -(90.-lon0)*grd.PI_180)
+        lamR,phiR = grd.rotate_mesh(lam-230.+lon0, phi, grd.rotation_matrix_regional(lon0, lat0, tilt))
+        assert np.allclose(phiR, phi_, atol=1.e-10)
+        assert np.allclose(np.mod(lamR - lam_ + 180., 360.) - 180., 0., atol=1.e-10)
+
+def test_make_grid_blocks(tmp_path):
+    # A grid written in blocks of rows matches the grid made in memory
+    import numpy as np
+    from gridtools import utils
+    from gridtools.gridutils import GridUtils
+    gridParameters = {
+        'projection': {'name': 'LambertConformalConic', 'ellps': 'WGS84', 'lon_0': 230.0, 'lat_0': 40.0},
+        'centerX': 230.0, 'centerY': 40.0, 'centerUnits': 'degrees',
+        'dx': 20.0, 'dxUnits': 'degrees', 'dy': 30.0, 'dyUnits': 'degrees',
+        'tilt': 30.0, 'gridResolution': 1.0, 'gridMode': 2, 'gridType': 'MOM6',
+        'ensureEvenI': True, 'ensureEvenJ': True, 'tileName': 'tile1',
+    }
+    grd = GridUtils()
+    grd.setGridParameters(dict(gridParameters, projection=dict(gridParameters['projection'])))
+    grd.makeGrid()
+    utils.updateSha256sums(grd.grid)
+    tiled = GridUtils()
+    tiled.setGridParameters(dict(gridParameters, projection=dict(gridParameters['projection'])))
+    tiled.makeGrid(outputFile=str(tmp_path / 'ocean_hgrid.nc'), blockRows=7)
+    for var in ['x', 'y', 'dx', 'dy', 'angle_dx', 'area']:
+        assert np.array_equal(grd.grid[var].values, tiled.grid[var].values)
+        assert grd.grid[var].attrs['sha256'] == tiled.grid[var].attrs['sha256']
+    tiled.closeGrid()
+    # Rows of a rotated mesh computed by worker processes match the grid made in memory,
+    # also once the numba kernels have started their threads in this process
+    from gridtools import kernels
+    kernels.refine_2x2(np.zeros((3, 3)), backend='numba')
+    gridParameters = dict(gridParameters, projection={'name': 'Mercator', 'ellps': 'WGS84', 'lon_0': 230.0, 'lat_0': 40.0})
+    grd = GridUtils()
+    grd.setGridParameters(dict(gridParameters, projection=dict(gridParameters['projection'])))
+    grd.makeGrid()
+    utils.updateSha256sums(grd.grid)
+    tiled = GridUtils()
+    tiled.setGridParameters(dict(gridParameters, projection=dict(gridParameters['projection'])))
+    tiled.makeGrid(outputFile=str(tmp_path / 'ocean_hgrid_workers.nc'), blockRows=7, nWorkers=2)
+    for var in ['x', 'y', 'dx', 'dy', 'angle_dx', 'area']:
+        assert np.array_equal(grd.grid[var].values, tiled.grid[var].values)
+        assert grd.grid[var].attrs['sha256'] == tiled.grid[var].attrs['sha256']
+    tiled.closeGrid()
+
+def test_make_grid_cache(tmp_path):
+    # A cached grid matches the grid it was made from
+    import os
+    import numpy as np
+    from gridtools import gridcache
+    from gridtools.gridutils import GridUtils
+    gridParameters = {
+        'projection': {'name': 'Mercator', 'ellps': 'WGS84', 'lon_0': 230.0, 'lat_0': 40.0},
+        'centerX': 230.0, 'centerY': 40.0, 'centerUnits': 'degrees',
+        'dx': 20.0, 'dxUnits': 'degrees', 'dy': 30.0, 'dyUnits': 'degrees',
+        'tilt': 10.0, 'gridResolution': 1.0, 'gridMode': 2, 'gridType': 'MOM6',
+        'ensureEvenI': True, 'ensureEvenJ': True, 'tileName': 'tile1',
+    }
+    cacheDir = str(tmp_path / 'grids')
+    grids = list()
+    for i in range(2):
+        grd = GridUtils()
+        grd.setGridParameters(dict(gridParameters, projection=dict(gridParameters['projection'])))
+        grd.makeGrid(useCache=True, cacheDir=cacheDir)
+        grids.append(grd)
+    assert len(os.listdir(cacheDir)) == 1
+    assert isinstance(grids[1].grid['x'].data, np.memmap)
+    assert grids[0].gridInfo['gridParameters'] == grids[1].gridInfo['gridParameters']
+    for var in ['x', 'y', 'dx', 'dy', 'angle_dx', 'area']:
+        assert np.array_equal(grids[0].grid[var].values, grids[1].grid[var].values)
+        assert grids[0].grid[var].attrs == grids[1].grid[var].attrs
+    assert str(grids[1].grid['tile'].values) == 'tile1'
+
+    # Least recently used entries are removed beyond the size limit
+    gridcache.evict(cacheDir, 0)
+    assert len(os.listdir(cacheDir)) == 0
+
+def test_make_grid_blocks_failure(tmp_path):
+    # A failed block write raises and leaves neither a file nor an open grid
+    import pytest
+    from gridtools.gridutils import GridUtils
+    grd = GridUtils()
+    grd.setGridParameters({
+        'projection': {'name': 'LambertConformalConic', 'ellps': 'WGS84', 'lon_0': 230.0, 'lat_0': 40.0},
+        'centerX': 230.0, 'centerY': 40.0, 'centerUnits': 'degrees',
+        'dx': 20.0, 'dxUnits': 'degrees', 'dy': 30.0, 'dyUnits': 'degrees',
+        'tilt': 30.0, 'gridResolution': 1.0, 'gridMode': 2, 'gridType': 'MOM6',
+        'ensureEvenI': True, 'ensureEvenJ': True, 'tileName': 'tile1',
+    })
+    outputFile = tmp_path / 'missing' / 'ocean_hgrid.nc'
+    with pytest.raises(Exception):
+        grd.makeGrid(outputFile=str(outputFile), blockRows=7)
+    assert list(tmp_path.iterdir()) == []
+    assert grd.gridMesh is None
+    assert not grd.xrOpen
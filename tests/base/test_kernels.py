@@ -0,0 +1,93 @@
+# Compare the refinement kernels against the original numpy code.
+import numpy as np
+from gridtools import kernels, meshrefinement
+
+def test_coarsen_2x2():
+    rng = np.random.default_rng(0)
+    zm, xm, ym = [rng.standard_normal((9, 13)) for n in range(3)]
+    moments = tuple([rng.standard_normal((9, 13)) for n in range(5)])
+    for backend in ['numpy', 'numba']:
+        height, hmin, hmax, zc, xc, yc, mc = kernels.coarsen_2x2(zm, xm, ym, backend=backend)
+        assert np.array_equal(height, meshrefinement.fourPointAve(zm))
+        assert np.array_equal(xc, meshrefinement.fourPointAve(xm))
+        assert np.array_equal(mc[3], meshrefinement.fourPointAve(xm*zm))
+        assert np.array_equal(hmin[:-1,:-1], np.minimum(np.minimum(np.minimum(
+            zm[:-1:2,:-1:2], zm[1::2,1::2]), zm[1::2,0:-1:2]), zm[0:-1:2,1::2]))
+        assert np.array_equal(hmax[-1,:], zm[-1,::2])
+        height, hmin, hmax, zc, xc, yc, mc = kernels.coarsen_2x2(zm, xm, ym, moments=moments,
+                min_max=False, backend=backend)
+        assert hmin is None and hmax is None
+        assert np.array_equal(mc[4], meshrefinement.fourPointAve(moments[4]))
+
+def test_backends():
+    rng = np.random.default_rng(1)
+    X, Y, Z = [rng.standard_normal((7, 11)) for n in range(3)]
+    x = rng.uniform(-400, 400, (20, 30))
+    zs = rng.standard_normal((40, 50))
+    i, j = rng.integers(0, 50, (9, 13)), rng.integers(0, 40, (9, 13))
+    for backend in ['numpy', 'numba']:
+        a = kernels.refine_2x2(X, backend=backend)
+        assert np.array_equal(a[::2,::2], X) and np.array_equal(a[1::2,1::2], 0.25*((X[:-1,:-1]+X[1:,1:])+(X[1:,:-1]+X[:-1,1:])))
+        R = kernels.refine_xyz_2x2(X, Y, Z, backend=backend)
+        assert np.allclose(R[0]**2 + R[1]**2 + R[2]**2, 1)
+        assert np.array_equal(R[2], kernels.refine_xyz_2x2(X, Y, Z, backend='numpy')[2])
+        n = kernels.uniform_index(x, 300.05, 0.1, 400, period=360., backend=backend)
+        assert np.array_equal(n, kernels.uniform_index(x, 300.05, 0.1, 400, period=360., backend='numpy'))
+        zm, xm, ym = kernels.gather_nn(zs, np.arange(50.), np.arange(40.), i, j, dtype=np.float32, backend=backend)
+        assert zm.dtype == np.float32 and np.array_equal(zm, zs[j,i].astype(np.float32)) and np.array_equal(xm, i)
+    previous = kernels.set_backend('numba')
+    assert kernels.get_backend() in ['numpy', 'numba']
+    kernels.set_backend(previous)
+
+def test_path_minimum():
+    rng = np.random.default_rng(2)
+    # Star forest: every parent is a root
+    parent = np.array([0, 0, 0, 3, 3])
+    values = np.array([1., 5., 0., 2., 7.])
+    for backend in ['numpy', 'numba']:
+        assert np.array_equal(kernels.path_minimum(np.arange(5), parent, values, backend=backend), [1., 1., 0., 2., 2.])
+    # Random forests, nodes numbered with each parent before its children
+    for n in range(50):
+        size = rng.integers(1, 60)
+        parent = np.array([k if rng.random() < 0.1 else rng.integers(0, k) for k in range(1, size)], dtype=int)
+        parent = np.concatenate(([0], parent))
+        values = rng.standard_normal(size)
+        expected = values.copy()
+        for k in range(size):
+            expected[k] = min(values[k], expected[parent[k]])
+        for backend in ['numpy', 'numba']:
+            assert np.array_equal(kernels.path_minimum(np.arange(size), parent, values, backend=backend), expected)
+
+def test_coarsen_2x2_single():
+    # Single precision central moments against the covariances of the (2**n,2**n) blocks of
+    # the finest nodes, with coordinates far from zero where raw moments would lose them
+    rng = np.random.default_rng(3)
+    zm = (4000. + 100.*rng.standard_normal((17, 33))).astype(np.float32)
+    xm = 180. + 0.01*rng.standard_normal((17, 33))
+    ym = -60. + 0.01*rng.standard_normal((17, 33))
+    def covariance(a, b, n):
+        nj, ni = (a.shape[0]-1)//n, (a.shape[1]-1)//n
+        a = a[:-1,:-1].reshape((nj, n, ni, n)).astype(np.float64)
+        b = b[:-1,:-1].reshape((nj, n, ni, n)).astype(np.float64)
+        c = np.zeros((nj+1, ni+1))
+        c[:-1,:-1] = ((a - a.mean(axis=(1,3), keepdims=True))*(b - b.mean(axis=(1,3), keepdims=True))).mean(axis=(1,3))
+        return c
+    for backend in ['numpy', 'numba']:
+        coarse64 = kernels.coarsen_2x2(zm.astype(np.float64), xm, ym, backend=backend)
+        coarse32 = kernels.coarsen_2x2(zm, xm, ym, dtype=np.float32, backend=backend)
+        for n in [2, 4, 8]:
+            height, hmin, hmax, zc, xc, yc, mc = coarse32
+            assert height is zc and height.dtype == np.float32 and hmin.dtype == np.float32
+            assert xc.dtype == np.float64 and all([m.dtype == np.float32 for m in mc])
+            assert np.array_equal(xc, coarse64[4]) and np.allclose(height, coarse64[0], rtol=1e-6, atol=0)
+            expected = (covariance(xm, xm, n), covariance(ym, ym, n), covariance(xm, ym, n),
+                        covariance(xm, zm, n), covariance(ym, zm, n))
+            # The means zm of the refined nodes are rounded to single precision too
+            for (m, e) in zip(mc, expected):
+                assert np.allclose(m, e, rtol=1e-5, atol=1e-5*np.abs(e).max())
+            coarse64 = kernels.coarsen_2x2(*coarse64[3:6], moments=coarse64[6], backend=backend)
+            coarse32 = kernels.coarsen_2x2(*coarse32[3:6], moments=coarse32[6], dtype=np.float32, backend=backend)
+    numba32 = kernels.coarsen_2x2(zm, xm, ym, dtype=np.float32, backend='numba')
+    numpy32 = kernels.coarsen_2x2(zm, xm, ym, dtype=np.float32, backend='numpy')
+    for (a, b) in zip(numba32[6], numpy32[6]):
+        assert np.array_equal(a, b)
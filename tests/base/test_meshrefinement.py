@@ -0,0 +1,156 @@
+# Compare vectorized mesh refinement routines with the original loops.
+import numpy as np
+import pytest
+import xarray as xr
+from gridtools.meshrefinement import MeshRefinement
+
+def test_least_square_plane_estimate():
+    rng = np.random.default_rng(2)
+    xs = xr.DataArray(np.arange(0.05, 6.0, 0.1), dims=('lon',))
+    xs = xs.assign_coords(lon=xs)
+    ys = xr.DataArray(np.arange(10.05, 14.0, 0.1), dims=('lat',))
+    ys = ys.assign_coords(lat=ys)
+    zs = xr.DataArray(rng.standard_normal((ys.size, xs.size)), dims=('lat', 'lon'))
+    lon, lat = np.meshgrid(np.linspace(0.5, 5.5, 6), np.linspace(10.5, 13.5, 5))
+    mesh = MeshRefinement(lon=lon + 0.1*(lat-12), lat=lat)
+    expected = mesh.least_square_plane_estimate_old(xs, ys, zs)
+    for max_points in [10, 2**22]:
+        result = mesh.least_square_plane_estimate(xs, ys, zs, max_points=max_points)
+        for (a, b) in zip(result, expected):
+            assert np.allclose(a, b, rtol=1e-12, atol=0)
+
+def test_find_nn_source():
+    # Compare the indexes of non-uniform and 2D sources with a brute force search
+    x = np.concatenate((np.arange(0.05, 3.0, 0.1), np.arange(3.0, 6.0, 0.04)))
+    y = np.arange(10.05, 14.0, 0.1)**1.1
+    lon, lat = np.meshgrid(np.linspace(0.52, 5.52, 6), np.linspace(13.51, 17.51, 5))
+    mesh = MeshRefinement(lon=lon + 0.1*(lat-15), lat=lat).refineby2().refineby2()
+    i = np.abs(mesh.lon[:,:,None] - x).argmin(axis=2)
+    j = np.abs(mesh.lat[:,:,None] - y).argmin(axis=2)
+    ni, nj = mesh.find_nn_source(x, y)
+    assert np.array_equal(ni, i) and np.array_equal(nj, j)
+    # A 2D source with the same points
+    x2, y2 = np.meshgrid(x, y)
+    ni, nj = mesh.find_nn_source(x2, y2)
+    assert np.mean(ni == i) > 0.99 and np.mean(nj == j) > 0.99
+
+def test_uniform_axis():
+    # Compare indexes of uniform axes with a brute force search
+    from gridtools.meshrefinement import uniform_axis
+    rng = np.random.default_rng(3)
+    x = rng.uniform(-400, 400, 1000)
+    for lon in [np.arange(-179.95, 180, 0.1), np.arange(0, 360.001, 0.25), np.arange(300.05, 340, 0.1)]:
+        axis = uniform_axis(lon, period=360.)
+        dist = np.abs(np.mod(x[:,None] - lon[:axis.count] + 180, 360) - 180)
+        assert np.array_equal(axis.index(x), dist.argmin(axis=1))
+    lat = np.arange(89.95, -90, -0.1)
+    y = rng.uniform(-95, 95, 1000)
+    assert np.array_equal(uniform_axis(lat).index(y), np.abs(y[:,None] - lat).argmin(axis=1))
+    assert uniform_axis(np.arange(0, 360.001, 0.25), period=360.).periodic
+    assert uniform_axis(lat**3) is None
+
+def test_block_average():
+    # Average a source 10x finer than a sheared mesh and compare with a direct
+    # search of the source points in each cell
+    from gridtools.meshrefinement import block_average
+    lon, lat = np.meshgrid(np.arange(10., 16.01, 1.), np.arange(40., 44.01, 1.))
+    lon = lon + 0.25*(lat - 40.)
+    src_lon = np.arange(9.05, 17., 0.1)
+    src_lat = np.arange(39.05, 45., 0.1)
+    src = np.add.outer(np.arange(src_lat.size), 0.01*np.arange(src_lon.size)**2) - 20.
+    mean, frac, hmin, hmax = block_average(lon, lat, src_lon, src_lat, src, max_elements=500)
+    x, y = np.meshgrid(src_lon, src_lat)
+    w = np.cos(np.deg2rad(y))
+    for (j, i) in [(0, 0), (2, 3), (3, 5)]:
+        # Cell edges are nearly straight in (lon,lat) at this size
+        s = (y - 40. - j)*(y - 41. - j) < 0
+        s &= (x - lon[j,i] - 0.25*(y - lat[j,i]))*(x - lon[j,i+1] - 0.25*(y - lat[j,i])) < 0
+        assert np.isclose(mean[j,i], (w*src)[s].sum()/w[s].sum())
+        assert np.isclose(frac[j,i], w[s & (src > 0)].sum()/w[s].sum())
+        assert hmin[j,i] == src[s].min() and hmax[j,i] == src[s].max()
+
+def test_block_average_seam():
+    # A source window wrapped to [-180,180] across the dateline gives the same
+    # averages as the continuous longitudes
+    from gridtools.meshrefinement import block_average, _cell_widths
+    lon, lat = np.meshgrid(np.arange(172., 188.01, 2.), np.arange(-4., 4.01, 2.))
+    src_lon = np.arange(170.25, 190., 0.5)
+    src_lat = np.arange(-5.75, 6., 0.5)
+    wrapped = np.where(src_lon > 180., src_lon - 360., src_lon)
+    src = np.add.outer(np.sin(src_lat), np.cos(src_lon))*100.
+    src[:, src_lon.size//2 - 1:src_lon.size//2 + 1] = 500.
+    assert np.allclose(_cell_widths(wrapped, period=360.), 0.5, rtol=1e-12, atol=0)
+    expected = block_average(lon, lat, src_lon, src_lat, src)
+    for (a, b) in zip(block_average(lon, lat, wrapped, src_lat, src), expected):
+        assert np.allclose(a, b, rtol=1e-12, atol=0)
+
+def test_source_hit_count():
+    # The hit count matches the sum of the hit mask for 1D and 2D sources
+    lon, lat = np.meshgrid(np.linspace(0.5, 5.5, 6), np.linspace(84.5, 89.5, 6))
+    mesh = MeshRefinement(lon=lon, lat=lat).refineby2()
+    x = np.arange(0.05, 6.0, 0.1)
+    y = np.arange(84.05, 90.0, 0.1)
+    x2, y2 = np.meshgrid(x, y)
+    for (xs, ys) in [(x, y), (x2, y2)]:
+        for radius in [0., 0.25]:
+            hits = mesh.source_hits(xs, ys, singularity_radius=radius)
+            assert mesh.source_hit_count(xs, ys, singularity_radius=radius) == (hits.sum(), hits.size)
+
+def test_refine_loop_predict_levels():
+    # Predicting the levels reaches the same hit count and final level as refining one level at a time
+    lon, lat = np.meshgrid(np.linspace(0., 6., 7), np.linspace(30., 36., 7))
+    src_lon = np.arange(0.025, 6.0, 0.05)
+    src_lat = np.arange(30.025, 36.0, 0.05)
+    assert MeshRefinement(lon=lon, lat=lat).predict_refine_levels(src_lon, src_lat) == 5
+    default = MeshRefinement(lon=lon, lat=lat).refine_loop(src_lon, src_lat, verbose=False)
+    predicted = MeshRefinement(lon=lon, lat=lat).refine_loop(src_lon, src_lat, verbose=False, predict_levels=True)
+    assert predicted[-1].rfl == default[-1].rfl
+    assert predicted[-1].shape == default[-1].shape
+    assert predicted[-1].source_hit_count(src_lon, src_lat) == default[-1].source_hit_count(src_lon, src_lat)
+    assert predicted[-1].source_hit_count(src_lon, src_lat)[0] == src_lon.size*src_lat.size
+
+def test_refine_xyz_lonlat():
+    # Longitudes and latitudes derived from the 3d coordinates match the originals across the
+    # dateline, to the round off of arccos() near 180 degrees
+    lon, lat = np.meshgrid(np.linspace(170., 190., 9), np.linspace(-30., 60., 7))
+    mesh = MeshRefinement(lon=lon, lat=lat)
+    derived = MeshRefinement(xyz=mesh.xyz())
+    assert MeshRefinement.mdist(derived.lon, lon).max() < 1.e-6
+    assert np.allclose(derived.lat, lat, rtol=0, atol=1.e-12)
+    # Keeping the 3d coordinates between levels matches refining from (lon,lat) at every level
+    kept, lonlat = mesh, MeshRefinement(lon=lon, lat=lat)
+    for level in range(3):
+        kept = kept.refineby2()
+        fine = lonlat.refineby2()
+        lonlat = MeshRefinement(lon=fine.lon, lat=fine.lat, rfl=fine.rfl)
+        assert kept.shape == lonlat.shape and kept.rfl == lonlat.rfl
+        assert MeshRefinement.mdist(kept.lon, lonlat.lon).max() < 1.e-6
+        assert np.allclose(kept.lat, lonlat.lat, rtol=0, atol=1.e-8)
+
+def test_coarsen_released_hierarchy():
+    # Releasing coordinates and data between levels does not change the coarsened moments,
+    # which with the moments of the finest mesh determine the roughness
+    lon, lat = np.meshgrid(np.linspace(0., 6., 7), np.linspace(30., 36., 7))
+    src_lon = np.arange(0.025, 6.0, 0.05)
+    src_lat = np.arange(30.025, 36.0, 0.05)
+    x, y = np.meshgrid(src_lon, src_lat)
+    src = 1000.*np.sin(np.deg2rad(40.*x))*np.cos(np.deg2rad(50.*y)) + 10.*np.cos(np.deg2rad(97.*x*y))
+    hierarchy = MeshRefinement(lon=lon, lat=lat).refine_loop(src_lon, src_lat, verbose=False)
+    hierarchy.sample(src_lon, src_lat, src)
+    hierarchy.coarsen()
+    full = [MeshRefinement(lon=lon, lat=lat)]
+    for level in range(len(hierarchy)-1):
+        full.append(full[-1].refineby2())
+    full[-1].sample_source_data_on_target_mesh(src_lon, src_lat, src)
+    for i in reversed(range(1, len(full))):
+        full[i].coarsenby2(full[i-1])
+    for name in ['height', 'h_min', 'h_max', 'xm', 'ym', 'zm', 'xxm', 'yym', 'xym', 'xzm', 'yzm']:
+        assert np.array_equal(hierarchy[0][name], full[0][name])
+    for name in ['xm', 'ym', 'zm']:
+        assert np.array_equal(hierarchy[-1][name], full[-1][name])
+    # Only the parent mesh keeps its coordinates and only the finest mesh keeps its data
+    for mesh in hierarchy[1:]:
+        with pytest.raises(Exception):
+            mesh.lon
+    for mesh in hierarchy[1:-1]:
+        assert not hasattr(mesh, 'zm')
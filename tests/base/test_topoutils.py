@@ -0,0 +1,102 @@
+# Check the helpers used by TopoUtils.regridTopo().
+import numpy as np
+import pytest
+import xarray as xr
+
+xe = pytest.importorskip('xesmf')
+from gridtools import topoutils
+
+def test_regridder_key():
+    lon = np.linspace(0., 10., 11)
+    lat = np.linspace(-5., 5., 6)
+    lon_b = np.linspace(-0.5, 10.5, 12)
+    lat_b = np.linspace(-6., 6., 7)
+    dsIn = xr.Dataset(coords={'lon': lon, 'lat': lat, 'lon_b': lon_b, 'lat_b': lat_b})
+    dsOut = xr.Dataset(coords={'lon': lon[::2], 'lat': lat[::2]})
+    key = topoutils.regridder_key(dsIn, dsOut, 'conservative', True)
+    # Only the coordinates, method and periodicity determine the key
+    assert key == topoutils.regridder_key(dsIn.assign(depth=('lat', lat)), dsOut, 'conservative', 1)
+    assert key != topoutils.regridder_key(dsIn, dsOut, 'bilinear', True)
+    assert key != topoutils.regridder_key(dsIn, dsOut, 'conservative', False)
+    assert key != topoutils.regridder_key(dsOut, dsIn, 'conservative', True)
+    assert key != topoutils.regridder_key(dsIn.assign_coords(lat_b=lat_b + 0.1), dsOut, 'conservative', True)
+    assert key != topoutils.regridder_key(dsIn.drop_vars('lon_b'), dsOut, 'conservative', True)
+
+def test_auto_coarsen_factor():
+    topoLon = np.arange(0., 20., 1./64.)
+    topoLat = np.arange(-10., 10., 1./64.)
+    gridLon, gridLat = np.meshgrid(np.arange(2., 8.01, 0.5), np.arange(-3., 3.01, 1.))
+    # About four coarsened cells across the smallest (0.5 degree) grid cell
+    assert topoutils.auto_coarsen_factor(topoLon, topoLat, gridLon, gridLat) == 8
+    assert topoutils.auto_coarsen_factor(topoLon, topoLat, gridLon, gridLat, cellsPerTarget=2) == 16
+    # A grid crossing the dateline uses the short way around
+    dateLon, dateLat = np.meshgrid(np.array([179., 179.5, -180., -179.5]), np.arange(-3., 3.01, 1.))
+    assert topoutils.auto_coarsen_factor(topoLon, topoLat, dateLon, dateLat) == 8
+    # Topography coarser than the grid, or a grid without spacing, is not coarsened
+    assert topoutils.auto_coarsen_factor(topoLon, topoLat, gridLon/64., gridLat/64.) == 1
+    assert topoutils.auto_coarsen_factor(topoLon, topoLat, np.zeros((2, 2)), np.zeros((2, 2))) == 1
+
+def test_coarsen_window():
+    # The window is aligned to the coarsening factor with two coarsened cells of halo
+    assert topoutils.coarsen_window(25, 40, 100, 10) == slice(0, 70)
+    assert topoutils.coarsen_window(40, 25, 100, 10) == slice(0, 70)
+    assert topoutils.coarsen_window(45, 52, 100, 10) == slice(20, 80)
+    assert topoutils.coarsen_window(45, 52, 100, 10, halo=0) == slice(40, 60)
+    assert topoutils.coarsen_window(45, 52, 100, 10, halo=1) == slice(30, 70)
+    # The window is clamped to the ends of the axis
+    assert topoutils.coarsen_window(3, 8, 100, 10) == slice(0, 30)
+    assert topoutils.coarsen_window(90, 99, 103, 10) == slice(70, 103)
+    assert topoutils.coarsen_window(0, 102, 103, 1, halo=5) == slice(0, 103)
+    # Coarsening the window gives the same cells as coarsening the whole axis
+    a = xr.DataArray(np.arange(103.)**2, dims=('nx',))
+    full = a.coarsen(nx=10, boundary='pad').mean()
+    for (i0, i1) in [(25, 40), (3, 8), (90, 99), (0, 102)]:
+        w = topoutils.coarsen_window(i0, i1, 103, 10)
+        part = a.isel(nx=w).coarsen(nx=10, boundary='pad').mean()
+        assert np.array_equal(part.values, full.values[w.start//10:w.start//10 + part.size])
+
+def test_stack_topo_fields():
+    rng = np.random.default_rng(5)
+    elev = rng.uniform(-1., 1., (6, 8))
+    elev[0, :3] = [0., 5.e-7, 1.e-6]
+    elev[1, 0] = np.nan
+    fields = topoutils.stack_topo_fields(elev, 'depth')
+    assert list(fields['field'].values) == ['depth', 'mask']
+    assert np.array_equal(fields.sel(field='depth').values, elev, equal_nan=True)
+    # The ocean fraction matches the chained where/fillna it replaces
+    lm = xr.DataArray(elev, dims=('ny', 'nx'))
+    lm = lm.where(lm > 0).fillna(0)
+    lm = lm.where(lm < 0.000001).fillna(1)
+    assert np.array_equal(fields.sel(field='mask').values, lm.values)
+    # Regridding the stacked fields is the same as regridding each field separately
+    lon_b, lat_b = np.meshgrid(np.linspace(0., 8., 9), np.linspace(-3., 3., 7))
+    lon, lat = np.meshgrid(np.linspace(0.5, 7.5, 8), np.linspace(-2.5, 2.5, 6))
+    topo = xr.Dataset(coords={'lon': (('ny', 'nx'), lon), 'lat': (('ny', 'nx'), lat),
+        'lon_b': (('nyp', 'nxp'), lon_b), 'lat_b': (('nyp', 'nxp'), lat_b)})
+    grid = xr.Dataset(coords={'lon': (('ny', 'nx'), lon[::2,::2] + 0.5), 'lat': (('ny', 'nx'), lat[::2,::2] + 0.5),
+        'lon_b': (('nyp', 'nxp'), lon_b[::2,::2]), 'lat_b': (('nyp', 'nxp'), lat_b[::2,::2])})
+    fields = topoutils.stack_topo_fields(np.nan_to_num(elev), 'depth')
+    regridder = xe.Regridder(topo, grid, method='conservative', periodic=False)
+    stacked = regridder(fields)
+    for name in ['depth', 'mask']:
+        separate = regridder(fields.sel(field=name, drop=True))
+        assert np.allclose(stacked.sel(field=name).values, separate.values, rtol=1.e-14, atol=0)
+
+def test_block_average_topo():
+    from gridtools.gridutils import GridUtils
+    lonCorners, latCorners = np.meshgrid(np.array([0., 1., 2.]), np.array([-1., 0., 1.]))
+    grid = xr.Dataset({'lon_corners': (('nyp', 'nxp'), lonCorners), 'lat_corners': (('nyp', 'nxp'), latCorners)})
+    # Two topography points in each direction of each cell, columns are constant in each cell
+    depth = np.array([[100., 100., 200., 400.],
+                      [100., 100., 200., 400.],
+                      [-10., -10.,  -5.,  50.],
+                      [-10., -10.,  -5.,  50.]])
+    topo = xr.Dataset({'depth': (('ny', 'nx'), depth),
+        'lon_centers': (('nx',), np.array([0.25, 0.75, 1.25, 1.75])),
+        'lat_centers': (('ny',), np.array([-0.75, -0.25, 0.25, 0.75]))})
+    result = topoutils.TopoUtils().blockAverageTopo(GridUtils(), grid, topo, 'depth', superGrid=False)
+    # Land cells have no depth, the fraction is the share of ocean points
+    assert np.allclose(result['depth'].values, [[100., 300.], [0., 22.5]], rtol=1.e-14)
+    assert np.allclose(result['ocean_mask'].values, [[1., 1.], [0., 0.5]], rtol=1.e-14)
+    assert np.array_equal(result['hMin'].values, [[100., 200.], [-10., -5.]])
+    assert np.array_equal(result['hMax'].values, [[100., 400.], [-10., 50.]])
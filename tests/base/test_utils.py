@@ -0,0 +1,21 @@
+def test_sha256sum():
+    # Hashes match hashing a C ordered copy of the data
+    import hashlib
+    import numpy as np
+    import xarray as xr
+    import dask.array as da
+    from gridtools import utils
+    data = np.random.default_rng(5).random((37, 23))
+    expected = hashlib.sha256(np.array(data)).hexdigest()
+    assert utils.sha256sum(data) == expected
+    assert utils.sha256sum(np.asfortranarray(data)) == expected
+    assert utils.sha256sum(xr.DataArray(data)) == expected
+    assert utils.sha256sum(da.from_array(data, chunks=(10, 7))) == expected
+
+    ds = xr.Dataset({'x': (('ny', 'nx'), data), 'y': (('ny', 'nx'), da.from_array(data[::-1], chunks=(8, 23)))})
+    utils.deferSha256sum(ds['x'])
+    utils.deferSha256sum(ds['y'])
+    assert ds['x'].attrs['sha256'] == utils.SHA256_DEFERRED
+    utils.updateSha256sums(ds)
+    assert ds['x'].attrs['sha256'] == expected
+    assert ds['y'].attrs['sha256'] == hashlib.sha256(np.array(data[::-1])).hexdigest()